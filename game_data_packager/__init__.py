@@ -184,6 +184,12 @@ class GameData(object):
         self.known_sha1s = {}
         self.known_sha256s = {}
 
+        # Map from crc32 to a set of names of WantedFile instances.
+        # This is only a hint: a match must be confirmed by size, and then
+        # by a stronger hash.
+        # { '0bfa5a5e': set(['doom2.wad_1.9']) }
+        self.known_crc32s = {}
+
         self._populate_files(self.data.get('files'))
 
         assert 'packages' in self.data
@@ -192,6 +198,7 @@ class GameData(object):
             # these should only be at top level, since they are global
             assert 'sha1sums' not in data, binary
             assert 'sha256sums' not in data, binary
+            assert 'crc32sums' not in data, binary
 
             if 'DISABLED' in data:
                 continue
@@ -253,7 +260,7 @@ class GameData(object):
             for line in self.data['size_and_md5'].splitlines():
                 self._add_hash(line, 'size_and_md5')
 
-        for alg in ('sha1', 'sha256'):
+        for alg in ('sha1', 'sha256', 'crc32'):
             if alg + 'sums' in self.data:
                 for line in self.data[alg + 'sums'].splitlines():
                     self._add_hash(line, alg)
@@ -388,6 +395,7 @@ class GameData(object):
             ret['packages'] = packages
 
         for k in (
+                'known_crc32s',
                 'known_filenames',
                 'known_md5s',
                 'known_sha1s',
@@ -422,7 +430,7 @@ class GameData(object):
                size_max += file.size
         for file in package.optional_files:
            if file.alternatives:
-               size_max += max(set(self.files[a].size for a in file.alternatives))
+               size_max += max(set(self.files[a].size or 0 for a in file.alternatives))
            elif file.size:
                size_max += file.size
         return (size_min, size_max)
@@ -464,6 +472,7 @@ class GameData(object):
                 assert data['look_for'] != [data['install_as']], filename
             for k in (
                     'alternatives',
+                    'crc32',
                     'distinctive_name',
                     'distinctive_size',
                     'download',
@@ -630,7 +639,7 @@ class GameData(object):
                     data = json.loads(jsondata)
                     self._populate_files(data)
 
-                for alg in ('sha1', 'sha256', 'size_and_md5'):
+                for alg in ('sha1', 'sha256', 'crc32', 'size_and_md5'):
                     filename = '%s.%s%s' % (self.shortname, alg,
                             '' if alg == 'size_and_md5' else 'sums')
                     if filename in files:
@@ -656,7 +665,7 @@ class GameData(object):
                 data = json.load(open(filename, encoding='utf-8'))
                 self._populate_files(data)
 
-            for alg in ('sha1', 'sha256', 'size_and_md5'):
+            for alg in ('sha1', 'sha256', 'crc32', 'size_and_md5'):
                 filename = os.path.join(vfs, '%s.%s%s' %
                         (self.shortname, alg,
                             '' if alg == 'size_and_md5' else 'sums'))
@@ -720,6 +729,9 @@ class GameData(object):
             if f.sha256 is not None:
                 self.known_sha256s.setdefault(f.sha256, set()).add(filename)
 
+            if f.crc32 is not None:
+                self.known_crc32s.setdefault(f.crc32, set()).add(filename)
+
         # check for different files that shares same md5 & look_for
         for file in self.known_md5s:
             if len(self.known_md5s[file]) == 1:
@@ -818,6 +830,7 @@ class GameData(object):
                 assert wanted.md5 is None, wanted.name
                 assert wanted.sha1 is None, wanted.name
                 assert wanted.sha256 is None, wanted.name
+                assert wanted.crc32 is None, wanted.name
                 assert wanted.size is None, wanted.name
             else:
                 assert (wanted.size is not None or filename in
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+"""Package several games in one process, walking each path and hashing
+each file only once.
+"""
+
+import copy
+import logging
+import os
+import stat
+from contextlib import (ExitStack)
+
+from .packaging import (get_packaging_system)
+
+logger = logging.getLogger(__name__)
+
+class CombinedIndex(object):
+    """Which games might want a file, across all the games in a batch."""
+
+    def __init__(self, tasks):
+        # { 'id1/pak0.pak': set(['quake']) }
+        self.filenames = {}
+        # { 18689235: set(['quake']) }
+        self.sizes = {}
+        self.md5s = {}
+        self.sha1s = {}
+        self.sha256s = {}
+
+        for shortname, task in tasks.items():
+            game = task.game
+
+            for look_for in game.known_filenames:
+                self.filenames.setdefault(look_for, set()).add(shortname)
+
+            for p in game.rip_cd_packages:
+                look_for = (p.rip_cd['filename_format'] %
+                        p.rip_cd.get('first_track', 2)).lower()
+                self.filenames.setdefault(look_for, set()).add(shortname)
+
+            for size in game.known_sizes:
+                self.sizes.setdefault(size, set()).add(shortname)
+
+            for index, known in ((self.md5s, game.known_md5s),
+                    (self.sha1s, game.known_sha1s),
+                    (self.sha256s, game.known_sha256s)):
+                for h in known:
+                    index.setdefault(h, set()).add(shortname)
+
+    def by_name_or_size(self, path, size):
+        """Return the games that have a file whose name is a suffix of
+        path, or whose size is size.
+        """
+        ret = set(self.sizes.get(size, ()))
+        parts = path.lower().split('/')
+
+        for i in range(len(parts)):
+            ret |= self.filenames.get('/'.join(parts[i:]), set())
+
+        return ret
+
+    def by_hashes(self, hashes):
+        return (self.md5s.get(hashes.md5, set()) |
+                self.sha1s.get(hashes.sha1, set()) |
+                self.sha256s.get(hashes.sha256, set()))
+
+def resolve_batch_arguments(args, games):
+    """Split the positional arguments of batch mode into games and paths.
+
+    Return a dict { game shortname: set of names given for it } and
+    a list of paths. Each name is the shortname or an alias of the game,
+    or the name of one of its packages. An argument containing '/' is
+    always a path.
+    """
+    wanted = {}
+    paths = []
+
+    for arg in args.games_and_paths:
+        if '/' not in arg:
+            for game in games.values():
+                if (arg == game.shortname or arg in game.aliases or
+                        arg in game.packages):
+                    wanted.setdefault(game.shortname, set()).add(arg)
+                    break
+            else:
+                paths.append(arg)
+        else:
+            paths.append(arg)
+
+    return wanted, paths
+
+def scan(paths, tasks, index):
+    """Walk each path once, and give each file to the tasks for the games
+    that might want it.
+    """
+    hasher = next(iter(tasks.values()))
+
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            logger.warning('file "%s" does not exist or is not a file, ' +
+                    'directory or CD block device', path)
+            continue
+
+        if stat.S_ISREG(st.st_mode):
+            # a file specified on the command line: try harder to match
+            # it to something
+            shortnames = (index.by_name_or_size(path, st.st_size) |
+                    index.by_hashes(hasher.hash_file(path, st.st_size)))
+
+            if not shortnames:
+                logger.warning('file "%s" does not match any known file',
+                        path)
+
+            for shortname in sorted(shortnames):
+                tasks[shortname].consider_file(path, True)
+        elif stat.S_ISDIR(st.st_mode):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for fn in filenames:
+                    file_path = os.path.join(dirpath, fn)
+
+                    try:
+                        size = os.stat(file_path).st_size
+                    except OSError:
+                        # dangling symlink
+                        continue
+
+                    for shortname in sorted(index.by_name_or_size(file_path,
+                            size)):
+                        tasks[shortname].consider_file(file_path, False)
+        elif stat.S_ISBLK(st.st_mode):
+            for task in tasks.values():
+                if task.game.rip_cd_packages:
+                    task.cd_device = path
+        else:
+            logger.warning('file "%s" does not exist or is not a file, ' +
+                    'directory or CD block device', path)
+
+def run_batch_mode(parsed, games, progress_factory=None, hash_cache=None):
+    wanted, paths = resolve_batch_arguments(parsed, games)
+
+    if not wanted and not parsed.all_found:
+        logger.error('Please specify some games, or --all-found to package '
+                'every game that is found.')
+        raise SystemExit(2)
+
+    if parsed.all_found:
+        shortnames = sorted(games)
+    else:
+        shortnames = sorted(wanted)
+
+    packaging = get_packaging_system(parsed.target_format,
+            parsed.target_distro)
+    failed = []
+
+    if hash_cache is None:
+        hash_cache = {}
+
+    with ExitStack() as stack:
+        tasks = {}
+
+        for shortname in shortnames:
+            task = stack.enter_context(games[shortname].construct_task(
+                packaging=packaging))
+            task.hash_cache = hash_cache
+
+            if progress_factory is not None:
+                task.progress_factory = progress_factory
+
+            tasks[shortname] = task
+
+        scan(paths, tasks, CombinedIndex(tasks))
+
+        if parsed.all_found:
+            todo = sorted(set(wanted) | set(s for s in shortnames
+                if tasks[s].found or tasks[s].cd_tracks))
+            logger.info('found files for: %s', ', '.join(todo) or 'nothing')
+        else:
+            todo = shortnames
+
+        for shortname in todo:
+            task = tasks[shortname]
+            game = task.game
+            names = wanted.get(shortname, set())
+            args = copy.copy(parsed)
+            args.shortname = shortname
+            args.paths = []
+
+            if (not names or shortname in names or
+                    names & set(game.aliases)):
+                args.packages = [p for p in parsed.packages
+                        if p in game.packages]
+            else:
+                args.packages = sorted(names)
+
+            logger.info('packaging %s...', game.longname)
+
+            try:
+                task.run_command_line(args)
+            except SystemExit as e:
+                if e.code:
+                    if not isinstance(e.code, int):
+                        logger.error('%s', e.code)
+                    failed.append(shortname)
+
+    if failed:
+        logger.error('Unable to package: %s', ', '.join(failed))
+        raise SystemExit(1)
@@ -18,13 +18,17 @@
 
 from collections import defaultdict
 from enum import Enum
+import concurrent.futures
 import logging
 import os
+import queue
 import random
+import re
 import shutil
 import stat
 import subprocess
 import tempfile
+import threading
 import urllib.request
 import zipfile
 
@@ -41,12 +45,17 @@ from .gog import GOG
 from .packaging import (get_native_packaging_system)
 from .paths import (DATADIR, ETCDIR)
 from .unpack import (TarUnpacker, ZipUnpacker)
+from .unpack.cab import (Cab, find_sibling)
+from .unpack.lha import (Lha)
 from .unpack.umod import (Umod)
 from .util import (AGENT,
+        MEBIBYTE,
         TemporaryUmask,
         check_call,
         check_output,
+        clone_file,
         copy_with_substitutions,
+        human_size,
         lang_score,
         mkdir_p,
         rm_rf,
@@ -56,6 +65,58 @@ from .util import (AGENT,
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+# Number of threads used to extract members from a seekable archive
+try:
+    EXTRACTION_THREADS = min(8, len(os.sched_getaffinity(0)))
+except AttributeError:
+    EXTRACTION_THREADS = min(8, os.cpu_count() or 1)
+
+# Formats we can unpack without running an external tool (cabextract
+# only needs the tool for Quantum-compressed cabinets: see
+# PackagingTask.runs_tool())
+BUILTIN_FORMATS = ('cabextract', 'cat', 'dos2unix', 'lha', 'tar.*', 'tar.gz',
+        'tar.bz2', 'tar.xz', 'umod', 'zip')
+
+# Rough relative cost of getting a byte of a provider that we don't
+# have yet, or of unpacking it, compared with reading a byte from disk
+DOWNLOAD_COST = 20
+UNPACK_COST = {
+        None: 2,
+        'cat': 1,
+        'dos2unix': 1,
+        'tar.*': 1,
+        'tar.gz': 1,
+        'tar.bz2': 4,
+        'tar.xz': 2,
+        'zip': 1,
+        # decompressed in Python
+        'lha': 10,
+        'cabextract': 2,
+        'umod': 1,
+        # slow or heavyweight external tools
+        'innoextract': 3,
+        'unshield': 4,
+}
+# Overhead of running an external tool, in the same units
+TOOL_COST = MEBIBYTE
+
+# Number of files downloaded at the same time
+DOWNLOAD_THREADS = 4
+
+# Archives inside archives up to this size are unpacked from memory
+# instead of being extracted to the workdir first
+NESTED_ARCHIVE_LIMIT = 64 * MEBIBYTE
+
+# Formats that can be unpacked from a file-like object. Cabinets are
+# not included, because they can continue into other cabinets, which
+# have to be found next to them on disk.
+NESTED_ARCHIVE_FORMATS = ('lha', 'zip', 'tar.*', 'tar.gz', 'tar.bz2',
+        'tar.xz')
+
+# A file in the output of "unshield l": the size and the name are
+# separated by two spaces, whereas the "N files" trailer only has one
+UNSHIELD_LIST_LINE = re.compile(r'^\s*(\d+)  (\S.*)$')
+
 class FillResult(Enum):
     UNDETERMINED = 0
     IMPOSSIBLE = 1
@@ -168,20 +229,36 @@ def choose_mirror(wanted):
         return []
     return mirrors
 
+def get_fat_mounts():
+    """Return the mount points of FAT and NTFS filesystems, which might
+    be Windows installations. /proc/mounts is only read once.
+    """
+    if get_fat_mounts.MOUNTS is None:
+        mounts = []
+
+        with open('/proc/mounts', 'r', encoding='utf8') as reader:
+            for line in reader.readlines():
+                mount, vfstype = line.split(' ')[1:3]
+                if vfstype in ('fat', 'vfat', 'ntfs'):
+                    mounts.append(mount)
+
+        get_fat_mounts.MOUNTS = mounts
+
+    return get_fat_mounts.MOUNTS
+
+get_fat_mounts.MOUNTS = None
+
 def iter_fat_mounts(folder):
-    with open('/proc/mounts', 'r', encoding='utf8') as mounts:
-        for line in mounts.readlines():
-            mount, vfstype = line.split(' ')[1:3]
-            if vfstype in ('fat', 'vfat', 'ntfs'):
-                path = os.path.join(mount, 'Program Files (x86)', folder)
-                if os.path.isdir(path):
-                    yield path
-                path = os.path.join(mount, 'Program Files', folder)
-                if os.path.isdir(path):
-                    yield path
-                path = os.path.join(mount, folder)
-                if os.path.isdir(path):
-                    yield path
+    for mount in get_fat_mounts():
+        path = os.path.join(mount, 'Program Files (x86)', folder)
+        if os.path.isdir(path):
+            yield path
+        path = os.path.join(mount, 'Program Files', folder)
+        if os.path.isdir(path):
+            yield path
+        path = os.path.join(mount, folder)
+        if os.path.isdir(path):
+            yield path
 
 class PackagingTask(object):
     def __init__(self, game, packaging=None, builder_packaging=None):
@@ -222,6 +299,31 @@ class PackagingTask(object):
         # Set of filenames we couldn't unpack, or already unpacked
         self.unpack_tried = set()
 
+        # Set of filenames that were unpacked from memory while
+        # unpacking another archive, and never written to disk.
+        # They are not in found, but their file_status is COMPLETE.
+        self.unpacked_in_memory = set()
+
+        # Nested archives up to this size are unpacked from memory.
+        self.nested_archive_limit = NESTED_ARCHIVE_LIMIT
+
+        # Number of threads used to extract members from one seekable
+        # archive. The Executor sets this to 1 while it is unpacking
+        # several archives at once.
+        self.extraction_threads = EXTRACTION_THREADS
+
+        # Held while updating found, file_status, unpack_tried and
+        # unpacked_in_memory, which the Executor's steps share
+        self.__state_lock = threading.RLock()
+
+        # Map from (provider name, path) to whether unpacking that
+        # cabinet needs cabextract
+        self.__cab_needs_tool = {}
+
+        # Set of filenames that might be needed on disk (lazily
+        # computed)
+        self.__needed_on_disk = None
+
         # Block device from which to rip audio
         self.cd_device = None
 
@@ -246,9 +348,25 @@ class PackagingTask(object):
         # None or an existing directory in which to save downloaded files.
         self.save_downloads = None
 
+        # None or the directory to which packages will be written.
+        # If possible, the workdir is created on the same filesystem as
+        # this or save_downloads, so that files can be linked into
+        # DESTDIR rather than copied.
+        self.destination = None
+
+        # Bytes put into DESTDIR by hard-linking or reflinking, and
+        # by copying.
+        self.bytes_linked = 0
+        self.bytes_copied = 0
+
         # Factory for a progress report (or None).
         self.progress_factory = lambda info=None: None
 
+        # Map from absolute path to (size, mtime in ns, HashedFile) for
+        # files already hashed. Tasks for several games can share one
+        # of these, so that batch mode hashes each file only once.
+        self.hash_cache = {}
+
         self.game.load_file_data()
 
     def __del__(self):
@@ -281,13 +399,70 @@ class PackagingTask(object):
 
     def get_workdir(self):
         if self.__workdir is None:
-            self.__workdir = tempfile.mkdtemp(prefix='gdptmp.')
+            parent = self.__choose_workdir_parent()
+            if parent is None:
+                self.__workdir = tempfile.mkdtemp(prefix='gdptmp.')
+            else:
+                self.__workdir = tempfile.mkdtemp(prefix='.gdptmp.',
+                        dir=parent)
             self._cleanup_dirs.add(self.__workdir)
         return self.__workdir
 
-    def use_file(self, found, candidates, path, hashes=None):
+    def __choose_workdir_parent(self):
+        """Return a directory on the same filesystem as the destination
+        or the saved downloads, or None to use the default temporary
+        directory.
+
+        Extracted files and DESTDIR live in the workdir, so keeping it
+        on the same filesystem as the files we find or write lets
+        fill_dest_dir link them instead of copying them.
+        """
+        try:
+            default_dev = os.stat(tempfile.gettempdir()).st_dev
+        except OSError:
+            default_dev = None
+
+        # a rough upper bound: every file that might be installed
+        need = 0
+        for package in self.game.packages.values():
+            for wanted in package.install_files:
+                need += wanted.size or 0
+
+        for candidate in (self.destination, self.save_downloads):
+            if candidate is None:
+                continue
+
+            try:
+                dev = os.stat(candidate).st_dev
+                statvfs = os.statvfs(candidate)
+            except OSError:
+                continue
+
+            if dev == default_dev:
+                # nothing to gain
+                return None
+
+            if not os.access(candidate, os.W_OK | os.X_OK):
+                continue
+
+            free = statvfs.f_bavail * statvfs.f_frsize
+
+            if free < need:
+                logger.debug('not using %s for temporary files: only %s '
+                        'free, might need %s', candidate, human_size(free),
+                        human_size(need))
+                continue
+
+            logger.debug('using %s for temporary files', candidate)
+            return candidate
+
+        return None
+
+    def use_file(self, found, candidates, path, hashes=None, size=None):
         logger.debug('found %s at %s', found, path)
-        size = os.stat(path).st_size
+
+        if size is None:
+            size = os.stat(path).st_size
 
         assert candidates
 
@@ -309,9 +484,7 @@ class PackagingTask(object):
             self._log_not_any_of(path, size, hashes, found, candidates)
             return False
 
-        if hashes is None:
-            hashes = HashedFile.from_file(path, open(path, 'rb'), size=size,
-                    progress=self.progress_factory(info='checking %s' % path))
+        hashes = self.__ensure_hashes(hashes, path, size)
 
         for wanted in remaining:
             if not wanted.skip_hash_matching and not hashes.matches(wanted):
@@ -325,19 +498,23 @@ class PackagingTask(object):
                 return True
 
             logger.debug('... matches %s', wanted.name)
-            self.found[wanted.name] = path
-            self.file_status[wanted.name] = FillResult.COMPLETE
 
-            # opportunistically use this same file to provide anything else that
-            # has the same hashes (a duplicate file with a different name)
-            for other_name in (self.game.known_md5s.get(hashes.md5, set()) |
-                    self.game.known_sha1s.get(hashes.sha1, set()) |
-                    self.game.known_sha256s.get(hashes.sha256, set())):
-                other = self.game.files[other_name]
-                if other is not wanted and other.matches(hashes):
-                    logger.debug('... also matches %s', other_name)
-                    self.found[other_name] = path
-                    self.file_status[other_name] = FillResult.COMPLETE
+            with self.__state_lock:
+                self.found[wanted.name] = path
+                self.file_status[wanted.name] = FillResult.COMPLETE
+
+                # opportunistically use this same file to provide anything
+                # else that has the same hashes (a duplicate file with a
+                # different name)
+                for other_name in (
+                        self.game.known_md5s.get(hashes.md5, set()) |
+                        self.game.known_sha1s.get(hashes.sha1, set()) |
+                        self.game.known_sha256s.get(hashes.sha256, set())):
+                    other = self.game.files[other_name]
+                    if other is not wanted and other.matches(hashes):
+                        logger.debug('... also matches %s', other_name)
+                        self.found[other_name] = path
+                        self.file_status[other_name] = FillResult.COMPLETE
 
             # no point in continuing, we've identified everything that matches
             # the hashes
@@ -525,6 +702,140 @@ class PackagingTask(object):
                 logger.error('%s should have provided %s but did not',
                         self.found[provider.name], missing)
 
+    def consider_extracted(self, path, provider):
+        """Identify files that an external tool extracted from provider
+        into the directory path.
+
+        Unlike consider_file_or_dir(), only files whose name and size
+        could match one of provider's provides_files are hashed.
+        Everything else is deleted without being read, to keep the
+        amount of temporary disk space down.
+        """
+        remaining = [f for f in provider.provides_files
+                if f.name not in self.found]
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            for fn in filenames:
+                file_path = os.path.join(dirpath, fn)
+
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    # dangling symlink
+                    continue
+
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+
+                size = st.st_size
+                match_path = '/' + os.path.relpath(file_path, path).lower()
+                candidates = [f for f in remaining
+                        if f.size in (None, size)
+                        and any(match_path.endswith('/' + look_for)
+                            for look_for in f.look_for)]
+
+                if candidates:
+                    found = 'possible "%s"' % match_path[1:]
+                else:
+                    # the tool might have changed the name, for instance
+                    # by discarding directories
+                    candidates = [f for f in remaining if f.size == size]
+                    found = 'file of size %d' % size
+
+                if (candidates and
+                        self.use_file(found, candidates, file_path,
+                            size=size)):
+                    remaining = [f for f in remaining
+                            if f.name not in self.found]
+                else:
+                    logger.debug('discarding %s', file_path)
+                    os.remove(file_path)
+
+        for missing in sorted(f.name for f in remaining):
+            if missing not in self.found:
+                logger.error('%s should have provided %s but did not',
+                        self.found[provider.name], missing)
+
+    def plan(self, packages, download=False):
+        """Return a Plan for obtaining the files for packages, without
+        actually doing anything.
+        """
+        # avoid import loop
+        from .plan import (Planner)
+        return Planner(self, download=download).plan(packages)
+
+    def execute_plan(self, plan):
+        """Carry out as much of plan as possible, with independent
+        steps in parallel. Anything that fails is left for fill_gaps()
+        to try again and report.
+        """
+        from .plan import (Executor)
+        return Executor(self, {
+                'cpu': EXTRACTION_THREADS,
+                'io': 1,
+                'network': DOWNLOAD_THREADS,
+            }).run(plan)
+
+    def estimate_resources(self, plan, packages):
+        """Return a ResourceEstimate for carrying out plan and then
+        building packages.
+        """
+        from .plan import (ResourceEstimate)
+        estimate = ResourceEstimate()
+        estimate.download_bytes = plan.download_bytes
+        # everything we download or extract gets hashed
+        estimate.hash_bytes = plan.write_bytes
+        estimate.tool_invocations = plan.tool_invocations
+
+        if self.__workdir is not None:
+            workdir = self.__workdir
+        else:
+            workdir = (self.__choose_workdir_parent() or
+                    tempfile.gettempdir())
+
+        # Files we extract stay in the workdir until the end, and are
+        # linked into each package's DESTDIR; the user's own files have
+        # to be copied there (unless the filesystem can make reflinks).
+        copied = 0
+        built = 0
+
+        for package in packages:
+            if plan.missing.get(package.name):
+                # we won't be building it
+                continue
+
+            built += self.game.size(package)[1]
+
+            for wanted in (package.install_files | package.optional_files):
+                for name in (wanted.alternatives or [wanted.name]):
+                    if name in self.found:
+                        copied += self.game.files[name].size or 0
+                        break
+
+        estimate.add_space('extracted files',
+                workdir, plan.write_bytes - plan.download_bytes)
+        estimate.add_space('copies of existing files', workdir, copied)
+        estimate.add_space('downloads', self.save_downloads or workdir,
+                plan.download_bytes)
+        estimate.add_space('built packages', self.destination or workdir,
+                built)
+        return estimate
+
+    def check_space(self, estimate):
+        """Warn about any filesystem that does not seem to have enough
+        free space for estimate. Return True if they all do.
+        """
+        ok = True
+
+        for labels, paths, needed, free in estimate.filesystems():
+            if needed > free:
+                logger.warning('%s might need %s for %s, but only %s is '
+                        'free', ', '.join(paths), human_size(needed),
+                        ', '.join(labels), human_size(free))
+                ok = False
+
+        return ok
+
     def fill_gaps(self, package, download=False, log=True, recheck=False):
         """Return a FillResult.
         """
@@ -581,75 +892,417 @@ class PackagingTask(object):
             should_provide = set(try_to_unpack)
             distinctive_dirs = provider.unpack.get('distinctive_dirs', True)
 
-        for entry in unpacker:
-            if not entry.is_extractable or not entry.is_regular_file:
-                continue
+        # If the unpacker can seek, we can defer extraction until we
+        # have seen the whole archive, and then extract in parallel.
+        # Otherwise entries have to be extracted as we go past them.
+        if unpacker.seekable() and self.extraction_threads > 1:
+            # [(entry, wanted)] in archive order
+            deferred = []
+        else:
+            deferred = None
+
+        # Some unpackers (cabextract) are much faster if they are told
+        # about everything we are going to open up-front
+        if unpacker.wants_prefetch:
+            prefetch = []
+
+            for entry in unpacker:
+                for wanted in self.__match_entry(name, entry, try_to_unpack,
+                        distinctive_dirs, log=False):
+                    if (wanted.name not in self.found and
+                            not self._can_unpack_in_memory(wanted, entry)):
+                        prefetch.append(entry)
+                        break
+
+            unpacker.prefetch(prefetch)
 
-            for filename in try_to_unpack:
-                wanted = self.game.files.get(filename)
+        for entry in unpacker:
+            for wanted in self.__match_entry(name, entry, try_to_unpack,
+                    distinctive_dirs):
+                should_provide.discard(wanted.name)
 
-                if wanted is None:
+                if wanted.name in self.found:
                     continue
 
-                if wanted.alternatives:
+                if self._can_unpack_in_memory(wanted, entry):
+                    self._consider_nested_archive(name, unpacker, entry,
+                            wanted)
                     continue
 
-                if wanted.size not in (None, entry.size):
+                if deferred is not None:
+                    deferred.append((entry, wanted))
                     continue
 
-                match_path = '/' + entry.name.lower()
+                tmp, hf = self._extract_member(name, unpacker, entry,
+                        wanted, provider)
 
-                for lf in wanted.look_for:
-                    if not distinctive_dirs:
-                        lf = os.path.basename(lf)
+                if not self.use_file(wanted.name, (wanted,), tmp, hf):
+                    os.remove(tmp)
 
-                    if match_path.endswith('/' + lf):
-                        # use this one
-                        break
-                else:
+        if deferred:
+            self._extract_members_in_parallel(name, unpacker, deferred,
+                    provider)
+
+        if should_provide:
+            for missing in sorted(should_provide):
+                logger.error('%s should have provided %s but did not',
+                        name, missing)
+
+    def __match_entry(self, name, entry, try_to_unpack, distinctive_dirs,
+            log=True):
+        """Yield each of the files in try_to_unpack that entry, from
+        the archive name, might be.
+        """
+        if not entry.is_extractable or not entry.is_regular_file:
+            return
+
+        # Some archive formats (zip) record the size and CRC32 of each
+        # member, which is enough to reject a member that can't be
+        # what we want, or to recognise one that has been renamed,
+        # without decompressing it. Anything we do extract is still
+        # checked against the stronger hashes by use_file().
+        entry_crc32 = entry.crc32
+
+        if entry_crc32 is None:
+            same_crc32 = ()
+        else:
+            same_crc32 = self.game.known_crc32s.get(entry_crc32, ())
+
+        for filename in try_to_unpack:
+            wanted = self.game.files.get(filename)
+
+            if wanted is None:
+                continue
+
+            if wanted.alternatives:
+                continue
+
+            if wanted.size not in (None, entry.size):
+                continue
+
+            if (entry_crc32 is not None and
+                    wanted.crc32 not in (None, entry_crc32)):
+                if log:
+                    logger.debug('%s in %s has the wrong CRC32 to be %s',
+                            entry.name, name, filename)
+                continue
+
+            match_path = '/' + entry.name.lower()
+
+            for lf in wanted.look_for:
+                if not distinctive_dirs:
+                    lf = os.path.basename(lf)
+
+                if match_path.endswith('/' + lf):
+                    # use this one
+                    break
+            else:
+                if wanted.size is None or filename not in same_crc32:
                     # proceed to next entry
                     continue
 
-                should_provide.discard(filename)
+                if log:
+                    logger.debug('%s in %s has the right size and CRC32 '
+                            'to be %s', entry.name, name, filename)
 
-                if filename in self.found:
-                    continue
+            yield wanted
 
-                entryfile = unpacker.open(entry)
+    def _extract_member(self, name, unpacker, entry, wanted, provider,
+            progress=True):
+        """Extract entry from unpacker (which came from the file name)
+        as a candidate for wanted, hashing it on the way.
 
-                tmp = os.path.join(self.get_workdir(),
-                        'tmp', wanted.name)
-                tmpdir = os.path.dirname(tmp)
-                mkdir_p(tmpdir)
+        Return the path to the extracted file and its HashedFile.
+        """
+        tmp = os.path.join(self.get_workdir(), 'tmp', wanted.name)
+        mkdir_p(os.path.dirname(tmp))
 
-                wf = open(tmp, 'wb')
+        if progress:
+            progress = self.progress_factory(
+                    info='extracting %s from %s' % (entry.name, name))
+        else:
+            progress = None
+
+        with unpacker.open(entry) as entryfile, open(tmp, 'wb') as wf:
+            hf = HashedFile.from_file(
+                    name + '//' + entry.name, entryfile, wf,
+                    size=entry.size,
+                    progress=progress,
+                    )
+
+        if entry.mtime is not None:
+            orig_time = entry.mtime
+        elif provider is not None and provider.name in self.found:
+            orig_name = self.found[provider.name]
+            orig_time = os.stat(orig_name).st_mtime
+        else:
+            orig_time = None
+
+        if orig_time is not None:
+            os.utime(tmp, (orig_time, orig_time))
+
+        return tmp, hf
+
+    def _can_unpack_in_memory(self, wanted, entry):
+        """Return True if wanted is an archive that we only need for
+        its contents, and entry is small enough that we can unpack it
+        from memory instead of extracting it to the workdir.
+        """
+        if not wanted.provides_files or not wanted.unpack:
+            return False
+
+        if wanted.unpack['format'] not in NESTED_ARCHIVE_FORMATS:
+            return False
+
+        if 'other_parts' in wanted.unpack:
+            return False
+
+        if entry.size is None or entry.size > self.nested_archive_limit:
+            return False
+
+        if wanted.name in self.unpack_tried:
+            return False
+
+        if self.__needed_on_disk is None:
+            needed = set()
+
+            for package in self.game.packages.values():
+                for f in (package.install_files | package.optional_files):
+                    needed.add(f.name)
+                    needed.update(f.alternatives)
+
+            for f in self.game.files.values():
+                if f.unpack:
+                    needed.update(f.unpack.get('other_parts', ()))
+
+            self.__needed_on_disk = needed
 
-                hf = HashedFile.from_file(
-                        name + '//' + entry.name, entryfile, wf,
+        return wanted.name not in self.__needed_on_disk
+
+    def _consider_nested_archive(self, name, unpacker, entry, wanted):
+        """Hash entry from unpacker (which came from the file name)
+        into memory as a candidate for wanted, which is an archive, and
+        if it matches, unpack the files it provides from there.
+        """
+        path = name + '//' + entry.name
+        tmpdir = os.path.join(self.get_workdir(), 'tmp')
+        mkdir_p(tmpdir)
+
+        # entry is no larger than this, so it will stay in memory, but
+        # spill to disk rather than failing if entry.size was wrong
+        spool = tempfile.SpooledTemporaryFile(
+                max_size=self.nested_archive_limit, dir=tmpdir)
+
+        with spool:
+            with unpacker.open(entry) as entryfile:
+                hf = HashedFile.from_file(path, entryfile, spool,
                         size=entry.size,
                         progress=self.progress_factory(
-                            info='extracting %s from %s' % (entry.name, name)),
-                        )
-                wf.close()
+                            info='extracting %s from %s' % (entry.name,
+                                name)))
 
-                if entry.mtime is not None:
-                    orig_time = entry.mtime
-                elif provider is not None:
-                    orig_name = self.found[provider.name]
-                    orig_time = os.stat(orig_name).st_mtime
-                else:
-                    orig_time = None
+            if not wanted.skip_hash_matching and not hf.matches(wanted):
+                logger.debug('... not the right hashes to be %s',
+                        wanted.name)
+                return
 
-                if orig_time is not None:
-                    os.utime(tmp, (orig_time, orig_time))
+            if wanted.unsuitable:
+                logger.warning('"%s" matches known file "%s" but cannot '
+                        'be used:\n%s', path, wanted.name, wanted.unsuitable)
+                return
 
-                if not self.use_file(wanted.name, (wanted,), tmp, hf):
-                    os.remove(tmp)
+            logger.debug('found %s at %s, unpacking it from memory',
+                    wanted.name, path)
 
-        if should_provide:
-            for missing in sorted(should_provide):
-                logger.error('%s should have provided %s but did not',
-                        name, missing)
+            with self.__state_lock:
+                self.unpack_tried.add(wanted.name)
+                self.unpacked_in_memory.add(wanted.name)
+                self.file_status[wanted.name] = FillResult.COMPLETE
+
+            spool.seek(0)
+            fmt = wanted.unpack['format']
+
+            if fmt == 'lha':
+                with Lha(spool) as inner:
+                    self.consider_stream(path, inner, wanted)
+            elif fmt == 'zip':
+                with ZipUnpacker(spool) as inner:
+                    self.consider_stream(path, inner, wanted)
+            else:
+                with TarUnpacker(path, spool, compression=fmt[4:],
+                        skip=wanted.unpack.get('skip', 0)) as inner:
+                    self.consider_stream(path, inner, wanted)
+
+    def __might_provide(self, provider, path, size):
+        """Return True if a member of provider with the given path and
+        size might be one of the files that it provides that we have not
+        found yet. Only the basename is compared, so this errs on the
+        side of saying yes.
+        """
+        basename = os.path.basename(path.replace('\\', '/')).lower()
+
+        for wanted in provider.provides_files:
+            if wanted.name in self.found:
+                continue
+
+            if wanted.size not in (None, size):
+                continue
+
+            for lf in wanted.look_for:
+                if os.path.basename(lf) == basename:
+                    return True
+
+        return False
+
+    def __iter_unshield_groups(self, provider, found_name):
+        """Yield the groups of an InstallShield cabinet that contain
+        files that provider provides, or None to extract everything.
+        """
+        groups = provider.unpack.get('groups') or [None]
+
+        for group in groups:
+            if group is None:
+                group_args = []
+            else:
+                group_args = ['-g', group]
+
+            try:
+                listing = check_output(['unshield'] + group_args +
+                        ['l', os.path.abspath(found_name)])
+            except subprocess.CalledProcessError:
+                # just extract it and see
+                yield group
+                continue
+
+            for line in listing.decode('utf-8', 'replace').splitlines():
+                match = UNSHIELD_LIST_LINE.match(line)
+
+                if match and self.__might_provide(provider, match.group(2),
+                        int(match.group(1))):
+                    yield group
+                    break
+            else:
+                logger.debug('nothing wanted in group %r of %s', group,
+                        found_name)
+
+    def __find_cab_part(self, name, near):
+        """Return the path to the cabinet name, which continues or is
+        continued by the cabinet near, or None.
+        """
+        path = find_sibling(name, near)
+
+        if path is not None:
+            return path
+
+        # it might have been extracted to the workdir under another name
+        name = name.replace('\\', '/').split('/')[-1].lower()
+
+        for filename, path in sorted(self.found.items()):
+            wanted = self.game.files.get(filename)
+
+            if wanted is None or not wanted.unpack:
+                continue
+
+            if wanted.unpack.get('format') != 'cabextract':
+                continue
+
+            if name in set([filename.split('?')[0].lower()] +
+                    [os.path.basename(lf) for lf in wanted.look_for]):
+                return path
+
+        return None
+
+    def __can_unpack_cab(self, provider, cab):
+        """Return True if we can decompress the folders in cab, either
+        natively or with cabextract.
+        """
+        if not cab.needs_cabextract or which('cabextract') is not None:
+            return True
+
+        logger.warning('cannot unpack "%s": tool "cabextract" is not '
+                'installed', provider.name)
+        self.missing_tools.add('cabextract')
+        return False
+
+    def _extract_members_in_parallel(self, name, unpacker, deferred,
+            provider):
+        """Extract and hash the (entry, wanted) pairs in deferred, from a
+        seekable unpacker, then pass them to use_file() in archive order.
+
+        Decompression and hashing release the GIL, so each worker thread
+        gets its own independent unpacker from unpacker.reopen().
+        """
+        # Extract only the first candidate for each wanted file up-front:
+        # further candidates are only needed if that one turns out to be
+        # the wrong version, and extracting them at the same time would
+        # clash over the temporary filename.
+        first = []
+        later = []
+        seen = set()
+
+        for entry, wanted in deferred:
+            if wanted.name in seen:
+                later.append((entry, wanted))
+            else:
+                seen.add(wanted.name)
+                first.append((entry, wanted))
+
+        if len(first) > 1:
+            spare = unpacker.reopen()
+        else:
+            spare = None
+
+        if spare is not None:
+            # make sure this exists before the workers want it
+            self.get_workdir()
+
+            # unpackers not currently in use by a worker
+            idle = queue.Queue()
+            idle.put(spare)
+            opened = [spare]
+
+            def extract(job):
+                entry, wanted = job
+
+                try:
+                    worker_unpacker = idle.get_nowait()
+                except queue.Empty:
+                    worker_unpacker = unpacker.reopen()
+                    opened.append(worker_unpacker)
+
+                try:
+                    return self._extract_member(name, worker_unpacker,
+                            entry, wanted, provider, progress=False)
+                finally:
+                    idle.put(worker_unpacker)
+
+            threads = min(self.extraction_threads, len(first))
+            logger.info('extracting %d files from %s using %d threads',
+                    len(first), name, threads)
+
+            try:
+                with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+                    results = list(pool.map(extract, first))
+            finally:
+                for worker_unpacker in opened:
+                    worker_unpacker.__exit__(None, None, None)
+        else:
+            results = [self._extract_member(name, unpacker, entry, wanted,
+                provider) for entry, wanted in first]
+
+        for (entry, wanted), (tmp, hf) in zip(first, results):
+            if not self.use_file(wanted.name, (wanted,), tmp, hf):
+                os.remove(tmp)
+
+        for entry, wanted in later:
+            if wanted.name in self.found:
+                continue
+
+            tmp, hf = self._extract_member(name, unpacker, entry, wanted,
+                    provider)
+
+            if not self.use_file(wanted.name, (wanted,), tmp, hf):
+                os.remove(tmp)
 
     def cat_files(self, package, provider, wanted):
         other_parts = provider.unpack['other_parts']
@@ -678,6 +1331,462 @@ class PackagingTask(object):
             os.utime(path, (orig_time, orig_time))
             self.use_file(wanted.name, (wanted,), path, hasher)
 
+    def download_file(self, wanted, progress=True):
+        """Try to download wanted from each of its mirrors in turn.
+
+        Return FillResult.COMPLETE if it was downloaded,
+        FillResult.IMPOSSIBLE if there is no room for it, or
+        FillResult.DOWNLOAD_NEEDED if every mirror failed.
+        """
+        logger.debug('trying to download %s...', wanted.name)
+
+        tmpdir = self.save_downloads or os.path.dirname(self.get_workdir())
+        statvfs = os.statvfs(tmpdir)
+        if wanted.size > statvfs.f_frsize * statvfs.f_bavail:
+            logger.error("Out of space on %s, can't download %s.",
+                          tmpdir, wanted.name)
+            self.download_failed |= set(choose_mirror(wanted))
+            return FillResult.IMPOSSIBLE
+
+        urls = choose_mirror(wanted)
+        for url in urls:
+            if url in self.download_failed:
+                logger.debug('... no, it already failed')
+                continue
+
+            logger.debug('... %s', url)
+
+            tmp = None
+            try:
+                rf = urllib.request.urlopen(urllib.request.Request(
+                                 url,headers={'User-Agent': AGENT}))
+                if rf is None:
+                    continue
+
+                try:
+                    size = int(rf.info().get('Content-Length'))
+                except:
+                    size = None
+                if size and size != wanted.size:
+                    logger.warning("File doesn't have expected size"
+                                   " (%s vs %s), skipping %s",
+                                   size, wanted.size, url)
+                    continue
+
+                if self.save_downloads is not None:
+                    tmp = os.path.join(self.save_downloads,
+                            wanted.name)
+                else:
+                    tmp = os.path.join(self.get_workdir(),
+                            'tmp', wanted.name)
+                    mkdir_p(os.path.dirname(tmp))
+
+                wf = open(tmp, 'wb')
+                logger.info('downloading %s', url)
+                hf = HashedFile.from_file(url, rf, wf,
+                        size=wanted.size,
+                        progress=(self.progress_factory() if progress
+                            else None))
+                wf.close()
+
+                if self.use_file(wanted.name, (wanted,), tmp, hf):
+                    assert self.found[wanted.name] == tmp
+                    assert (self.file_status[wanted.name] ==
+                            FillResult.COMPLETE)
+                    return FillResult.COMPLETE
+                else:
+                    # file corrupted or something
+                    os.remove(tmp)
+            except Exception as e:
+                logger.warning('Failed to download "%s": %s', url, e)
+                self.download_failed.add(url)
+                if tmp is not None:
+                    os.remove(tmp)
+
+        return FillResult.DOWNLOAD_NEEDED
+
+    def unpack_provider(self, package, provider, wanted):
+        """Unpack provider, which must already have been found, to get
+        wanted and anything else it provides.
+        """
+        found_name = self.found[provider.name]
+        logger.debug('trying provider %s found at %s',
+                provider.name, found_name)
+        fmt = provider.unpack['format']
+
+        with self.__state_lock:
+            self.unpack_tried.add(provider.name)
+
+        if self.verbose and fmt in ('zip', 'unzip'):
+            with zipfile.ZipFile(found_name, 'r') as zf:
+                encoding = provider.unpack.get('encoding', 'cp437')
+                if zf.comment:
+                    comment = zf.comment.decode(encoding, 'replace')
+                    try:
+                        print(comment)
+                    except UnicodeError:
+                        print(comment.encode('ascii', 'replace').decode('ascii'))
+                if 'FILE_ID.DIZ' in zf.namelist():
+                    id_diz = ''
+                    try:
+                        entryfile = zf.open('FILE_ID.DIZ')
+                        id_diz = entryfile.read().decode(encoding, 'replace')
+                    except NotImplementedError:
+                        if which('unzip'):
+                            id_diz = check_output(['unzip', '-c','-q',
+                                found_name, 'FILE_ID.DIZ']
+                                ).decode(encoding, 'replace')
+                    try:
+                        print(id_diz)
+                    except UnicodeError:
+                        print(id_diz.encode('ascii', 'replace').decode('ascii'))
+
+        to_unpack = provider.unpack.get('unpack')
+
+        if to_unpack is None:
+            to_unpack = []
+
+            for f in provider.provides_files:
+                to_unpack.append(f.name.split('?')[0])
+
+        if fmt == 'dos2unix':
+            tmp = os.path.join(self.get_workdir(),
+                    'tmp', wanted.name)
+            tmpdir = os.path.dirname(tmp)
+            mkdir_p(tmpdir)
+
+            rf = open(found_name, 'rb')
+            contents = rf.read()
+            wf = open(tmp, 'wb')
+            wf.write(contents.replace(b'\r\n', b'\n'))
+
+            orig_time = os.stat(found_name).st_mtime
+            os.utime(tmp, (orig_time, orig_time))
+            self.use_file(wanted.name, (wanted,), tmp, None)
+        elif fmt in ('tar.*', 'tar.gz', 'tar.bz2', 'tar.xz'):
+            reader = open(found_name, 'rb')
+            with TarUnpacker(found_name, reader, compression=fmt[4:],
+                    skip=provider.unpack.get('skip', 0),
+                    use_index=True,
+                    index_key=(provider.sha256 or provider.sha1 or
+                        provider.md5)) as tar:
+                self.consider_stream(found_name, tar, provider)
+        elif fmt == 'deb':
+            with subprocess.Popen(['dpkg-deb', '--fsys-tarfile', found_name],
+                        stdout=subprocess.PIPE) as fsys_process:
+                with TarUnpacker(found_name + '//data.tar.*',
+                        fsys_process.stdout, compression='') as tar:
+                    self.consider_stream(found_name, tar, provider)
+        elif fmt == 'zip':
+            if provider.name.startswith('gog_'):
+                package.used_sources.add(provider.name)
+            with ZipUnpacker(found_name) as unpacker:
+                self.consider_stream(found_name, unpacker, provider)
+        elif fmt == 'lha':
+            with Lha(found_name) as unpacker:
+                self.consider_stream(found_name, unpacker, provider)
+        elif fmt == 'id-shr-extract':
+            logger.debug('Extracting %r from %s',
+                    to_unpack, found_name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                    provider.name + '.d')
+            mkdir_p(tmpdir)
+            check_call(['id-shr-extract', os.path.abspath(found_name)],
+                    cwd=tmpdir)
+            # this format doesn't store a timestamp, so the extracted
+            # files will instead inherit the archive's timestamp
+            recursive_utime(tmpdir, os.stat(found_name).st_mtime)
+            self.consider_extracted(tmpdir, provider)
+        elif fmt == 'cabextract':
+            other_parts = [self.found[p] for p in
+                    provider.unpack.get('other_parts', ())]
+
+            with Cab(found_name, other_parts, find_part=self.__find_cab_part,
+                    tmpdir=os.path.join(self.get_workdir(), 'tmp')) as cab:
+                if self.__can_unpack_cab(provider, cab):
+                    self.consider_stream(found_name, cab, provider)
+        elif fmt == 'unace-nonfree':
+            logger.debug('Extracting %r from %s',
+                    to_unpack, found_name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                    provider.name + '.d')
+            mkdir_p(tmpdir)
+            check_call(['unace', 'x',
+                     os.path.abspath(found_name)] +
+                     list(to_unpack), cwd=tmpdir)
+            self.consider_extracted(tmpdir, provider)
+        elif fmt == 'unrar-nonfree':
+            logger.debug('Extracting %r from %s',
+                    to_unpack, found_name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                    provider.name + '.d')
+            mkdir_p(tmpdir)
+            quiet = [] if self.verbose else ['-inul']
+            check_call(['unrar-nonfree', 'x'] + quiet +
+                     [os.path.abspath(found_name)] +
+                     list(to_unpack), cwd=tmpdir)
+            self.consider_extracted(tmpdir, provider)
+        elif fmt == 'innoextract':
+            if 'unpack' in provider.unpack:
+                to_unpack = provider.unpack['unpack']
+            else:
+                # this will result in extraneous "-I <file>" parameters,
+                # but innoextract doesn't care
+                to_unpack = set()
+                for f in provider.provides_files:
+                    to_unpack.add(f.name.split('?')[0])
+                    for l in f.look_for:
+                        to_unpack.add(l)
+            to_unpack = sorted(to_unpack)
+            logger.debug('Extracting %r from %s', to_unpack, found_name)
+            package.used_sources.add(provider.name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                                  provider.name + '.d')
+            mkdir_p(tmpdir)
+            cmdline = ['innoextract',
+                       '--language', 'english',
+                       '-T', 'local',
+                       '-d', tmpdir,
+                       os.path.abspath(found_name)]
+            if not self.verbose:
+                cmdline.append('--silent')
+                cmdline.append('--progress')
+            version = check_output(['innoextract', '-v', '-s'],
+                    universal_newlines=True)
+            if Version(version.split('-')[0]) >= Version('1.5'):
+                prefix = provider.unpack.get('prefix', '')
+                if prefix and not prefix.endswith('/'):
+                    prefix += '/'
+                if '$provides' in to_unpack:
+                    to_unpack.remove('$provides')
+                    to_unpack += [f.name for f in provider.provides_files]
+                for i in to_unpack:
+                    cmdline.append('-I')
+                    if prefix and i[0] != '/':
+                        i = prefix + i
+                    cmdline.append(i)
+            check_call(cmdline)
+            self.consider_extracted(tmpdir, provider)
+        elif fmt == 'unzip' and which('unzip'):
+            logger.debug('Extracting %r from %s',
+                    to_unpack, found_name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                    provider.name + '.d')
+            mkdir_p(tmpdir)
+            quiet = ['-q'] if self.verbose else ['-qq']
+            check_call(['unzip', '-j', '-C'] +
+                        quiet + [os.path.abspath(found_name)] +
+                    list(to_unpack), cwd=tmpdir)
+            # -j junk paths
+            # -C use case-insensitive matching
+            self.consider_extracted(tmpdir, provider)
+        elif fmt in ('7z', 'unzip'):
+            logger.debug('Extracting %r from %s',
+                    to_unpack, found_name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                    provider.name + '.d')
+            mkdir_p(tmpdir)
+            flags = provider.unpack.get('flags', [])
+            if not self.verbose:
+                flags.append('-bd')
+            check_call(['7z', 'x'] + flags +
+                        [os.path.abspath(found_name)] +
+                        list(to_unpack), cwd=tmpdir)
+            self.consider_extracted(tmpdir, provider)
+        elif fmt in ('unar', 'unzip'):
+            logger.debug('Extracting %r from %s', to_unpack, found_name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                    provider.name + '.d')
+            mkdir_p(tmpdir)
+            quiet = [] if self.verbose else ['-q']
+            check_call(['unar', '-D'] +
+                       quiet + [os.path.abspath(found_name)] +
+                       list(to_unpack), cwd=tmpdir)
+            self.consider_extracted(tmpdir, provider)
+        elif fmt == 'unshield':
+            logger.debug('Extracting %r from %s', to_unpack, found_name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                                  provider.name + '.d')
+            mkdir_p(tmpdir)
+            # we can't specify individual files to extract
+            # but we can narrow down to 'groups', and skip
+            # groups that don't contain anything we want
+            # unshield only take last '-g' into account
+            for group in self.__iter_unshield_groups(provider,
+                    found_name):
+                if group is None:
+                    group_args = []
+                else:
+                    group_args = ['-g', group]
+
+                check_call(['unshield'] + group_args +
+                        ['x', os.path.abspath(found_name)],
+                        cwd=tmpdir)
+
+            # this format doesn't store a timestamp, so the extracted
+            # files will instead inherit the archive's timestamp
+            recursive_utime(tmpdir, os.stat(found_name).st_mtime)
+            self.consider_extracted(tmpdir, provider)
+        elif fmt == 'arj':
+            logger.debug('Extracting %r from %s',
+                         to_unpack, found_name)
+            tmpdir = os.path.join(self.get_workdir(), 'tmp',
+                                  provider.name + '.d')
+            mkdir_p(tmpdir)
+            check_call(['arj', 'e',
+                          os.path.abspath(found_name)] +
+                          list(to_unpack), cwd=tmpdir)
+            for p in provider.unpack.get('other_parts', []):
+                check_call(['arj', 'e', '-jya',
+                          os.path.join(os.path.dirname(found_name),p)] +
+                          list(to_unpack), cwd=tmpdir)
+            self.consider_extracted(tmpdir, provider)
+        elif fmt == 'cat':
+            self.cat_files(package, provider, wanted)
+
+        elif fmt == 'xdelta':
+            # provider (found_name) is the delta
+            # other_parts contains only the base (unpatched) file
+            # wanted is the patched file
+            assert len(provider.unpack['other_parts']) == 1
+            basis = self.game.files[provider.unpack['other_parts'][0]]
+            if basis.name in self.found:
+                out_path = os.path.join(self.get_workdir(), 'tmp',
+                        wanted.name)
+                mkdir_p(os.path.dirname(out_path))
+                check_call(['xdelta', 'patch', found_name,
+                    self.found[basis.name], out_path])
+                orig_time = os.stat(found_name).st_mtime
+                os.utime(out_path, (orig_time, orig_time))
+                self.use_file(wanted.name, (wanted,), out_path)
+
+        elif fmt == 'umod':
+            with Umod(found_name) as unpacker:
+                self.consider_stream(found_name, unpacker, provider)
+
+    def provider_cost(self, provider, package=None, _seen=frozenset()):
+        """Return a rough estimate of how much work it would be to get
+        files out of provider, in units of "bytes read from local disk".
+        """
+        size = provider.size or 0
+
+        if provider.name in self.unpacked_in_memory:
+            # we already got everything we wanted from it
+            return 0
+
+        cost = self.__acquire_cost(provider, _seen)
+
+        for part in (provider.unpack or {}).get('other_parts', ()):
+            cost += self.__acquire_cost(self.game.files[part], _seen)
+
+        fmt = provider.unpack.get('format') if provider.unpack else None
+        cost += size * UNPACK_COST.get(fmt, UNPACK_COST[None])
+
+        if self.runs_tool(provider):
+            cost += TOOL_COST
+
+        if package is not None:
+            # a provider that also gets us other files that this package
+            # is missing is worth more
+            useful = 0
+
+            for f in provider.provides_files:
+                if f.name not in self.found and (f in package.install_files
+                        or f in package.optional_files):
+                    useful += 1
+
+            cost //= max(1, useful)
+
+        return cost
+
+    def __acquire_cost(self, wanted, seen):
+        """Return a rough estimate of how much work it would be to get
+        wanted onto local disk, in the same units as provider_cost().
+        """
+        if wanted.name in self.found:
+            return 0
+
+        size = wanted.size or 0
+        seen = seen | set([wanted.name])
+        costs = []
+
+        if wanted.download:
+            costs.append(size * DOWNLOAD_COST)
+
+        # it might be extracted from something that we already have
+        for outer_name in self.game.providers.get(wanted.name, ()):
+            if outer_name in seen or outer_name in self.unpack_tried:
+                continue
+
+            costs.append(self.provider_cost(self.game.files[outer_name],
+                _seen=seen))
+
+        if costs:
+            return min(costs)
+
+        # we don't know how to get it, so it had better turn up somehow,
+        # which is probably at least as bad as downloading it
+        return size * (DOWNLOAD_COST + 1)
+
+    def runs_tool(self, provider):
+        """Return True if unpacking provider is likely to run an
+        external tool.
+
+        Cabinets only need cabextract for Quantum folders, which we
+        can't tell until we have the cabinet, so assume the worst.
+        """
+        fmt = provider.unpack.get('format') if provider.unpack else None
+
+        if fmt != 'cabextract':
+            return fmt not in BUILTIN_FORMATS
+
+        path = self.found.get(provider.name)
+
+        if path is None:
+            return True
+
+        key = (provider.name, path)
+
+        if key not in self.__cab_needs_tool:
+            other_parts = [self.found[p] for p in
+                    provider.unpack.get('other_parts', ())
+                    if p in self.found]
+
+            try:
+                with Cab(path, other_parts,
+                        find_part=self.__find_cab_part) as cab:
+                    self.__cab_needs_tool[key] = cab.needs_cabextract
+            except (OSError, ValueError):
+                self.__cab_needs_tool[key] = True
+
+        return self.__cab_needs_tool[key]
+
+    def order_providers(self, wanted, package=None):
+        """Return the names of the providers of wanted, cheapest first.
+        """
+        providers = list(self.game.providers.get(wanted.name, ()))
+
+        if len(providers) < 2:
+            return providers
+
+        # This generally prefers something that we have already found,
+        # and otherwise the smallest download: for example this huge
+        # archive is a superset of the smaller one
+        # 103M /var/www/html/ETQW-client-1.4-1.5-update.x86.run
+        # 531M /var/www/html/ETQW-client-1.5-full.x86.run
+        costs = {}
+
+        for provider_name in providers:
+            costs[provider_name] = self.provider_cost(
+                    self.game.files[provider_name], package)
+
+        # sort by name first, so that ties are broken consistently
+        providers = sorted(sorted(providers), key=costs.get)
+        logger.debug('providers for %s, cheapest first: %s', wanted.name,
+                ', '.join('%s (cost %d)' % (p, costs[p])
+                    for p in providers))
+        return providers
+
     def fill_gap(self, package, wanted, download=False, log=True, recheck=False):
         """Try to unpack, download or otherwise obtain wanted.
 
@@ -690,6 +1799,10 @@ class PackagingTask(object):
             assert self.file_status[wanted.name] is FillResult.COMPLETE
             return FillResult.COMPLETE
 
+        if wanted.name in self.unpacked_in_memory:
+            # we already got everything we wanted from it
+            return FillResult.COMPLETE
+
         if self.file_status[wanted.name] is FillResult.IMPOSSIBLE and not recheck:
             return FillResult.IMPOSSIBLE
 
@@ -740,82 +1853,12 @@ class PackagingTask(object):
             self.file_status[wanted.name] = FillResult.DOWNLOAD_NEEDED
 
             if download:
-                logger.debug('trying to download %s...', wanted.name)
-
-                tmpdir = self.save_downloads or os.path.dirname(self.get_workdir())
-                statvfs = os.statvfs(tmpdir)
-                if wanted.size > statvfs.f_frsize * statvfs.f_bavail:
-                    logger.error("Out of space on %s, can't download %s.",
-                                  tmpdir, wanted.name)
-                    self.download_failed |= set(choose_mirror(wanted))
-                    return FillResult.IMPOSSIBLE
-
-                urls = choose_mirror(wanted)
-                for url in urls:
-                    if url in self.download_failed:
-                        logger.debug('... no, it already failed')
-                        continue
+                result = self.download_file(wanted)
 
-                    logger.debug('... %s', url)
+                if result is not FillResult.DOWNLOAD_NEEDED:
+                    return result
 
-                    tmp = None
-                    try:
-                        rf = urllib.request.urlopen(urllib.request.Request(
-                                         url,headers={'User-Agent': AGENT}))
-                        if rf is None:
-                            continue
-
-                        try:
-                            size = int(rf.info().get('Content-Length'))
-                        except:
-                            size = None
-                        if size and size != wanted.size:
-                            logger.warning("File doesn't have expected size"
-                                           " (%s vs %s), skipping %s",
-                                           size, wanted.size, url)
-                            continue
-
-                        if self.save_downloads is not None:
-                            tmp = os.path.join(self.save_downloads,
-                                    wanted.name)
-                        else:
-                            tmp = os.path.join(self.get_workdir(),
-                                    'tmp', wanted.name)
-                            mkdir_p(os.path.dirname(tmp))
-
-                        wf = open(tmp, 'wb')
-                        logger.info('downloading %s', url)
-                        hf = HashedFile.from_file(url, rf, wf,
-                                size=wanted.size,
-                                progress=self.progress_factory())
-                        wf.close()
-
-                        if self.use_file(wanted.name, (wanted,), tmp, hf):
-                            assert self.found[wanted.name] == tmp
-                            assert (self.file_status[wanted.name] ==
-                                    FillResult.COMPLETE)
-                            return FillResult.COMPLETE
-                        else:
-                            # file corrupted or something
-                            os.remove(tmp)
-                    except Exception as e:
-                        logger.warning('Failed to download "%s": %s', url,
-                                e)
-                        self.download_failed.add(url)
-                        if tmp is not None:
-                            os.remove(tmp)
-
-        providers = list(self.game.providers.get(wanted.name, ()))
-
-        # pick smallest possible provider to download
-        # example: this huge archive is a superset of the smaller one
-        # 103M /var/www/html/ETQW-client-1.4-1.5-update.x86.run
-        # 531M /var/www/html/ETQW-client-1.5-full.x86.run
-        if len(providers) > 1:
-            sizes = dict()
-            for provider_name in providers:
-                sizes[provider_name] = self.game.files[provider_name].size or 0
-            providers = sorted(sizes, key=sizes.get)
+        providers = self.order_providers(wanted, package)
 
         for provider_name in providers:
             provider = self.game.files[provider_name]
@@ -842,263 +1885,7 @@ class PackagingTask(object):
                 logger.debug('already tried unpacking provider %s',
                         provider_name)
             elif provider_status is FillResult.COMPLETE:
-                found_name = self.found[provider_name]
-                logger.debug('trying provider %s found at %s',
-                        provider_name, found_name)
-                fmt = provider.unpack['format']
-
-                self.unpack_tried.add(provider_name)
-
-                if self.verbose and fmt in ('zip', 'unzip'):
-                    with zipfile.ZipFile(found_name, 'r') as zf:
-                        encoding = provider.unpack.get('encoding', 'cp437')
-                        if zf.comment:
-                            comment = zf.comment.decode(encoding, 'replace')
-                            try:
-                                print(comment)
-                            except UnicodeError:
-                                print(comment.encode('ascii', 'replace').decode('ascii'))
-                        if 'FILE_ID.DIZ' in zf.namelist():
-                            id_diz = ''
-                            try:
-                                entryfile = zf.open('FILE_ID.DIZ')
-                                id_diz = entryfile.read().decode(encoding, 'replace')
-                            except NotImplementedError:
-                                if which('unzip'):
-                                    id_diz = check_output(['unzip', '-c','-q',
-                                        found_name, 'FILE_ID.DIZ']
-                                        ).decode(encoding, 'replace')
-                            try:
-                                print(id_diz)
-                            except UnicodeError:
-                                print(id_diz.encode('ascii', 'replace').decode('ascii'))
-
-                to_unpack = provider.unpack.get('unpack')
-
-                if to_unpack is None:
-                    to_unpack = []
-
-                    for f in provider.provides_files:
-                        to_unpack.append(f.name.split('?')[0])
-
-                if fmt == 'dos2unix':
-                    tmp = os.path.join(self.get_workdir(),
-                            'tmp', wanted.name)
-                    tmpdir = os.path.dirname(tmp)
-                    mkdir_p(tmpdir)
-
-                    rf = open(found_name, 'rb')
-                    contents = rf.read()
-                    wf = open(tmp, 'wb')
-                    wf.write(contents.replace(b'\r\n', b'\n'))
-
-                    orig_time = os.stat(found_name).st_mtime
-                    os.utime(tmp, (orig_time, orig_time))
-                    self.use_file(wanted.name, (wanted,), tmp, None)
-                elif fmt in ('tar.*', 'tar.gz', 'tar.bz2', 'tar.xz'):
-                    reader = open(found_name, 'rb')
-                    with TarUnpacker(found_name, reader, compression=fmt[4:],
-                            skip=provider.unpack.get('skip', 0)) as tar:
-                        self.consider_stream(found_name, tar, provider)
-                elif fmt == 'deb':
-                    with subprocess.Popen(['dpkg-deb', '--fsys-tarfile', found_name],
-                                stdout=subprocess.PIPE) as fsys_process:
-                        with TarUnpacker(found_name + '//data.tar.*',
-                                fsys_process.stdout, compression='') as tar:
-                            self.consider_stream(found_name, tar, provider)
-                elif fmt == 'zip':
-                    if provider.name.startswith('gog_'):
-                        package.used_sources.add(provider.name)
-                    with ZipUnpacker(found_name) as unpacker:
-                        self.consider_stream(found_name, unpacker, provider)
-                elif fmt == 'lha':
-                    logger.debug('Extracting %r from %s',
-                            to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                            provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    arg = 'x' if self.verbose else 'xq'
-                    check_call(['lha', arg, os.path.abspath(found_name)] +
-                            list(to_unpack),
-                            cwd=tmpdir)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'id-shr-extract':
-                    logger.debug('Extracting %r from %s',
-                            to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                            provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    check_call(['id-shr-extract', os.path.abspath(found_name)],
-                            cwd=tmpdir)
-                    # this format doesn't store a timestamp, so the extracted
-                    # files will instead inherit the archive's timestamp
-                    recursive_utime(tmpdir, os.stat(found_name).st_mtime)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'cabextract':
-                    logger.debug('Extracting %r from %s',
-                            to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                            provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    quiet = [] if self.verbose else ['-q']
-                    check_call(['cabextract'] + quiet + ['-L',
-                            os.path.abspath(found_name)], cwd=tmpdir)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'unace-nonfree':
-                    logger.debug('Extracting %r from %s',
-                            to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                            provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    check_call(['unace', 'x',
-                             os.path.abspath(found_name)] +
-                             list(to_unpack), cwd=tmpdir)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'unrar-nonfree':
-                    logger.debug('Extracting %r from %s',
-                            to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                            provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    quiet = [] if self.verbose else ['-inul']
-                    check_call(['unrar-nonfree', 'x'] + quiet +
-                             [os.path.abspath(found_name)] +
-                             list(to_unpack), cwd=tmpdir)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'innoextract':
-                    if 'unpack' in provider.unpack:
-                        to_unpack = provider.unpack['unpack']
-                    else:
-                        # this will result in extraneous "-I <file>" parameters,
-                        # but innoextract doesn't care
-                        to_unpack = set()
-                        for f in provider.provides_files:
-                            to_unpack.add(f.name.split('?')[0])
-                            for l in f.look_for:
-                                to_unpack.add(l)
-                    to_unpack = sorted(to_unpack)
-                    logger.debug('Extracting %r from %s', to_unpack, found_name)
-                    package.used_sources.add(provider.name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                                          provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    cmdline = ['innoextract',
-                               '--language', 'english',
-                               '-T', 'local',
-                               '-d', tmpdir,
-                               os.path.abspath(found_name)]
-                    if not self.verbose:
-                        cmdline.append('--silent')
-                        cmdline.append('--progress')
-                    version = check_output(['innoextract', '-v', '-s'],
-                            universal_newlines=True)
-                    if Version(version.split('-')[0]) >= Version('1.5'):
-                        prefix = provider.unpack.get('prefix', '')
-                        if prefix and not prefix.endswith('/'):
-                            prefix += '/'
-                        if '$provides' in to_unpack:
-                            to_unpack.remove('$provides')
-                            to_unpack += [f.name for f in provider.provides_files]
-                        for i in to_unpack:
-                            cmdline.append('-I')
-                            if prefix and i[0] != '/':
-                                i = prefix + i
-                            cmdline.append(i)
-                    check_call(cmdline)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'unzip' and which('unzip'):
-                    logger.debug('Extracting %r from %s',
-                            to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                            provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    quiet = ['-q'] if self.verbose else ['-qq']
-                    check_call(['unzip', '-j', '-C'] +
-                                quiet + [os.path.abspath(found_name)] +
-                            list(to_unpack), cwd=tmpdir)
-                    # -j junk paths
-                    # -C use case-insensitive matching
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt in ('7z', 'unzip'):
-                    logger.debug('Extracting %r from %s',
-                            to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                            provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    flags = provider.unpack.get('flags', [])
-                    if not self.verbose:
-                        flags.append('-bd')
-                    check_call(['7z', 'x'] + flags +
-                                [os.path.abspath(found_name)] +
-                                list(to_unpack), cwd=tmpdir)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt in ('unar', 'unzip'):
-                    logger.debug('Extracting %r from %s', to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                            provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    quiet = [] if self.verbose else ['-q']
-                    check_call(['unar', '-D'] +
-                               quiet + [os.path.abspath(found_name)] +
-                               list(to_unpack), cwd=tmpdir)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'unshield':
-                    logger.debug('Extracting %r from %s', to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                                          provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    # we can't specify individual files to extract
-                    # but we can narrow down to 'groups'
-                    groups = provider.unpack.get('groups')
-                    if groups:
-                        # unshield only take last '-g' into account
-                        for group in groups:
-                            check_call(['unshield', '-g', group,
-                               'x', os.path.abspath(found_name)], cwd=tmpdir)
-                    else:
-                        check_call(['unshield', 'x',
-                                 os.path.abspath(found_name)], cwd=tmpdir)
-
-                    # this format doesn't store a timestamp, so the extracted
-                    # files will instead inherit the archive's timestamp
-                    recursive_utime(tmpdir, os.stat(found_name).st_mtime)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'arj':
-                    logger.debug('Extracting %r from %s',
-                                 to_unpack, found_name)
-                    tmpdir = os.path.join(self.get_workdir(), 'tmp',
-                                          provider_name + '.d')
-                    mkdir_p(tmpdir)
-                    check_call(['arj', 'e',
-                                  os.path.abspath(found_name)] +
-                                  list(to_unpack), cwd=tmpdir)
-                    for p in provider.unpack.get('other_parts', []):
-                        check_call(['arj', 'e', '-jya',
-                                  os.path.join(os.path.dirname(found_name),p)] +
-                                  list(to_unpack), cwd=tmpdir)
-                    self.consider_file_or_dir(tmpdir, provider=provider)
-                elif fmt == 'cat':
-                    self.cat_files(package, provider, wanted)
-
-                elif fmt == 'xdelta':
-                    # provider (found_name) is the delta
-                    # other_parts contains only the base (unpatched) file
-                    # wanted is the patched file
-                    assert len(provider.unpack['other_parts']) == 1
-                    basis = self.game.files[provider.unpack['other_parts'][0]]
-                    if basis.name in self.found:
-                        out_path = os.path.join(self.get_workdir(), 'tmp',
-                                wanted.name)
-                        mkdir_p(os.path.dirname(out_path))
-                        check_call(['xdelta', 'patch', found_name,
-                            self.found[basis.name], out_path])
-                        orig_time = os.stat(found_name).st_mtime
-                        os.utime(out_path, (orig_time, orig_time))
-                        self.use_file(wanted.name, (wanted,), out_path)
-
-                elif fmt == 'umod':
-                    with Umod(found_name) as unpacker:
-                        self.consider_stream(found_name, unpacker, provider)
+                self.unpack_provider(package, provider, wanted)
 
                 if wanted.name in self.found:
                     assert (self.file_status[wanted.name] ==
@@ -1289,6 +2076,9 @@ class PackagingTask(object):
         self.__check_component(package)
         self.fill_docs(package, destdir, pkgdocdir)
 
+        # (st_dev, st_ino) of files already hard-linked into this DESTDIR
+        linked = set()
+
         for wanted in (package.install_files | package.optional_files):
             install_as = wanted.install_as
 
@@ -1329,10 +2119,7 @@ class PackagingTask(object):
                 logger.debug('Copying to %s', copy_to)
                 if not os.path.isdir(copy_to_dir):
                     mkdir_p(copy_to_dir)
-                # Use cp(1) so we can make a reflink if source and
-                # destination happen to be the same btrfs volume
-                subprocess.check_call(['cp', '--reflink=auto',
-                    '--preserve=timestamps', copy_from, copy_to])
+                self.__install_file(copy_from, copy_to, linked)
 
                 if wanted.executable:
                     os.chmod(copy_to, 0o755)
@@ -1383,11 +2170,39 @@ class PackagingTask(object):
                 copy_to_dir = os.path.dirname(copy_to)
                 if not os.path.isdir(copy_to_dir):
                     mkdir_p(copy_to_dir)
-                check_call(['cp', '--reflink=auto',
-                    '--preserve=timestamps', copy_from, copy_to])
+                self.__install_file(copy_from, copy_to, linked)
 
         self.fill_extra_files(package, destdir)
 
+    def __install_file(self, copy_from, copy_to, linked):
+        """Put a copy of copy_from at copy_to.
+
+        Files that we extracted or downloaded into the workdir are ours
+        to do with as we like, so they are hard-linked; if the same file
+        is installed twice in a package, or it is one of the user's
+        files, we try to make a reflink and fall back to copying.
+        """
+        stat_res = os.stat(copy_from)
+        key = (stat_res.st_dev, stat_res.st_ino)
+
+        if (self.__workdir is not None and key not in linked and
+                os.path.abspath(copy_from).startswith(
+                    self.__workdir + os.sep)):
+            try:
+                os.link(copy_from, copy_to)
+            except OSError as e:
+                logger.debug('unable to link %s to %s: %s', copy_from,
+                        copy_to, e)
+            else:
+                linked.add(key)
+                self.bytes_linked += stat_res.st_size
+                return
+
+        if clone_file(copy_from, copy_to):
+            self.bytes_linked += stat_res.st_size
+        else:
+            self.bytes_copied += stat_res.st_size
+
     def look_for_engines(self, packages, force=False):
         engines = set()
 
@@ -1546,13 +2361,18 @@ class PackagingTask(object):
 
         self.verbose = getattr(args, 'verbose', False)
 
+        if getattr(args, 'nested_archive_limit', None) is not None:
+            self.nested_archive_limit = args.nested_archive_limit
+
         if self.packaging.__class__ is self.builder_packaging.__class__:
             preserve_debs = (getattr(args, 'destination', None) is not None)
             install_debs = getattr(args, 'install', True)
         else:
             preserve_debs = True
             install_debs = False
-            if args.destination is None:
+            if (args.destination is None and
+                    not getattr(args, 'dry_run', False) and
+                    not getattr(args, 'plan', False)):
                 raise SystemExit('Must specify a destination when '
                         'building packages for a different packaging '
                         'system')
@@ -1563,6 +2383,7 @@ class PackagingTask(object):
             args.compress = preserve_debs
 
         self.save_downloads = args.save_downloads
+        self.destination = args.destination
 
         for package in self.game.packages.values():
             if args.shortname in package.aliases:
@@ -1605,6 +2426,26 @@ class PackagingTask(object):
         except NoPackagesPossible:
             raise SystemExit(1)
 
+        plan = self.plan(packages, download=args.download)
+
+        if getattr(args, 'dry_run', False):
+            print(plan.describe())
+
+        estimate = self.estimate_resources(plan, packages)
+
+        if getattr(args, 'plan', False):
+            print(estimate.describe())
+
+            if not self.check_space(estimate):
+                raise SystemExit(1)
+
+        if getattr(args, 'dry_run', False) or getattr(args, 'plan', False):
+            return
+
+        # this is an overestimate if some of the packages are not going
+        # to be built, so just warn
+        self.check_space(estimate)
+
         try:
             ready = self.prepare_packages(packages,
                     build_demos=args.demo, download=args.download,
@@ -1641,7 +2482,8 @@ class PackagingTask(object):
 
         debs = self.build_packages(ready,
                 compress=getattr(args, 'compress', True),
-                destination=destination)
+                destination=destination,
+                repository=getattr(args, 'repository', False))
 
         rm_rf(os.path.join(self.get_workdir(), 'tmp'))
 
@@ -1736,6 +2578,9 @@ class PackagingTask(object):
                     raise CDRipFailed()
                 self.rip_cd(rip_cd_packages.pop())
 
+        # do everything we can with what we have, in parallel where possible
+        self.execute_plan(self.plan(packages))
+
         for package in packages:
             gog_id = self.game.gog_download_name(package)
             steam_id = package.steam.get('id') or self.game.steam.get('id')
@@ -1913,6 +2758,10 @@ class PackagingTask(object):
         steam_password = None
 
         external_download = possible_with_lgogdownloader | possible_with_steamcmd
+
+        self.execute_plan(self.plan([p for p in possible
+            if p.name not in external_download], download=download))
+
         for package in possible:
             logger.debug('will produce %s', package.name)
             result = self.fill_gaps(package=package, download=download,
@@ -2007,7 +2856,8 @@ class PackagingTask(object):
         logger.debug('packages ready for building: %r', set(p.name for p in ready))
         return ready
 
-    def build_packages(self, ready, destination, compress):
+    def build_packages(self, ready, destination, compress,
+            repository=False):
         packages = set()
 
         for package in ready:
@@ -2026,6 +2876,13 @@ class PackagingTask(object):
             assert pkg is not None
             packages.add(pkg)
 
+        logger.info('%s linked into packages, %s copied',
+                human_size(self.bytes_linked), human_size(self.bytes_copied))
+
+        if repository:
+            packages = self.packaging.update_repository(destination,
+                    packages)
+
         return packages
 
     def locate_steam_icon(self, package):
@@ -2080,36 +2937,30 @@ class PackagingTask(object):
         if packages is None:
             packages = self.game.packages.values()
 
-        suffixes = set(p.steam.get('path') for p in packages)
-        suffixes.add(self.game.steam.get('path'))
-        suffixes.discard(None)
-        if not suffixes:
-            return
+        wanted = set()
 
-        for prefix in (
-                os.path.expanduser('~/.steam'),
-                os.path.join(os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share')),
-                    'wineprefixes/steam/drive_c/Program Files/Steam'),
-                os.path.join(os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share')),
-                    'wineprefixes/steam/drive_c/Program Files (x86)/Steam'),
-                os.path.expanduser('~/Steam'),
-                os.path.expanduser('~/.wine/drive_c/Program Files/Steam'),
-                os.path.expanduser('~/.wine/drive_c/Program Files (x86)/Steam'),
-                os.path.expanduser('~/.PlayOnLinux/wineprefix/Steam/drive_c/Program Files/Steam'),
-                ) + tuple(iter_fat_mounts('Steam')):
-            if not os.path.isdir(prefix):
-                continue
+        for steam in [p.steam for p in packages] + [self.game.steam]:
+            appid = steam.get('id') or self.game.steam.get('id')
+            path = steam.get('path') or self.game.steam.get('path')
 
-            logger.debug('possible Steam root directory at %s', prefix)
+            if appid is not None or path is not None:
+                wanted.add((appid, path))
 
-            for middle in ('steamapps', 'steam/steamapps', 'SteamApps',
-                    'steam/SteamApps'):
-                for suffix in suffixes:
-                    path = os.path.join(prefix, middle, suffix)
-                    if os.path.isdir(path):
-                        logger.debug('possible %s found in Steam at %s',
-                                self.game.shortname, path)
-                        yield os.path.realpath(path)
+        if not wanted:
+            return
+
+        # avoid import loop
+        from .steam import (get_steam_locator)
+        locator = get_steam_locator()
+        seen = set()
+
+        for appid, path in sorted(wanted, key=str):
+            for found in locator.iter_paths(appid, path):
+                if found not in seen:
+                    logger.debug('possible %s found in Steam at %s',
+                            self.game.shortname, found)
+                    seen.add(found)
+                    yield found
 
     def iter_origin_paths(self, packages=None):
         if packages is None:
@@ -2160,8 +3011,7 @@ class PackagingTask(object):
 
         fmt = wanted.unpack['format']
 
-        # builtins
-        if fmt in ('cat', 'dos2unix', 'tar.*', 'tar.gz', 'tar.bz2', 'tar.xz', 'umod', 'zip'):
+        if fmt in BUILTIN_FORMATS:
             return True
 
         if fmt == 'deb':
@@ -2204,5 +3054,12 @@ class PackagingTask(object):
         if hashes is not None:
             return hashes
 
-        return HashedFile.from_file(path, open(path, 'rb'), size=size,
-                progress=self.progress_factory(info='identifying %s' % path))
+        return self.hash_file(path, size)
+
+    def hash_file(self, path, size=None):
+        """Return a HashedFile for the file at path, reusing the result
+        from hash_cache if the file has not changed since it was hashed.
+        """
+        return HashedFile.from_cached_file(path, self.hash_cache, size=size,
+                progress_factory=lambda: self.progress_factory(
+                    info='identifying %s' % path))
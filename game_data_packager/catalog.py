@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+"""An index of every known file in every game, so that files can be
+identified without knowing which game they belong to.
+"""
+
+import json
+import logging
+import os
+import stat
+import zipfile
+
+from . import (load_games)
+from .build import (FillResult)
+from .data import (HashedFile)
+from .paths import (DATADIR, USE_VFS)
+from .util import (ascii_safe)
+
+logger = logging.getLogger(__name__)
+
+# The name of the catalog in vfs.zip or the vfs directory. It must not
+# end with .json, or load_games() would think it was a game.
+CATALOG = 'catalog.index'
+
+# Don't list more missing files than this for each package.
+MAX_MISSING = 5
+
+class Catalog(object):
+    def __init__(self):
+        # { size: set([(game, file name)]) }
+        self.sizes = {}
+        # Files whose size we don't know.
+        # { look_for: set([(game, file name)]) }
+        self.filenames = {}
+        # { hexdigest: set([(game, file name)]) }
+        self.md5s = {}
+        self.sha1s = {}
+        self.sha256s = {}
+
+    @classmethod
+    def from_games(cls, games):
+        self = cls()
+
+        for shortname, game in sorted(games.items()):
+            game.load_file_data()
+
+            for wanted in game.files.values():
+                if (wanted.alternatives or wanted.unsuitable or
+                        wanted.skip_hash_matching):
+                    continue
+
+                if (wanted.md5 is None and wanted.sha1 is None and
+                        wanted.sha256 is None):
+                    # we couldn't recognise it anyway
+                    continue
+
+                if wanted.size == 0:
+                    # an empty file could be anything
+                    continue
+
+                entry = (shortname, wanted.name)
+
+                if wanted.size is None:
+                    for look_for in wanted.look_for:
+                        self.filenames.setdefault(look_for,
+                                set()).add(entry)
+                else:
+                    self.sizes.setdefault(wanted.size, set()).add(entry)
+
+                for index, h in ((self.md5s, wanted.md5),
+                        (self.sha1s, wanted.sha1),
+                        (self.sha256s, wanted.sha256)):
+                    if h is not None:
+                        index.setdefault(h, set()).add(entry)
+
+        return self
+
+    @classmethod
+    def from_data(cls, data):
+        self = cls()
+
+        for size, entries in data['sizes'].items():
+            self.sizes[int(size)] = set(map(tuple, entries))
+
+        for attr in ('filenames', 'md5s', 'sha1s', 'sha256s'):
+            index = getattr(self, attr)
+
+            for k, entries in data[attr].items():
+                index[k] = set(map(tuple, entries))
+
+        return self
+
+    def to_data(self):
+        data = {}
+        data['sizes'] = dict((str(size), sorted(entries))
+                for size, entries in self.sizes.items())
+
+        for attr in ('filenames', 'md5s', 'sha1s', 'sha256s'):
+            data[attr] = dict((k, sorted(entries))
+                    for k, entries in getattr(self, attr).items())
+
+        return data
+
+    def candidates(self, path, size):
+        """Return the (game, file name) pairs that a file could be,
+        judging by its path and size. If this is empty, there is no
+        need to read the file.
+        """
+        ret = set(self.sizes.get(size, ()))
+
+        if self.filenames:
+            parts = path.lower().split('/')
+
+            for i in range(len(parts)):
+                ret |= self.filenames.get('/'.join(parts[i:]), set())
+
+        return ret
+
+    def identify(self, candidates, hashes):
+        """Return the subset of candidates that match hashes."""
+        return candidates & (self.md5s.get(hashes.md5, set()) |
+                self.sha1s.get(hashes.sha1, set()) |
+                self.sha256s.get(hashes.sha256, set()))
+
+def load_catalog(use_vfs=USE_VFS, games=None):
+    """Load the catalog that was compiled into vfs.zip or the vfs
+    directory. If there isn't one (for instance when running from the
+    source tree), build it from games, or from the game data if that
+    is None.
+    """
+    if use_vfs:
+        if isinstance(use_vfs, str):
+            zip = use_vfs
+        else:
+            zip = os.path.join(DATADIR, 'vfs.zip')
+
+        with zipfile.ZipFile(zip, 'r') as zf:
+            if CATALOG in zf.namelist():
+                return Catalog.from_data(json.loads(
+                    zf.open(CATALOG).read().decode('utf-8')))
+    else:
+        vfs = os.path.join(DATADIR, 'vfs')
+
+        if not os.path.isdir(vfs):
+            vfs = DATADIR
+
+        filename = os.path.join(vfs, CATALOG)
+
+        if os.path.isfile(filename):
+            with open(filename, encoding='utf-8') as reader:
+                return Catalog.from_data(json.load(reader))
+
+    logger.debug('no precompiled catalog, building one')
+
+    if games is None:
+        games = load_games(use_vfs=use_vfs)
+
+    return Catalog.from_games(games)
+
+def identify_paths(catalog, paths, progress_factory=None, hash_cache=None):
+    """Walk paths, and return { game: { file name: path } } for every
+    file that was recognised.
+
+    Only files whose size or name appears in the catalog are read,
+    and each file (even if it has several names) is hashed at most once.
+    hash_cache is in the same format as PackagingTask.hash_cache.
+    """
+    found = {}
+
+    if hash_cache is None:
+        hash_cache = {}
+
+    # { (st_dev, st_ino): set([(game, file name)]) }
+    seen = {}
+
+    def consider(path, st):
+        key = (st.st_dev, st.st_ino)
+
+        if key in seen:
+            matches = seen[key]
+        else:
+            candidates = catalog.candidates(path, st.st_size)
+
+            if not candidates:
+                return
+
+            if progress_factory is None:
+                make_progress = None
+            else:
+                make_progress = lambda: progress_factory(
+                        info='identifying %s' % path)
+
+            hashes = HashedFile.from_cached_file(path, hash_cache,
+                    size=st.st_size, st=st, progress_factory=make_progress)
+
+            matches = seen[key] = catalog.identify(candidates, hashes)
+
+        for game, name in matches:
+            found.setdefault(game, {}).setdefault(name, path)
+
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            logger.warning('file "%s" does not exist', path)
+            continue
+
+        if stat.S_ISREG(st.st_mode):
+            consider(path, st)
+        elif stat.S_ISDIR(st.st_mode):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for fn in filenames:
+                    file_path = os.path.join(dirpath, fn)
+
+                    try:
+                        st = os.stat(file_path)
+                    except OSError:
+                        # dangling symlink
+                        continue
+
+                    if stat.S_ISREG(st.st_mode):
+                        consider(file_path, st)
+        else:
+            logger.warning('"%s" is not a file or directory', path)
+
+    return found
+
+def describe_game(game, found):
+    """Return a human-readable description of which packages of game
+    could be built from found, { file name: path }.
+    """
+    lines = ['%s: %s' % (game.shortname, ascii_safe(game.longname))]
+
+    for name, path in sorted(found.items()):
+        lines.append('    %s: %s' % (name, path))
+
+    with game.construct_task() as task:
+        for name, path in found.items():
+            task.found[name] = path
+            task.file_status[name] = FillResult.COMPLETE
+
+        packages = sorted(game.packages.values(), key=lambda p: p.name)
+        plan = task.plan(packages)
+        nothing = 0
+
+        for package in packages:
+            missing = plan.missing[package.name]
+            wanted = set(f.name for f in package.install_files)
+
+            if not missing:
+                lines.append('  [x] %s' % package.name)
+            elif missing != wanted:
+                missing = sorted(missing)
+
+                if len(missing) > MAX_MISSING:
+                    missing[MAX_MISSING:] = ['and %d more' %
+                            (len(missing) - MAX_MISSING)]
+
+                lines.append('  [ ] %s: missing %s' % (package.name,
+                    ', '.join(missing)))
+            else:
+                nothing += 1
+
+        if nothing:
+            lines.append('  (nothing found for %d other packages)' % nothing)
+
+    return '\n'.join(lines)
+
+def run_identify_mode(parsed, games, progress_factory=None, catalog=None,
+        hash_cache=None):
+    if not parsed.paths:
+        logger.error('Please specify some files or directories.')
+        raise SystemExit(2)
+
+    if catalog is None:
+        catalog = load_catalog()
+    found = identify_paths(catalog, parsed.paths, progress_factory,
+            hash_cache)
+
+    if not found:
+        print('no known files found')
+        return
+
+    for shortname in sorted(found):
+        game = games.get(shortname)
+
+        if game is None:
+            game = load_games(game=shortname)[shortname]
+
+        print(describe_game(game, found[shortname]))
+        print()
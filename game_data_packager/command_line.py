@@ -24,13 +24,17 @@ import time
 import zipfile
 
 from . import (load_games)
+from .batch import (run_batch_mode)
+from .catalog import (run_identify_mode)
 from .config import (read_config)
+from .daemon import (run_daemon_client, run_daemon_mode)
 from .data import (ProgressCallback)
 from .gog import (run_gog_meta_mode)
+from .owned import (OwnedGamesCache)
 from .packaging import (get_packaging_system)
 from .paths import (DATADIR)
 from .steam import (run_steam_meta_mode)
-from .util import (human_size)
+from .util import (MEBIBYTE, human_size, which)
 from .version import (FORMAT, DISTRO)
 
 logger = logging.getLogger(__name__)
@@ -79,9 +83,46 @@ class TerminalProgress(ProgressCallback):
     def __exit__(self, et=None, ev=None, tb=None):
         self()
 
-def run_command_line():
+# Modes that are never passed to the daemon, because they can ask the
+# user to log in (or are the daemon)
+INTERACTIVE_MODES = ('daemon', 'gog', 'steam')
+
+def can_use_daemon(args, config):
+    """Return True if the command line args, as parsed by the dumb
+    parser in run_command_line(), can be run by the daemon with the
+    same result as running it here.
+
+    Installing packages needs the user's terminal to gain root, and
+    downloading with steamcmd asks for a password, so those are run
+    here instead.
+    """
+    if args.game in INTERACTIVE_MODES:
+        return False
+
+    if getattr(args, 'install', config['install']):
+        return False
+
+    if getattr(args, 'download', True) and which('steamcmd'):
+        return False
+
+    return True
+
+def run_command_line(games=None, hash_cache=None, catalog=None,
+        progress=None, daemon=False):
+    """Run game-data-packager with the arguments in sys.argv.
+
+    The keyword arguments are used by the daemon to reuse what it has
+    already loaded: games is the result of load_games(), hash_cache
+    is shared by all packaging tasks, catalog is used by identify mode
+    and progress says whether to show progress bars (by default, if
+    stderr is a terminal). If daemon is true, we are running inside the
+    daemon, so we cannot install packages.
+    """
     logger.debug('Arguments: %r', sys.argv)
 
+    if progress is None:
+        progress = sys.stderr.isatty()
+
     # Don't set any defaults on this base parser, because it interferes
     # with the ability to recognise the same argument either before or
     # after the game name. Set them on the Namespace instead.
@@ -127,6 +168,9 @@ def run_command_line():
             help='do not install the generated package (requires -d, default)')
     base_parser.add_argument('-d', '--destination', metavar='OUTDIR',
             help='write the generated .deb(s) to OUTDIR')
+    base_parser.add_argument('--repository', action='store_true',
+            help='treat OUTDIR as a package repository and update its ' +
+                'index to include the generated packages (requires -d)')
 
     group = base_parser.add_mutually_exclusive_group()
     group.add_argument('-z', '--compress', action='store_true',
@@ -143,6 +187,16 @@ def run_command_line():
             dest='download', help='do not download anything')
     base_parser.add_argument('--save-downloads', metavar='DIR',
             help='save downloaded files to DIR, and look for files there')
+    base_parser.add_argument('--refresh-owned', action='store_true',
+            help='ask Steam and GOG.com which games you own, even if ' +
+                'a recent answer was cached')
+    base_parser.add_argument('--dry-run', action='store_true',
+            help='show what would be downloaded and unpacked, and how ' +
+                'much data that involves, but do not do it')
+    base_parser.add_argument('--plan', action='store_true',
+            help='estimate how much disk space, hashing, downloading ' +
+                'and external tools building the packages will need, ' +
+                'then stop')
 
     group = base_parser.add_mutually_exclusive_group()
     group.add_argument('--search', action='store_true', default=True,
@@ -174,9 +228,27 @@ def run_command_line():
     dumb_parser.add_argument('game', type=str, nargs='?')
     dumb_parser.add_argument('paths', type=str, nargs='*')
     dumb_parser.add_argument('-h', '--help', action='store_true', dest='h')
-    g = dumb_parser.parse_args().game
+    dumb_args = dumb_parser.parse_args()
+    g = dumb_args.game
+    config = read_config()
+    socket_path = os.environ.get('GDP_DAEMON_SOCKET')
+
+    if socket_path and games is None:
+        if not can_use_daemon(dumb_args, config):
+            logger.debug('not using the daemon for this command')
+        else:
+            status = run_daemon_client(socket_path, sys.argv[1:])
+
+            if status is not None:
+                sys.exit(status)
+
+            logger.debug('no daemon listening on %s, continuing without it',
+                    socket_path)
+
     zip = os.path.join(DATADIR, 'vfs.zip')
-    if g is None:
+    if games is not None:
+        pass
+    elif g is None:
         games = load_games()
     elif '-h' in sys.argv or '--help' in sys.argv:
         games = load_games()
@@ -225,18 +297,69 @@ def run_command_line():
                        help='package all Steam games')
     group.add_argument('--new', action='store_true', default=False,
                        help='package all new Steam games')
+    steam_parser.add_argument('--jobs', type=int, metavar='N', default=1,
+            help='package up to N games at the same time, but only one ' +
+                'from each disk (default 1)')
+
+    # Batch mode
+    batch_parser = game_parsers.add_parser('batch',
+        help='Package several games at once',
+        description='Package several games at once, looking at each ' +
+            'file only once',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=(base_parser,))
+    batch_parser.add_argument('--all-found', action='store_true',
+            default=False,
+            help='package every game for which files were found')
+    batch_parser.add_argument('--demo', action='store_true', default=False,
+            help='Build demo packages even if files for the full ' +
+                'versions are available')
+    batch_parser.add_argument('games_and_paths', nargs='*',
+            metavar='GAME|DIRECTORY|FILE',
+            help='Games to package, and files to use in constructing ' +
+                'the packages')
+
+    # Identify mode
+    identify_parser = game_parsers.add_parser('identify',
+        help='Identify game files without knowing which game they are from',
+        description='Report which known files of which games are in the ' +
+            'given files and directories, and which packages could be ' +
+            'built from them',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=(base_parser,))
+    identify_parser.add_argument('paths', nargs='*',
+            metavar='DIRECTORY|FILE',
+            help='Files and directories to look in')
+
+    # Daemon mode
+    daemon_parser = game_parsers.add_parser('daemon',
+        help='Keep game data loaded and package games on request',
+        description='Listen on a Unix socket and package games for ' +
+            'game-data-packager commands run with GDP_DAEMON_SOCKET ' +
+            'set to the same socket',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=(base_parser,))
+    daemon_parser.add_argument('--socket', metavar='PATH',
+            help='listen on PATH (default: $GDP_DAEMON_SOCKET, or ' +
+                'game-data-packager.socket in $XDG_RUNTIME_DIR)')
+    daemon_parser.add_argument('--jobs', type=int, metavar='N', default=2,
+            help='run at most N requests at the same time (default 2)')
 
-    config = read_config()
     parsed = argparse.Namespace(
             binary_executables=False,
             compress=None,
             destination=None,
             download=True,
+            dry_run=False,
+            plan=False,
+            refresh_owned=False,
             verbose=False,
             install=False,
             install_method='',
             gain_root_command='',
+            nested_archive_limit=None,
             packages=[],
+            repository=False,
             save_downloads=None,
             shortname=None,
             target_format=FORMAT,
@@ -259,14 +382,32 @@ def run_command_line():
         logger.debug('obeying GAIN_ROOT_COMMAND=%r in configuration',
                 config['gain_root_command'])
         parsed.gain_root_command = config['gain_root_command']
+    if config['nested_archive_limit']:
+        logger.debug('obeying NESTED_ARCHIVE_LIMIT=%r in configuration',
+                config['nested_archive_limit'])
+        parsed.nested_archive_limit = (int(config['nested_archive_limit']) *
+                MEBIBYTE)
 
     parser.parse_args(namespace=parsed)
     logger.debug('parsed command-line arguments into: %r', parsed)
 
-    if parsed.destination is None and not parsed.install:
+    OwnedGamesCache.refresh = parsed.refresh_owned
+
+    if (parsed.destination is None and not parsed.install and
+            not parsed.dry_run and not parsed.plan and
+            parsed.shortname not in ('daemon', 'identify')):
         logger.error('At least one of --install or --destination is required')
         sys.exit(2)
 
+    if parsed.repository and parsed.destination is None:
+        logger.error('--repository requires --destination')
+        sys.exit(2)
+
+    if daemon and parsed.install:
+        logger.error('Packages cannot be installed by the daemon: use ' +
+                '--destination, or unset GDP_DAEMON_SOCKET')
+        sys.exit(2)
+
     if parsed.shortname is None:
         parser.print_help()
         sys.exit(0)
@@ -294,6 +435,23 @@ def run_command_line():
     elif parsed.shortname == 'gog':
         run_gog_meta_mode(parsed, games)
         return
+    elif parsed.shortname == 'identify':
+        run_identify_mode(parsed, games,
+                progress_factory=(TerminalProgress if progress else None),
+                catalog=catalog, hash_cache=hash_cache)
+        return
+    elif parsed.shortname == 'batch':
+        run_batch_mode(parsed, games,
+                progress_factory=(TerminalProgress if progress else None),
+                hash_cache=hash_cache)
+        return
+    elif parsed.shortname == 'daemon':
+        if daemon:
+            logger.error('The daemon cannot start another daemon')
+            sys.exit(2)
+
+        run_daemon_mode(parsed, games)
+        return
     elif parsed.shortname in games:
         game = games[parsed.shortname]
     else:
@@ -308,9 +466,12 @@ def run_command_line():
 
     with game.construct_task(packaging=get_packaging_system(
         parsed.target_format, parsed.target_distro)) as task:
-        if sys.stderr.isatty():
+        if progress:
             task.progress_factory = TerminalProgress
 
+        if hash_cache is not None:
+            task.hash_cache = hash_cache
+
         task.run_command_line(parsed)
 
 if __name__ == '__main__':
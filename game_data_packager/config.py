@@ -35,6 +35,7 @@ def read_config():
             'verbose': False,
             'install_method': '',
             'gain_root_command': '',
+            'nested_archive_limit': '',
             }
 
     try:
@@ -57,6 +58,9 @@ def read_config():
                             config[k] = False
                         elif k in ('install_method', 'gain_root_command'):
                             config[k] = v
+                        elif k == 'nested_archive_limit' and (v.isdigit() or
+                                not v):
+                            config[k] = v
                         else:
                             logger.warning('%s:%d: unknown option value: %s=%r',
                                     CONFIG, lineno, k, v)
@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+"""A long-running process that keeps the game data, the catalog, the
+hash cache and the package database indexes loaded, and runs
+game-data-packager commands on behalf of clients.
+
+The protocol is JSON, one object per line, over a Unix socket.
+The client sends a single request:
+
+    {"argv": ["doom", "-d", "."], "cwd": "/home/me", "isatty": true}
+
+and the daemon replies with any number of
+
+    {"stdout": "text"}
+    {"stderr": "text"}
+
+followed by
+
+    {"exit": 0}
+
+Each request is run in a forked child process, so it starts with
+everything the daemon has loaded, and cannot disturb the daemon or
+other requests.
+"""
+
+import codecs
+import json
+import logging
+import os
+import pickle
+import selectors
+import socket
+import sys
+import tempfile
+import traceback
+
+logger = logging.getLogger(__name__)
+
+def default_socket_path():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+
+    if runtime:
+        return os.path.join(runtime, 'game-data-packager.socket')
+
+    return os.path.join(tempfile.gettempdir(),
+            'game-data-packager-%d.socket' % os.getuid())
+
+def send(writer, **message):
+    writer.write(json.dumps(message, sort_keys=True).encode('utf-8'))
+    writer.write(b'\n')
+    writer.flush()
+
+def run_daemon_client(path, argv):
+    """Ask the daemon listening on path to run game-data-packager
+    with arguments argv, copying its output to ours.
+
+    Return its exit status, or None if there is no daemon listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rwb') as stream:
+        send(stream, argv=argv, cwd=os.getcwd(), isatty=sys.stderr.isatty())
+
+        for line in stream:
+            message = json.loads(line.decode('utf-8'))
+
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+                sys.stdout.flush()
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+
+    logger.error('game-data-packager daemon on %s went away', path)
+    return 1
+
+class Daemon(object):
+    def __init__(self, games, jobs=2):
+        self.games = games
+        self.jobs = max(1, jobs)
+        # Shared by every request, and updated with the hashes each
+        # request calculated when it finishes
+        self.hash_cache = {}
+        self.catalog = None
+        # { pid: file to which it will write its new hashes }
+        self.children = {}
+
+    def warm(self):
+        """Load everything that a request might need, so that the
+        child processes inherit it.
+        """
+        # avoid import loop
+        from .catalog import (load_catalog)
+        from .packaging import (get_native_packaging_system)
+
+        for game in self.games.values():
+            game.load_file_data()
+
+        self.catalog = load_catalog(games=self.games)
+        get_native_packaging_system().refresh_package_indexes()
+
+    def serve(self, path):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+        except OSError:
+            # nobody is listening: remove a stale socket, if any
+            sock.close()
+
+            if os.path.exists(path):
+                os.unlink(path)
+        else:
+            sock.close()
+            logger.error('another daemon is already listening on %s', path)
+            raise SystemExit(1)
+
+        old_umask = os.umask(0o077)
+
+        try:
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+        finally:
+            os.umask(old_umask)
+
+        try:
+            server.listen(16)
+            logger.info('listening on %s', path)
+
+            while True:
+                self.reap(block=False)
+
+                while len(self.children) >= self.jobs:
+                    self.reap(block=True)
+
+                conn, _ = server.accept()
+
+                # pick up the hashes from requests that finished while
+                # we were waiting
+                self.reap(block=False)
+                self.collect()
+
+                with conn:
+                    self.start(server, conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.unlink(path)
+
+    def merge_hashes(self, hashes):
+        try:
+            with open(hashes, 'rb') as reader:
+                self.hash_cache.update(pickle.load(reader))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        finally:
+            for path in (hashes, hashes + '.new'):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def reap(self, block):
+        while self.children:
+            pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+
+            if pid == 0:
+                return
+
+            hashes = self.children.pop(pid, None)
+
+            if hashes is not None:
+                self.merge_hashes(hashes)
+
+            if block:
+                return
+
+    def collect(self):
+        """Merge the hashes from requests that have told their client
+        that they have finished, but have not necessarily exited yet.
+        """
+        for pid, hashes in self.children.items():
+            # the hashes are renamed into place when complete
+            if (hashes is not None and os.path.exists(hashes) and
+                    os.path.getsize(hashes) > 0):
+                self.merge_hashes(hashes)
+                self.children[pid] = None
+
+    def start(self, server, conn):
+        # avoid import loop
+        from .packaging import (get_native_packaging_system)
+
+        # pick up packages installed since the last request
+        get_native_packaging_system().refresh_package_indexes()
+
+        fd, hashes = tempfile.mkstemp(prefix='gdp-daemon.', suffix='.hashes')
+        os.close(fd)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+
+        if pid:
+            self.children[pid] = hashes
+            return
+
+        status = 1
+
+        try:
+            server.close()
+            status = self.handle(conn, hashes)
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def handle(self, conn, hashes):
+        """In a child process, run one request and relay its output."""
+        stream = conn.makefile('rwb')
+        request = json.loads(stream.readline().decode('utf-8'))
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+
+        pid = os.fork()
+
+        if pid == 0:
+            status = 1
+
+            try:
+                stream.close()
+                conn.close()
+                os.close(out_r)
+                os.close(err_r)
+                null = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(null, 0)
+                os.dup2(out_w, 1)
+                os.dup2(err_w, 2)
+                status = self.run(request, hashes)
+            finally:
+                os._exit(status)
+
+        os.close(out_w)
+        os.close(err_w)
+
+        selector = selectors.DefaultSelector()
+
+        for fd, name in ((out_r, 'stdout'), (err_r, 'stderr')):
+            selector.register(fd, selectors.EVENT_READ,
+                    (name, codecs.getincrementaldecoder('utf-8')('replace')))
+
+        while selector.get_map():
+            for key, events in selector.select():
+                name, decoder = key.data
+                data = os.read(key.fd, 65536)
+                text = decoder.decode(data, final=not data)
+
+                if text:
+                    send(stream, **{name: text})
+
+                if not data:
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+
+        _, status = os.waitpid(pid, 0)
+
+        if os.WIFSIGNALED(status):
+            status = 128 + os.WTERMSIG(status)
+        else:
+            status = os.WEXITSTATUS(status)
+
+        send(stream, exit=status)
+        stream.close()
+        return 0
+
+    def run(self, request, hashes):
+        """In a grandchild process with stdout and stderr redirected,
+        run game-data-packager.
+        """
+        # avoid import loop
+        from .command_line import (run_command_line)
+
+        known = dict(self.hash_cache)
+        status = 0
+
+        try:
+            os.chdir(request['cwd'])
+            sys.argv = ['game-data-packager'] + list(request['argv'])
+            run_command_line(games=self.games, hash_cache=self.hash_cache,
+                    catalog=self.catalog,
+                    progress=bool(request.get('isatty')), daemon=True)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except:
+            traceback.print_exc()
+            status = 1
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        # the client is not told that we have finished until this is in
+        # place, so the next request can use these hashes
+        with open(hashes + '.new', 'wb') as writer:
+            pickle.dump(dict((k, v) for k, v in self.hash_cache.items()
+                if known.get(k) is not v), writer)
+
+        os.rename(hashes + '.new', hashes)
+        return status
+
+def run_daemon_mode(parsed, games):
+    path = (parsed.socket or os.environ.get('GDP_DAEMON_SOCKET') or
+            default_socket_path())
+
+    daemon = Daemon(games, jobs=parsed.jobs)
+    logger.info('loading game data...')
+    daemon.warm()
+    daemon.serve(path)
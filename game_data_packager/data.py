@@ -18,6 +18,8 @@
 
 import hashlib
 import io
+import os
+import zlib
 
 from .version import (GAME_PACKAGE_VERSION)
 
@@ -45,18 +47,53 @@ class HashedFile:
         self._md5 = None
         self._sha1 = None
         self._sha256 = None
+        self._crc32 = None
         self.skip_hash_matching = False
 
     @classmethod
     def from_file(cls, name, f, write_to=None, size=None, progress=None):
         return cls.from_concatenated_files(name, [f], write_to, size, progress)
 
+    @classmethod
+    def from_cached_file(cls, path, cache, size=None, st=None,
+            progress_factory=None):
+        """Return a HashedFile for the file at path, reusing the one in
+        cache if the file has not changed since it was hashed.
+
+        cache is a dict { absolute path: (size, mtime in ns, HashedFile) },
+        and is updated. st is the result of os.stat(path), if already
+        known. progress_factory is only called if the file has to be
+        hashed, and returns a ProgressCallback.
+        """
+        key = os.path.abspath(path)
+
+        if st is None:
+            st = os.stat(path)
+
+        cached = cache.get(key)
+
+        if (cached is not None and cached[0] == st.st_size and
+                cached[1] == st.st_mtime_ns):
+            return cached[2]
+
+        if progress_factory is None:
+            progress = None
+        else:
+            progress = progress_factory()
+
+        with open(path, 'rb') as reader:
+            hashes = cls.from_file(path, reader, size=size, progress=progress)
+
+        cache[key] = (st.st_size, st.st_mtime_ns, hashes)
+        return hashes
+
     @classmethod
     def from_concatenated_files(cls, name, fs, write_to=None, size=None,
             progress=None):
         md5 = hashlib.new('md5')
         sha1 = hashlib.new('sha1')
         sha256 = hashlib.new('sha256')
+        crc32 = 0
         done = 0
 
         if progress is None:
@@ -78,6 +115,7 @@ class HashedFile:
                     md5.update(blob)
                     sha1.update(blob)
                     sha256.update(blob)
+                    crc32 = zlib.crc32(blob, crc32)
                     if write_to is not None:
                         write_to.write(blob)
 
@@ -85,6 +123,7 @@ class HashedFile:
         self.md5 = md5.hexdigest()
         self.sha1 = sha1.hexdigest()
         self.sha256 = sha256.hexdigest()
+        self.crc32 = '%08x' % crc32
         return self
 
     @property
@@ -165,6 +204,26 @@ class HashedFile:
                     + 'and %s', self.name, self._sha256, value)
         self._sha256 = value
 
+    # The CRC32 is too weak to identify a file on its own, so it does not
+    # take part in matches(), but archive formats like zip record it for
+    # each member, so it can be used to reject a member without
+    # decompressing it.
+    @property
+    def crc32(self):
+        return self._crc32
+    @crc32.setter
+    def crc32(self, value):
+        if not isinstance(value, str):
+            # YAML reads an unquoted CRC32 made of digits as a decimal
+            # or octal integer, and we can't tell which
+            raise ValueError('crc32 of "%s" must be a string of 8 hex '
+                    'digits, not %r (quote it in YAML)' % (self.name, value))
+        value = value.lower()
+        if self._crc32 is not None and value != self._crc32:
+            raise AssertionError('trying to set crc32 of "%s" to both %s '
+                    + 'and %s', self.name, self._crc32, value)
+        self._crc32 = value
+
 class WantedFile(HashedFile):
     def __init__(self, name):
         super(WantedFile, self).__init__(name)
@@ -19,7 +19,9 @@ import json
 import logging
 import os
 import subprocess
+import threading
 
+from .owned import (OwnedGamesCache)
 from .packaging import (get_native_packaging_system)
 from .util import (ascii_safe,
         check_output,
@@ -28,59 +30,226 @@ from .util import (ascii_safe,
 
 logger = logging.getLogger(__name__)
 
+class GogMetadata(object):
+    """An index of the metadata that lgogdownloader keeps in
+    ~/.cache/lgogdownloader, read once per process and read again
+    only if it changes.
+    """
+
+    def __init__(self, root=None):
+        # Defaults to ~/.cache/lgogdownloader, looked up every time
+        self.root = root
+        self.lock = threading.Lock()
+
+        # (path, mtime) of gamedetails.json when it was indexed
+        self.details_stamp = None
+        # { gamename: [installer, ...] }, or None if there is no
+        # readable gamedetails.json
+        self.games = None
+        # { installer basename: gamename }
+        self.installers = {}
+
+        # { directory: mtime } for xml/ and its subdirectories, or None
+        # if xml/ is missing
+        self.xml_stamps = None
+        # { installer basename: [path to .xml, mtime, { attribute: value }] }
+        self.xml = {}
+
+    def get_path(self, *parts):
+        return os.path.join(self.root or
+                os.path.expanduser('~/.cache/lgogdownloader'), *parts)
+
+    def __load_details(self):
+        path = self.get_path('gamedetails.json')
+
+        try:
+            stamp = (path, os.stat(path).st_mtime_ns)
+        except OSError:
+            stamp = None
+
+        if stamp == self.details_stamp and stamp is not None:
+            return
+
+        self.details_stamp = stamp
+        self.games = None
+        self.installers = {}
+
+        if stamp is None:
+            return
+
+        try:
+            with open(path, encoding='utf-8') as reader:
+                data = json.load(reader)
+        except (OSError, ValueError) as e:
+            logger.warning('unable to read %s: %s', path, e)
+            return
+
+        self.games = {}
+
+        for game in data['games']:
+            installers = game.get('installers', [])
+            self.games[game['gamename']] = installers
+
+            for installer in installers:
+                self.installers.setdefault(
+                        os.path.basename(installer['path']), game['gamename'])
+
+    def __xml_changed(self):
+        xml_root = self.get_path('xml')
+
+        if self.xml_stamps is None:
+            return os.path.isdir(xml_root)
+
+        if xml_root not in self.xml_stamps:
+            return True
+
+        for dirpath, mtime in self.xml_stamps.items():
+            try:
+                if os.stat(dirpath).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+
+        return False
+
+    def __load_xml(self):
+        if not self.__xml_changed():
+            return
+
+        xml_root = self.get_path('xml')
+        self.xml_stamps = None
+        self.xml = {}
+
+        if not os.path.isdir(xml_root):
+            return
+
+        self.xml_stamps = {}
+
+        for dirpath, dirnames, filenames in os.walk(xml_root):
+            try:
+                self.xml_stamps[dirpath] = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+
+            for fn in filenames:
+                if fn.endswith('.xml'):
+                    self.xml.setdefault(fn[:-len('.xml')],
+                            [os.path.join(dirpath, fn), None, None])
+
+    @staticmethod
+    def parse_xml(xml_file):
+        """Return the attributes of the first element of an
+        lgogdownloader .xml file, which describes an installer.
+        """
+        attributes = {}
+        xml = open(xml_file, 'r', encoding='utf-8').readline()
+        xml = xml.strip('<>\n')
+        for tag in xml.split(' '):
+            if '=' not in tag:
+                continue
+            k,v = tag.split('=', 2)
+            attributes[k] = v.strip('"')
+        return attributes
+
+    def get_game(self, gamename):
+        """Return the installers for gamename, or None if we don't know
+        about it.
+        """
+        with self.lock:
+            self.__load_details()
+
+            if self.games is None:
+                return None
+
+            return self.games.get(gamename)
+
+    def get_owned_games(self):
+        """Return the owned games' names, or None if we don't know."""
+        with self.lock:
+            self.__load_details()
+
+            if self.games is None:
+                return None
+
+            return list(self.games)
+
+    def get_game_for_installer(self, basename):
+        with self.lock:
+            self.__load_details()
+            return self.installers.get(basename)
+
+    def get_installer_checksum(self, basename):
+        """Return the attributes of the .xml file describing the
+        installer basename, such as md5 and total_size, or None if
+        there is no such file.
+        """
+        with self.lock:
+            self.__load_xml()
+            entry = self.xml.get(basename)
+
+            if entry is None:
+                return None
+
+            path, mtime, attributes = entry
+
+            try:
+                new_mtime = os.stat(path).st_mtime_ns
+                if new_mtime != mtime:
+                    attributes = self.parse_xml(path)
+                    entry[1:] = [new_mtime, attributes]
+            except OSError:
+                return None
+
+            return attributes
+
 class Gog:
     available = None
 
-    def owned_games(self):
-        if self.available is not None:
+    def __init__(self):
+        self.cache = OwnedGamesCache('gog')
+        self.metadata = GogMetadata()
+
+    def owned_games(self, refresh=False):
+        if self.available is not None and not refresh:
             return self.available
 
         self.available = []
-        cache = os.path.expanduser('~/.cache/lgogdownloader/gamedetails.json')
+        cache = self.metadata.get_path('gamedetails.json')
         if not which('lgogdownloader'):
             pass
         elif os.path.isfile(cache):
-            data = json.load(open(cache, encoding='utf-8'))
-            for key in data['games']:
-                self.available.append(key['gamename'])
+            # lgogdownloader --update-cache rewrites it, changing the key
+            self.available = self.cache.get('%s:%d' % (cache,
+                    os.stat(cache).st_mtime_ns),
+                    self.metadata.get_owned_games, refresh=refresh)
         else:
-            try:
-                list = check_output(['lgogdownloader', '--list'],
-                        stdin=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                        universal_newlines=True)
-                self.available = list.splitlines()
-            except subprocess.CalledProcessError:
-                pass
+            def fetch():
+                try:
+                    list = check_output(['lgogdownloader', '--list'],
+                            stdin=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+                except subprocess.CalledProcessError:
+                    return None
+                return list.splitlines()
+
+            self.available = self.cache.get('lgogdownloader --list', fetch,
+                    refresh=refresh)
 
         return self.available
 
     def is_native(self, wanted):
-        cache = os.path.expanduser('~/.cache/lgogdownloader/gamedetails.json')
-        if not os.path.isfile(cache):
+        installers = self.metadata.get_game(wanted)
+        if installers is None:
             return
 
-        data = json.load(open(cache, encoding='utf-8'))
-        for game in data['games']:
-            if game['gamename'] != wanted:
-                continue
-            for installer in game['installers']:
-                if installer['platform'] == 4:
-                    return True
-            return False
+        for installer in installers:
+            if installer['platform'] == 4:
+                return True
+        return False
 
     def get_id_from_archive(self, archive):
-        cache = os.path.expanduser('~/.cache/lgogdownloader/gamedetails.json')
-        if not os.path.isfile(cache):
-            return None
-
-        archive = os.path.basename(archive)
-
-        data = json.load(open(cache, encoding='utf-8'))
-        for game in data['games']:
-            for installer in game['installers']:
-                if installer['path'].endswith(archive):
-                    return game['gamename']
+        return self.metadata.get_game_for_installer(os.path.basename(archive))
 
     def verify_checksum(self, archive, size, md5):
         basename = os.path.basename(archive)
@@ -89,29 +258,16 @@ class Gog:
              or basename.startswith('setup_') and extension == '.exe'):
             return False
 
-        xml_root = os.path.expanduser('~/.cache/lgogdownloader/xml/')
-        if not os.path.isdir(xml_root):
+        attributes = self.metadata.get_installer_checksum(basename)
+        if attributes is None:
             return False
 
-        for dirpath, dirnames, filenames in os.walk(xml_root):
-            for fn in filenames:
-                if fn != basename + '.xml':
-                    continue
-                xml_file = os.path.join(dirpath, fn)
-                xml = open(xml_file, 'r', encoding='utf-8').readline()
-                xml = xml.strip('<>\n')
-                for tag in xml.split(' '):
-                    if '=' not in tag:
-                        continue
-                    k,v = tag.split('=', 2)
-                    v = v.strip('"')
-                    if k == 'md5' and v != md5:
-                        return False
-                    elif k == 'total_size' and int(v) != size:
-                        return False
-                else:
-                    return True
-        return False
+        if 'md5' in attributes and attributes['md5'] != md5:
+            return False
+        if ('total_size' in attributes and
+                int(attributes['total_size']) != size):
+            return False
+        return True
 
 GOG = Gog()
 
@@ -128,8 +284,7 @@ def run_gog_meta_mode(parsed, games):
         subprocess.call(['lgogdownloader', '--login'])
         logger.info("... and now 'lgogdownloader --update-cache'")
         subprocess.call(['lgogdownloader', '--update-cache'])
-        GOG.available = None
-        owned = GOG.owned_games()
+        owned = GOG.owned_games(refresh=True)
     logger.info("Found %d game(s) !" % len(owned))
 
     packaging = get_native_packaging_system()
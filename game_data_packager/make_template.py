@@ -163,6 +163,7 @@ class GameData(object):
         self.md5 = {}
         self.sha1 = {}
         self.sha256 = {}
+        self.crc32 = {}
         self.has_dosbox = False
 
     def is_scummvm(self,path):
@@ -260,6 +261,7 @@ class GameData(object):
         self.md5[out_name] = hf.md5
         self.sha1[out_name] = hf.sha1
         self.sha256[out_name] = hf.sha256
+        self.crc32[out_name] = hf.crc32
 
         unpacker = None
 
@@ -542,6 +544,7 @@ class GameData(object):
                         self.md5[name] = hf.md5
                         self.sha1[name] = hf.sha1
                         self.sha256[name] = hf.sha256
+                        self.crc32[name] = hf.crc32
                     elif entry.isdir():
                         pass
                     elif entry.issym():
@@ -628,6 +631,14 @@ class GameData(object):
             else:
                 print('  %s %s' % (self.sha256[f], f))
 
+        print('\ncrc32sums: |')
+
+        for f in sorted(self.crc32.keys()):
+            if f in self.unwanted.group_members:
+                print('  #%s %s' % (self.crc32[f], f))
+            else:
+                print('  %s %s' % (self.crc32[f], f))
+
         print('\n...')
 
 def do_one_exec(pgm,lower):
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import json
+import logging
+import os
+import time
+
+from .util import (get_cache_dir)
+
+logger = logging.getLogger(__name__)
+
+# How long to believe a list of owned games, in seconds
+OWNED_GAMES_TTL = 24 * 60 * 60
+
+class OwnedGamesCache(object):
+    """The list of games that the user owns in some online store,
+    cached on disk so that we don't have to ask the network (or a
+    slow tool) on every run.
+    """
+
+    # If true, ignore cached lists and fetch them again; set by
+    # --refresh-owned
+    refresh = False
+
+    def __init__(self, name, ttl=OWNED_GAMES_TTL):
+        # Basename of the cache file, e.g. 'steam'
+        self.name = name
+        self.ttl = ttl
+
+    def __load(self):
+        try:
+            path = os.path.join(get_cache_dir('owned'), self.name + '.json')
+
+            with open(path, encoding='utf-8') as reader:
+                return json.load(reader)
+        except (OSError, ValueError):
+            return None
+
+    def __save(self, data):
+        try:
+            path = os.path.join(get_cache_dir('owned'), self.name + '.json')
+
+            with open(path + '.tmp', 'w', encoding='utf-8') as writer:
+                json.dump(data, writer)
+
+            os.rename(path + '.tmp', path)
+        except OSError as e:
+            logger.debug('unable to cache owned %s games: %s', self.name, e)
+
+    def get(self, key, fetch, refresh=False):
+        """Return the list of games for key (for instance an account
+        name), calling fetch() to get it if the cached copy is missing,
+        too old or for a different key.
+
+        fetch() returns a JSON-serializable list, or None if it fails.
+        If it fails, a cached list that is too old is better than
+        nothing. Empty lists are not cached, because they usually mean
+        that the user has not logged in yet.
+        """
+        data = self.__load()
+        now = time.time()
+
+        if (data is None or not isinstance(data, dict) or
+                data.get('key') != key):
+            data = None
+
+        if (data is not None and not refresh and not self.refresh and
+                0 <= now - data.get('time', 0) < self.ttl):
+            logger.debug('using cached list of owned %s games', self.name)
+            return data['games']
+
+        games = fetch()
+
+        if games is None:
+            if data is not None:
+                logger.debug('using outdated list of owned %s games',
+                        self.name)
+                return data['games']
+
+            return []
+
+        if games:
+            self.__save(dict(key=key, time=now, games=games))
+
+        return games
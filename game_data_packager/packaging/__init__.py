@@ -18,14 +18,122 @@
 
 from abc import (ABCMeta, abstractmethod)
 import importlib
+import json
+import logging
 import os
 import string
 
+from ..util import (get_cache_dir)
+
+logger = logging.getLogger(__name__)
+
 class RecursiveExpansionMap(dict):
     def __getitem__(self, k):
         v = super(RecursiveExpansionMap, self).__getitem__(k)
         return string.Template(v).substitute(self)
 
+class PackageIndex(object):
+    """A map from package names to versions (or other JSON-serializable
+    details), populated by a single bulk query of a package database
+    and cached on disk.
+
+    The on-disk cache is considered to be valid for as long as the
+    modification times of all the paths in stamps are unchanged, so
+    those should be files or directories that the packaging system
+    touches whenever it installs, removes or downloads anything.
+    """
+
+    def __init__(self, name, stamps, query):
+        # Basename of the cache file, e.g. 'rpm-installed', or None
+        # to keep the index in memory only
+        self.name = name
+        # Paths whose mtimes determine whether the cache is still valid
+        self.stamps = stamps
+        # Callable returning a dict { package name: version }, or None
+        # if the database could not be queried at all
+        self.query = query
+        self.__versions = None
+        # The stamps at the time __versions was loaded
+        self.__stamp = None
+
+    def __contains__(self, package):
+        return package in self.versions
+
+    def get(self, package, default=None):
+        return self.versions.get(package, default)
+
+    def invalidate(self):
+        """Discard the in-memory copy, for example after installing
+        packages. The next lookup will check the stamps again.
+        """
+        self.__versions = None
+
+    def refresh(self):
+        """Discard the in-memory copy if the packaging system has
+        changed anything since it was loaded, for example in a
+        long-running process.
+        """
+        if self.__versions is not None and self._get_stamp() != self.__stamp:
+            self.invalidate()
+
+    def _get_stamp(self):
+        stamp = []
+        for path in self.stamps:
+            try:
+                stamp.append([path, os.stat(path).st_mtime_ns])
+            except OSError:
+                continue
+        return stamp
+
+    @property
+    def versions(self):
+        if self.__versions is not None:
+            return self.__versions
+
+        stamp = self._get_stamp()
+
+        cache = None
+
+        if self.name is not None:
+            try:
+                cache = os.path.join(get_cache_dir('packages'),
+                        self.name + '.json')
+            except OSError:
+                pass
+
+        if stamp and cache is not None and os.path.isfile(cache):
+            try:
+                with open(cache, encoding='utf-8') as reader:
+                    data = json.load(reader)
+                if data['stamp'] == stamp:
+                    logger.debug('using cached package list %s', cache)
+                    self.__versions = data['versions']
+                    self.__stamp = stamp
+                    return self.__versions
+            except (OSError, ValueError, KeyError):
+                pass
+
+        versions = self.query()
+
+        self.__stamp = stamp
+
+        if versions is None:
+            # the tool is not installed, or failed; don't cache that
+            self.__versions = {}
+            return self.__versions
+
+        self.__versions = versions
+
+        if stamp and cache is not None:
+            try:
+                with open(cache + '.tmp', 'w', encoding='utf-8') as writer:
+                    json.dump(dict(stamp=stamp, versions=versions), writer)
+                os.rename(cache + '.tmp', cache)
+            except OSError as e:
+                logger.debug('unable to cache package list: %s', e)
+
+        return self.__versions
+
 class PackagingSystem(metaclass=ABCMeta):
     ASSETS = '$datadir'
     BINDIR = '$prefix/bin'
@@ -65,6 +173,11 @@ class PackagingSystem(metaclass=ABCMeta):
         # contexts to use when evaluating format- or distro-specific
         # dependencies, in order by preference
         self._contexts = ('generic',)
+        # PackageIndex objects to discard after installing packages
+        self._package_indexes = []
+        # { absolute path of a built package: metadata captured from
+        #   its DESTDIR, in a format specific to the packaging system }
+        self._built = {}
 
     def derives_from(self, context):
         return context in self._contexts
@@ -130,6 +243,26 @@ class PackagingSystem(metaclass=ABCMeta):
         """Install one or more packages (a list of filenames)."""
         raise NotImplementedError
 
+    def _add_package_index(self, name, stamps, query):
+        index = PackageIndex(name, stamps, query)
+        self._package_indexes.append(index)
+        return index
+
+    def invalidate_package_indexes(self):
+        """Forget what we knew about installed and available packages,
+        typically because we have just installed some.
+        """
+        for index in self._package_indexes:
+            index.invalidate()
+
+    def refresh_package_indexes(self):
+        """Make sure that what we know about installed and available
+        packages is up to date, re-reading it if necessary.
+        """
+        for index in self._package_indexes:
+            index.refresh()
+            index.versions
+
     def substitute(self, template, package, **kwargs):
         if isinstance(template, dict):
             for c in self._contexts:
@@ -321,9 +454,27 @@ class PackagingSystem(metaclass=ABCMeta):
         """
         raise NotImplementedError
 
+    def update_repository(self, repository, packages):
+        """Add the given packages (a list of filenames previously
+        returned by build_package) to the package repository in the
+        directory repository, updating its index incrementally.
+        Return the set of filenames of the packages in the repository.
+        """
+        raise NotImplementedError('%s cannot maintain a package repository'
+                % self.__class__.__name__)
+
 def get_packaging_system(format, distro=None):
-    mod = 'game_data_packager.packaging.{}'.format(format)
-    return importlib.import_module(mod).get_packaging_system(distro)
+    # There is one instance per format and distro, so that the task,
+    # the builder and the Steam/GOG meta-modes all share the same
+    # package database indexes.
+    key = (format, distro)
+    if key not in _packaging_systems:
+        mod = 'game_data_packager.packaging.{}'.format(format)
+        _packaging_systems[key] = importlib.import_module(
+                mod).get_packaging_system(distro)
+    return _packaging_systems[key]
+
+_packaging_systems = {}
 
 def get_native_packaging_system():
     # lazy import when actually needed
@@ -16,12 +16,15 @@
 # You can find the GPL license text on a Debian system under
 # /usr/share/common-licenses/GPL-2.
 
+import io
 import logging
 import os
 import subprocess
+import tarfile
 import time
 
 from . import (PackagingSystem)
+from ..data import (HashedFile)
 from ..util import (
         check_output,
         normalize_permissions,
@@ -49,6 +52,10 @@ class ArchPackaging(PackagingSystem):
     def __init__(self):
         super(ArchPackaging, self).__init__()
         self._contexts = ('arch', 'generic')
+        self._installed = self._add_package_index('pacman-installed',
+                ('/var/lib/pacman/local',), self._query_installed)
+        self._available = self._add_package_index('pacman-available',
+                ('/var/lib/pacman/sync',), self._query_available)
 
     def read_architecture(self):
         super(ArchPackaging, self).read_architecture()
@@ -56,49 +63,55 @@ class ArchPackaging(PackagingSystem):
         if self._architecture == 'amd64' and os.path.exists('/usr/lib32/libc.so'):
             self._foreign_architectures = set(['i386'])
 
-    def is_installed(self, package):
+    def _query_installed(self):
         try:
-            return subprocess.call(['pacman', '-Q', package],
-                                    stdout=subprocess.DEVNULL,
-                                    stderr=subprocess.DEVNULL) == 0
-        except FileNotFoundError:
-            return False
+            output = check_output(['pacman', '-Q'],
+                                  stderr=subprocess.DEVNULL,
+                                  universal_newlines=True)
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            return None
 
-    def current_version(self, package):
+        installed = {}
+        for line in output.splitlines():
+            # name version
+            name, version = line.split()[:2]
+            installed[name] = version
+        return installed
+
+    def _query_available(self):
         try:
-            return check_output(['pacman', '-Q', package],
-                                stderr=subprocess.DEVNULL,
-                                universal_newlines=True).split()[1]
-        except FileNotFoundError:
-            return None
-        except subprocess.CalledProcessError:
+            output = check_output(['pacman', '-Sl'],
+                                  stderr=subprocess.DEVNULL,
+                                  universal_newlines=True,
+                                  env={'LANG':'C'})
+        except (FileNotFoundError, subprocess.CalledProcessError):
             return None
 
+        available = {}
+        for line in output.splitlines():
+            # repository name version [installed]
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            # repositories are listed in order of preference
+            available.setdefault(fields[1], fields[2])
+        return available
+
+    def is_installed(self, package):
+        return package in self._installed
+
+    def current_version(self, package):
+        return self._installed.get(package)
+
     def is_available(self, package):
-        try:
-            return subprocess.call(['pacman', '-Si', package],
-                                    stdout=subprocess.DEVNULL,
-                                    stderr=subprocess.DEVNULL) == 0
-        except FileNotFoundError:
-            return False
+        return package in self._available
 
     def available_version(self, package):
-        try:
-            remote_info = check_output(['pacman', '-Si', package],
-                                       universal_newlines=True,
-                                       env={'LANG':'C'})
-            for line in remote_info.splitlines():
-                k, _, v = line.split(maxsplit=2)
-                if k == 'Version':
-                    return v
-
-        except FileNotFoundError:
-            return None
-        except subprocess.CalledProcessError:
-            return None
+        return self._available.get(package)
 
     def install_packages(self, pkgs, method=None, gain_root='su'):
         run_as_root(['pacman', '-U'] + list(pkgs), gain_root)
+        self.invalidate_package_indexes()
 
     def format_relation(self, pr):
         assert not pr.contextual
@@ -122,6 +135,7 @@ class ArchPackaging(PackagingSystem):
         size = int(size.split()[0])
         with open(PKGINFO, 'w',  encoding='utf-8') as pkginfo:
             pkginfo.write('pkgname = %s\n' % package.name)
+            pkginfo.write('pkgbase = %s\n' % package.name)
             pkginfo.write('pkgver = %s-1\n' % package.version)
             pkginfo.write('pkgdesc = %s\n' % short_desc)
             pkginfo.write('url = https://wiki.debian.org/Games/GameDataPackager\n')
@@ -183,8 +197,135 @@ class ArchPackaging(PackagingSystem):
             print(cpe.output)
             raise
 
+        pkginfo = {}
+        with open(os.path.join(destdir, '.PKGINFO'),
+                encoding='utf-8') as reader:
+            for line in reader:
+                k, _, v = line.rstrip('\n').partition(' = ')
+                pkginfo.setdefault(k, []).append(v)
+        self._built[outfile] = pkginfo
+
         rm_rf(destdir)
         return outfile
 
+    # .PKGINFO key => repository database desc key
+    DESC_KEYS = (
+            ('pkgname', 'NAME'),
+            ('pkgbase', 'BASE'),
+            ('pkgver', 'VERSION'),
+            ('pkgdesc', 'DESC'),
+            ('group', 'GROUPS'),
+            ('size', 'ISIZE'),
+            ('url', 'URL'),
+            ('license', 'LICENSE'),
+            ('arch', 'ARCH'),
+            ('builddate', 'BUILDDATE'),
+            ('packager', 'PACKAGER'),
+            ('depend', 'DEPENDS'),
+            )
+    # order in which repo-add writes them
+    DESC_ORDER = ('FILENAME', 'NAME', 'BASE', 'VERSION', 'DESC', 'GROUPS',
+            'CSIZE', 'ISIZE', 'MD5SUM', 'SHA256SUM', 'URL', 'LICENSE',
+            'ARCH', 'BUILDDATE', 'PACKAGER', 'DEPENDS')
+
+    def update_repository(self, repository, packages):
+        """Maintain a repository database named after the repository
+        directory, like repo-add(8) would, so that /srv/games can be used
+        with "[games] Server = file:///srv/games" in pacman.conf.
+
+        Entries for other packages are copied from the existing database
+        without reading their packages again.
+        """
+        repository = os.path.abspath(repository)
+        name = os.path.basename(repository)
+        db = os.path.join(repository, name + '.db.tar.gz')
+
+        # { pkgname: { 'name-version/desc': b'...' } }
+        entries = {}
+
+        if os.path.exists(db):
+            with tarfile.open(db, 'r:*') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    dirname, _, basename = member.name.partition('/')
+                    entry = entries.setdefault(dirname, {})
+                    entry[basename] = tar.extractfile(member).read()
+
+        # key the existing entries by name, dropping those whose
+        # package is no longer there
+        by_name = {}
+        for dirname, entry in entries.items():
+            desc = self.__parse_desc(entry.get('desc', b''))
+            filename = desc.get('FILENAME', [''])[0]
+            if not os.path.exists(os.path.join(repository, filename)):
+                logger.debug('dropping %s from repository database: no '
+                        'longer exists', filename)
+                continue
+            by_name[desc['NAME'][0]] = (dirname, entry)
+
+        for pkg in packages:
+            pkg = os.path.abspath(pkg)
+            pkginfo = self._built[pkg]
+
+            with open(pkg, 'rb') as reader:
+                hf = HashedFile.from_file(pkg, reader)
+
+            desc = dict(
+                    FILENAME=[os.path.relpath(pkg, repository)],
+                    CSIZE=[str(os.path.getsize(pkg))],
+                    MD5SUM=[hf.md5],
+                    SHA256SUM=[hf.sha256],
+                    )
+            for k, v in self.DESC_KEYS:
+                if k in pkginfo:
+                    desc[v] = pkginfo[k]
+
+            text = ''.join('%%%s%%\n%s\n\n' % (k, '\n'.join(desc[k]))
+                    for k in self.DESC_ORDER if k in desc)
+            dirname = '%s-%s' % (pkginfo['pkgname'][0], pkginfo['pkgver'][0])
+            by_name[pkginfo['pkgname'][0]] = (dirname,
+                    {'desc': text.encode('utf-8')})
+
+        now = int(time.time())
+
+        with tarfile.open(db + '.tmp', 'w:gz') as tar:
+            for pkgname in sorted(by_name):
+                dirname, entry = by_name[pkgname]
+                info = tarfile.TarInfo(dirname)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = now
+                tar.addfile(info)
+
+                for basename in sorted(entry):
+                    info = tarfile.TarInfo(dirname + '/' + basename)
+                    info.size = len(entry[basename])
+                    info.mode = 0o644
+                    info.mtime = now
+                    tar.addfile(info, io.BytesIO(entry[basename]))
+
+        os.rename(db + '.tmp', db)
+
+        link = os.path.join(repository, name + '.db')
+        if not os.path.lexists(link):
+            os.symlink(os.path.basename(db), link)
+
+        logger.info('updated %s (%d packages)', db, len(by_name))
+
+        return set(os.path.abspath(pkg) for pkg in packages)
+
+    @staticmethod
+    def __parse_desc(blob):
+        desc = {}
+        key = None
+        for line in blob.decode('utf-8', 'replace').splitlines():
+            if line.startswith('%') and line.endswith('%'):
+                key = line.strip('%')
+                desc[key] = []
+            elif line and key is not None:
+                desc[key].append(line)
+        return desc
+
 def get_packaging_system(distro=None):
     return ArchPackaging()
@@ -16,7 +16,10 @@
 # You can find the GPL license text on a Debian system under
 # /usr/share/common-licenses/GPL-2.
 
+import glob
+import gzip
 import logging
+import lzma
 import os
 import stat
 import subprocess
@@ -48,7 +51,6 @@ class DebPackaging(PackagingSystem):
     INSTALL_CMD = ['apt-get', 'install']
     PACKAGE_MAP = {
                   'id-shr-extract': 'dynamite',
-                  'lha': 'lhasa',
                   '7z': 'p7zip-full',
                   'unrar-nonfree': 'unrar',
                   'zoom': 'zoom-player',
@@ -64,11 +66,27 @@ class DebPackaging(PackagingSystem):
             'libjpeg.so.62': 'libjpeg62-turbo | libjpeg62',
     }
 
-    def __init__(self):
+    def __init__(self, root='/'):
         super(DebPackaging, self).__init__()
-        self.__installed = None
-        self.__available = None
         self._contexts = ('deb', 'generic')
+        # Read the dpkg and apt databases below this directory; only
+        # the default is cached across runs
+        self.root = root
+
+        if root == '/':
+            names = ('dpkg-installed', 'apt-available')
+        else:
+            names = (None, None)
+
+        self._installed = self._add_package_index(names[0],
+                (self.__in_root('var/lib/dpkg/status'),),
+                self._query_installed)
+        self._available = self._add_package_index(names[1],
+                (self.__in_root('var/lib/apt/lists'),),
+                self._query_available)
+
+    def __in_root(self, path):
+        return os.path.join(self.root, path)
 
     def read_architecture(self):
         self._architecture = check_output(['dpkg',
@@ -93,62 +111,87 @@ class DebPackaging(PackagingSystem):
             return (self.is_installed('chocolate-hexen')
                  or self.is_installed('doomsday'))
 
-        if os.path.isdir(os.path.join('/usr/share/doc', package)):
+        if os.path.isdir(self.__in_root(os.path.join('usr/share/doc',
+                package))):
             return True
 
-        if self.__installed is None:
-            try:
-                proc = subprocess.Popen(['dpkg-query', '--show',
-                            '--showformat', '${Package}\\n'],
-                        universal_newlines=True,
-                        stdout=subprocess.PIPE)
-            except FileNotFoundError:
-                return False
+        return package in self._installed
 
-            cache = set()
-            for line in proc.stdout:
-                cache.add(line.rstrip())
-            self.__installed = cache
+    def _query_installed(self):
+        try:
+            reader = open(self.__in_root('var/lib/dpkg/status'),
+                    encoding='utf-8', errors='replace')
+        except OSError:
+            return None
 
-        return package in self.__installed
+        installed = {}
+
+        with reader:
+            for fields in iter_stanzas(reader,
+                    ('Package', 'Version', 'Status')):
+                # the status file also lists removed-but-not-purged
+                # packages, and packages that were only ever selected
+                status = fields.get('Status', '').split()
+                if not status or status[-1] in ('not-installed',
+                        'config-files'):
+                    continue
+
+                # Multi-Arch: same packages are listed once per
+                # architecture with the same version
+                installed[fields['Package']] = fields.get('Version')
+
+        return installed
+
+    def _query_available(self):
+        lists = self.__in_root('var/lib/apt/lists')
+
+        if not os.path.isdir(lists):
+            return None
+
+        available = {}
+
+        for path in sorted(glob.glob(os.path.join(lists, '*_Packages*'))):
+            if path.endswith('_Packages'):
+                opener = open
+            elif path.endswith('_Packages.gz'):
+                opener = gzip.open
+            elif path.endswith('_Packages.xz'):
+                opener = lzma.open
+            else:
+                # e.g. .lz4 with Acquire::GzipIndexes, or a partial download
+                logger.debug('not reading apt list %s', path)
+                continue
 
-    def is_available(self, package):
-        if self.__available is None:
             try:
-                proc = subprocess.Popen(['apt-cache', 'pkgnames'],
-                        universal_newlines=True,
-                        stdout=subprocess.PIPE)
-            except FileNotFoundError:
-                return False
+                reader = opener(path, 'rt', encoding='utf-8',
+                        errors='replace')
+            except OSError as e:
+                logger.debug('unable to read apt list %s: %s', path, e)
+                continue
 
-            cache = set()
-            for line in proc.stdout:
-                cache.add(line.rstrip())
-            self.__available = cache
+            with reader:
+                for fields in iter_stanzas(reader, ('Package', 'Version')):
+                    package = fields['Package']
+                    version = fields.get('Version')
+                    old = available.get(package)
 
-        return package in self.__available
+                    try:
+                        if old is None or Version(version) > Version(old):
+                            available[package] = version
+                    except TypeError:
+                        # LooseVersion can't compare every Debian version
+                        pass
+
+        return available
+
+    def is_available(self, package):
+        return package in self._available
 
     def current_version(self, package):
-        # 'dpkg-query: no packages found matching $package'
-        # will leak on stderr if called with an unknown package,
-        # but that should never happen
-        try:
-            return check_output(['dpkg-query', '--show',
-              '--showformat', '${Version}', package], universal_newlines=True)
-        except FileNotFoundError:
-            return None
-        except subprocess.CalledProcessError:
-            return None
+        return self._installed.get(package)
 
     def available_version(self, package):
-        try:
-            current_ver = check_output(['apt-cache', 'madison', package],
-                                        universal_newlines=True)
-        except FileNotFoundError:
-            return None
-        current_ver = current_ver.splitlines()[0]
-        current_ver = current_ver.split('|')[1].strip()
-        return current_ver
+        return self._available.get(package)
 
     def install_packages(self, debs, method=None, gain_root='su'):
         if method and method not in (
@@ -177,6 +220,8 @@ class DebPackaging(PackagingSystem):
             # gdebi-gtk etc.
             subprocess.call([method] + list(debs))
 
+        self.invalidate_package_indexes()
+
     def rename_package(self, p):
         mapped = super(DebPackaging, self).rename_package(p)
 
@@ -418,8 +463,107 @@ class DebPackaging(PackagingSystem):
             print(cpe.output)
             raise
 
+        with open(os.path.join(destdir, 'DEBIAN/control'),
+                encoding='utf-8') as reader:
+            self._built[outfile] = reader.read()
+
         rm_rf(destdir)
         return outfile
 
+    def update_repository(self, repository, packages):
+        """Maintain a flat repository, usable with a sources.list line
+        like "deb [trusted=yes] file:/srv/games ./".
+
+        Existing entries in Packages are kept as-is, so packages that
+        are already in the repository are not read again; only the
+        new packages are hashed, and the rest of their stanzas come
+        from the control files we generated.
+        """
+        repository = os.path.abspath(repository)
+        index = os.path.join(repository, 'Packages')
+        stanzas = {}
+
+        try:
+            with open(index, encoding='utf-8') as reader:
+                text = reader.read()
+        except FileNotFoundError:
+            text = ''
+
+        for stanza in text.split('\n\n'):
+            fields = next(iter_stanzas(stanza.splitlines(),
+                ('Package', 'Version', 'Architecture', 'Filename')), None)
+
+            if fields is None:
+                continue
+
+            if not os.path.exists(os.path.join(repository,
+                    fields.get('Filename', ''))):
+                logger.debug('dropping %s from repository index: no '
+                        'longer exists', fields.get('Filename'))
+                continue
+
+            key = (fields['Package'], fields.get('Version'),
+                    fields.get('Architecture'))
+            stanzas[key] = stanza.strip('\n') + '\n'
+
+        for deb in packages:
+            deb = os.path.abspath(deb)
+            control = self._built[deb]
+            fields = next(iter_stanzas(control.splitlines(),
+                ('Package', 'Version', 'Architecture')))
+
+            with open(deb, 'rb') as reader:
+                hf = HashedFile.from_file(deb, reader)
+
+            key = (fields['Package'], fields.get('Version'),
+                    fields.get('Architecture'))
+            stanzas[key] = (control.strip('\n') + '\n' +
+                    'Filename: %s\n' % os.path.relpath(deb, repository) +
+                    'Size: %d\n' % os.path.getsize(deb) +
+                    'MD5sum: %s\n' % hf.md5 +
+                    'SHA1: %s\n' % hf.sha1 +
+                    'SHA256: %s\n' % hf.sha256)
+
+        text = '\n'.join(stanzas[k] for k in sorted(stanzas, key=str))
+
+        with open(index + '.tmp', 'w', encoding='utf-8') as writer:
+            writer.write(text)
+        with lzma.open(index + '.xz.tmp', 'wt', encoding='utf-8') as writer:
+            writer.write(text)
+
+        os.rename(index + '.xz.tmp', index + '.xz')
+        os.rename(index + '.tmp', index)
+        logger.info('updated %s (%d packages)', index, len(stanzas))
+
+        return set(os.path.abspath(deb) for deb in packages)
+
+def iter_stanzas(reader, wanted):
+    """Parse a dpkg status file or apt Packages file, streaming from the
+    given iterable of lines, and yield a dict for each stanza that has
+    a Package field. Only the fields listed in wanted are kept, and only
+    their first line: that is enough for the single-line fields
+    Package, Version and Status.
+    """
+    fields = {}
+
+    for line in reader:
+        if not line.strip():
+            if 'Package' in fields:
+                yield fields
+            fields = {}
+            continue
+
+        if line[0] in ' \t':
+            # continuation of a multi-line field
+            continue
+
+        name, sep, value = line.partition(':')
+
+        if sep and name in wanted:
+            fields[name] = value.strip()
+
+    if 'Package' in fields:
+        yield fields
+
 def get_packaging_system(distro=None):
     return DebPackaging()
@@ -18,19 +18,46 @@
 
 import logging
 import os
+import shutil
 import subprocess
 import time
 from distutils.version import LooseVersion as Version
 
 from . import (PackagingSystem)
 from ..util import (
+        check_call,
         check_output,
         normalize_permissions,
         run_as_root,
+        which,
         )
 
 logger = logging.getLogger(__name__)
 
+def owned_paths(paths, system_dirs):
+    """Return the minimal set of files and directories that a package
+    must list in its %files section to own all of the given absolute
+    paths, without owning any of system_dirs.
+
+    Each path is owned via its shallowest ancestor (or itself) that is
+    not a system directory, so this is linear in the total length of
+    the paths, and can equally be used on the result of walking
+    DESTDIR or on a list of files that are going to be installed.
+    """
+    files = set()
+
+    for path in paths:
+        prefix = ''
+        for part in path.strip('/').split('/'):
+            if not part:
+                break
+            prefix = prefix + '/' + part
+            if prefix not in system_dirs:
+                files.add(prefix)
+                break
+
+    return files
+
 class RpmPackaging(PackagingSystem):
     INSTALL_CMD = ['rpm', '-U']
     CHECK_CMD = 'rpmlint'
@@ -40,6 +67,32 @@ class RpmPackaging(PackagingSystem):
                   'amd64': 'x86_64',
                   }
 
+    # Directories that belong to the base system and must not be listed
+    # in %files. /usr/games & /usr/share/games should only
+    # be seen in rpm's built for Mageia
+    SYSTEM_DIRS = frozenset(['/usr',
+                             '/usr/bin',
+                             '/usr/games',
+                             '/usr/lib',
+                             '/usr/share',
+                             '/usr/share/applications',
+                             '/usr/share/doc',
+                             '/usr/share/doc/packages',
+                             '/usr/share/games',
+                             '/usr/share/icons',
+                             '/usr/share/icons/hicolor',
+                             '/usr/share/icons/hicolor/scalable',
+                             '/usr/share/icons/hicolor/scalable/apps',
+                             '/usr/share/licenses',
+                             '/usr/share/pixmaps'])
+
+    # rpm touches one of these whenever it installs or removes anything
+    RPMDB_STAMPS = (
+            '/usr/lib/sysimage/rpm/rpmdb.sqlite',
+            '/var/lib/rpm/rpmdb.sqlite',
+            '/var/lib/rpm/Packages',
+            )
+
     def __init__(self, distro=None):
         super(RpmPackaging, self).__init__()
         self.distro = distro
@@ -48,22 +101,38 @@ class RpmPackaging(PackagingSystem):
         else:
             self._contexts = (distro, 'rpm', 'generic')
 
-    def is_installed(self, package):
+        # { name: [version, release] }
+        self._installed = self._add_package_index('rpm-installed',
+                self.RPMDB_STAMPS, self._query_installed)
+
+    def _query_installed(self):
         try:
-            return 0 == subprocess.call(['rpm', '-q', package],
-                                        stdout=subprocess.DEVNULL,
-                                        stderr=subprocess.DEVNULL)
-        except FileNotFoundError:
-            return False
+            output = check_output(['rpm', '-qa',
+                '--qf', '%{NAME}\t%{VERSION}\t%{RELEASE}\n'],
+                stderr=subprocess.DEVNULL, universal_newlines=True)
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            return None
+
+        installed = {}
+        for line in output.splitlines():
+            name, version, release = line.split('\t')
+            installed[name] = [version, release]
+        return installed
+
+    def is_installed(self, package):
+        return package in self._installed
 
     def current_version(self, package):
-        try:
-            return check_output(['rpm', '-q',
-              '--qf', '%{VERSION}', package], universal_newlines=True)
-        except FileNotFoundError:
+        details = self._installed.get(package)
+        if details is None:
             return None
-        except subprocess.CalledProcessError:
+        return details[0]
+
+    def current_release(self, package):
+        details = self._installed.get(package)
+        if details is None:
             return None
+        return details[1]
 
     def is_available(self, package):
         # assume no apt-like system in this base class
@@ -91,6 +160,8 @@ class RpmPackaging(PackagingSystem):
                                 ' using rpm instead') % method)
             run_as_root(['rpm', '-U'] + list(rpms), gain_root)
 
+        self.invalidate_package_indexes()
+
     def format_relation(self, pr):
         assert not pr.contextual
         assert not pr.alternatives
@@ -120,42 +191,18 @@ class RpmPackaging(PackagingSystem):
         else:
             url = 'https://wiki.debian.org/Games/GameDataPackager'
 
-        # /usr/games & /usr/share/games should only
-        # be seen in rpm's built for Mageia
-        SYSTEM_DIRS = set(['/usr',
-                           '/usr/bin',
-                           '/usr/games',
-                           '/usr/lib',
-                           '/usr/share',
-                           '/usr/share/applications',
-                           '/usr/share/doc',
-                           '/usr/share/doc/packages',
-                           '/usr/share/games',
-                           '/usr/share/icons',
-                           '/usr/share/icons/hicolor',
-                           '/usr/share/icons/hicolor/scalable',
-                           '/usr/share/icons/hicolor/scalable/apps',
-                           '/usr/share/licenses',
-                           '/usr/share/pixmaps'])
-
         files = set()
         for dirpath, dirnames, filenames in os.walk(destdir):
-             dir = dirpath[len(destdir):]
-             if not dir:
-                 # /
-                 continue
-             elif dir in SYSTEM_DIRS:
-                 for fn in filenames + dirnames:
-                     full = os.path.join(dirpath, fn)
-                     file = full[len(destdir):]
-                     if file not in SYSTEM_DIRS:
-                         files.add(file)
-             else:
-                 for file in files:
-                     if dir.startswith(file):
-                         break
-                 else:
-                     files.add(dir)
+            dir = os.path.join('/', os.path.relpath(dirpath, destdir))
+            if dir == '/.':
+                dir = '/'
+            files |= owned_paths(
+                    [os.path.join(dir, fn) for fn in filenames + dirnames],
+                    self.SYSTEM_DIRS)
+            # everything below a directory that we own is covered by it,
+            # so only descend into system directories
+            dirnames[:] = [d for d in dirnames
+                    if os.path.join(dir, d) in self.SYSTEM_DIRS]
 
         logger.debug('%%files in specfile:\n%s', '\n'.join(sorted(files)))
 
@@ -247,13 +294,12 @@ class RpmPackaging(PackagingSystem):
             release = '0'
         else:
             try:
-                release = check_output(['rpm', '-q', '--qf' ,'%{RELEASE}',
-                                         package.name]).decode('ascii')
+                release = self.current_release(package.name)
                 if (self.distro is not None and
                         release.endswith('.' + self.distro)):
                     release = release[:-(len(self.distro) + 1)]
                 release = str(int(release) + 1)
-            except (subprocess.CalledProcessError, ValueError):
+            except (AttributeError, ValueError):
                 release = '0'
 
         if self.distro is not None:
@@ -282,6 +328,34 @@ class RpmPackaging(PackagingSystem):
                 + package.name + '-'
                 + package.version + '-' + release + '.' + arch + '.rpm')
 
+    def update_repository(self, repository, packages):
+        """Copy the packages into the repository and refresh its
+        repodata.
+
+        Writing repodata natively would mean reimplementing most of
+        createrepo, so we let createrepo_c do it; with --update it
+        reuses the existing metadata for packages whose size and mtime
+        have not changed instead of reading them again.
+        """
+        repository = os.path.abspath(repository)
+        copied = set()
+
+        for rpm in packages:
+            dest = os.path.join(repository, os.path.basename(rpm))
+            if os.path.abspath(rpm) != dest:
+                shutil.copy2(rpm, dest)
+            copied.add(dest)
+
+        for tool in ('createrepo_c', 'createrepo'):
+            if which(tool) is not None:
+                check_call([tool, '--quiet', '--update', repository])
+                break
+        else:
+            logger.error('Neither createrepo_c nor createrepo is installed: '
+                    'repodata in %s was not updated', repository)
+
+        return copied
+
 # XXX: dnf is written in python3 and has a stable public api,
 #      it is likely faster to use it instead of calling 'dnf' pgm.
 #
@@ -304,42 +378,45 @@ class DnfPackaging(RpmPackaging):
 
     def __init__(self, distro='fedora'):
         super(DnfPackaging, self).__init__(distro)
-        self.available = None
+        self._available = self._add_package_index('dnf-available',
+                ('/var/cache/dnf',) + self.RPMDB_STAMPS,
+                self._query_available)
 
     def read_architecture(self):
         super(DnfPackaging, self).read_architecture()
         if self._architecture == 'amd64':
             self._foreign_architectures = set(['i386'])
 
-    def is_available(self, package):
-        if self.available is None:
-            try:
-                proc = subprocess.Popen(['dnf', 'list'],
-                        universal_newlines=True,
-                        stderr=subprocess.DEVNULL,
-                        stdout=subprocess.PIPE)
-            except FileNotFoundError:
-                return False
-            cache = set()
+    def _query_available(self):
+        try:
+            proc = subprocess.Popen(['dnf', '--quiet', 'list'],
+                    universal_newlines=True,
+                    stderr=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            return None
+
+        available = {}
+        with proc:
             for line in proc.stdout:
-                if '.' in line:
-                    cache.add(line.split('.')[0])
-            self.available = cache
+                # e.g. "quake3-data.noarch  1.32b-0  @commandline"
+                # (the section headings have fewer fields)
+                fields = line.split()
+                if len(fields) < 3 or '.' not in fields[0]:
+                    continue
+                name = fields[0].rsplit('.', 1)[0]
+                # the later "Available Packages" section wins
+                available[name] = fields[1]
+
+        if proc.returncode != 0:
+            return None
+        return available
 
-        return package in self.available
+    def is_available(self, package):
+        return package in self._available
 
     def available_version(self, package):
-        try:
-            proc = subprocess.Popen(['dnf', 'list', package],
-                                     universal_newlines=True,
-                                     stderr=subprocess.DEVNULL,
-                                     stdout=subprocess.PIPE)
-        except FileNotFoundError:
-            return None
-        # keep only last line
-        for line in proc.stdout:
-            pass
-        return line.split()[1]
+        return self._available.get(package)
 
     def install_packages(self, rpms, method='dnf', gain_root='su'):
         super(DnfPackaging, self).install_packages(rpms, method=method,
@@ -358,31 +435,40 @@ class ZypperPackaging(RpmPackaging):
 
     def __init__(self, distro='suse'):
         super(ZypperPackaging, self).__init__(distro)
+        self._available = self._add_package_index('zypper-available',
+                ('/var/cache/zypp/solv',) + self.RPMDB_STAMPS,
+                self._query_available)
 
-    def is_available(self, package):
+    def _query_available(self):
         try:
-            proc = subprocess.Popen(['zypper', 'info', package],
+            proc = subprocess.Popen(['zypper', '--non-interactive',
+                        '--quiet', 'search', '--details', '--type',
+                        'package'],
                     universal_newlines=True,
+                    stderr=subprocess.DEVNULL,
                     stdout=subprocess.PIPE,
                     env={'LANG':'C'})
         except FileNotFoundError:
-            return False
-        for line in proc.stdout:
-            if line.startswith('Version:'):
-                return True
-        return False
+            return None
 
-    def available_version(self, package):
-        try:
-            proc = subprocess.Popen(['zypper', 'info', package],
-                    universal_newlines=True,
-                    stdout=subprocess.PIPE,
-                    env={'LANG':'C'})
-        except FileNotFoundError:
+        available = {}
+        with proc:
+            for line in proc.stdout:
+                # S | Name | Type | Version | Arch | Repository
+                fields = [f.strip() for f in line.split('|')]
+                if len(fields) < 6 or fields[2] != 'package':
+                    continue
+                available.setdefault(fields[1], fields[3])
+
+        if proc.returncode != 0:
             return None
-        for line in proc.stdout:
-            if line.startswith('Version:'):
-                return line.split(':', maxsplit=1)[1]
+        return available
+
+    def is_available(self, package):
+        return package in self._available
+
+    def available_version(self, package):
+        return self._available.get(package)
 
     def install_packages(self, rpms, method='zypper', gain_root='su'):
         super(ZypperPackaging, self).install_packages(rpms, method=method,
@@ -401,23 +487,32 @@ class UrpmiPackaging(RpmPackaging):
 
     def __init__(self, distro='mageia'):
         super(UrpmiPackaging, self).__init__(distro)
+        self._available = self._add_package_index('urpmi-available',
+                ('/var/lib/urpmi',) + self.RPMDB_STAMPS,
+                self._query_available)
 
-    def is_available(self, package):
+    def _query_available(self):
         try:
-            return 0 == subprocess.call(['urpmq', package],
-                                        stdout=subprocess.DEVNULL,
-                                        stderr=subprocess.DEVNULL)
-        except FileNotFoundError:
-            return False
+            output = check_output(['urpmq', '--list', '-f'],
+                    stderr=subprocess.DEVNULL, universal_newlines=True)
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            return None
+
+        available = {}
+        for line in output.splitlines():
+            # name-version-release.arch
+            try:
+                name, version, release = line.strip().rsplit('-', 2)
+            except ValueError:
+                continue
+            available.setdefault(name, version)
+        return available
+
+    def is_available(self, package):
+        return package in self._available
 
     def available_version(self, package):
-        try:
-            line = check_output(['urpmq', '-r', package]).decode('ascii')
-            return line.split('-')[-2]
-        except FileNotFoundError:
-            return None
-        except subprocess.CalledProcessError:
-            return None
+        return self._available.get(package)
 
 def get_packaging_system(distro=None):
     if distro is None:
@@ -0,0 +1,556 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+"""Planning how to obtain the files for a set of packages.
+
+PackagingTask.fill_gap() decides how to get each file and then gets it,
+one file at a time. The Planner makes the same decisions up-front,
+without touching anything, and produces a Plan: a graph of Steps
+(download this, unpack that) that can be printed, or run by an Executor
+with independent steps in parallel. Anything the Executor doesn't
+manage to do is left for fill_gap() to try in the usual way.
+"""
+
+from collections import defaultdict
+import concurrent.futures
+import logging
+import os
+
+from .build import (FillResult)
+from .util import (human_size)
+
+logger = logging.getLogger(__name__)
+
+# Formats that just copy data around, rather than decompressing it
+IO_FORMATS = ('cat', 'dos2unix', 'xdelta')
+
+VERBS = {
+        'cat': 'concatenate',
+        'dos2unix': 'convert',
+        'xdelta': 'patch',
+}
+
+class Step(object):
+    """Something that has to be done to obtain some of the files we want.
+    """
+    def __init__(self, game, action, wanted, package, inputs=(),
+            runs_tool=False):
+        self.game = game
+        # 'download', or 'unpack' (which also covers concatenating and
+        # patching)
+        self.action = action
+        # the WantedFile to download, or the provider to unpack
+        self.wanted = wanted
+        # the package we are doing this for, for unpack_provider()
+        self.package = package
+        # Steps that must be completed first
+        self.inputs = list(inputs)
+        # names of the files we want to get out of this step
+        self.targets = set()
+        # whether unpacking runs an external tool, from
+        # PackagingTask.runs_tool()
+        self.runs_tool = runs_tool
+
+        if action == 'download':
+            self.resource = 'network'
+        elif wanted.unpack['format'] in IO_FORMATS:
+            self.resource = 'io'
+        else:
+            self.resource = 'cpu'
+
+    @property
+    def key(self):
+        return (self.action, self.wanted.name)
+
+    @property
+    def download_bytes(self):
+        if self.action == 'download':
+            return self.wanted.size or 0
+
+        return 0
+
+    @property
+    def read_bytes(self):
+        if self.action == 'download':
+            return 0
+
+        ret = self.wanted.size or 0
+
+        for part in self.wanted.unpack.get('other_parts', ()):
+            ret += self.game.files[part].size or 0
+
+        return ret
+
+    @property
+    def write_bytes(self):
+        if self.action == 'download':
+            return self.wanted.size or 0
+
+        return sum((self.game.files[t].size or 0) for t in self.targets)
+
+    @property
+    def tool_invocations(self):
+        if self.action == 'download':
+            return 0
+
+        fmt = self.wanted.unpack['format']
+
+        if not self.runs_tool:
+            return 0
+        elif fmt == 'arj':
+            # once per part
+            return 1 + len(self.wanted.unpack.get('other_parts', ()))
+        elif fmt == 'unshield':
+            # list and extract each group
+            return 2 * max(1, len(self.wanted.unpack.get('groups', ())))
+
+        return 1
+
+    def __str__(self):
+        if self.action == 'download':
+            return 'download %s (%s)' % (self.wanted.name,
+                    human_size(self.download_bytes))
+
+        fmt = self.wanted.unpack['format']
+        return '%s %s (%s) to get %s' % (VERBS.get(fmt, 'unpack'),
+                self.wanted.name, fmt, ', '.join(sorted(self.targets)))
+
+class Plan(object):
+    """A set of Steps in an order that satisfies their dependencies."""
+
+    def __init__(self):
+        self.steps = []
+        # {package name: set of file names we cannot get}
+        self.missing = {}
+
+    @property
+    def download_bytes(self):
+        return sum(s.download_bytes for s in self.steps)
+
+    @property
+    def read_bytes(self):
+        return sum(s.read_bytes for s in self.steps)
+
+    @property
+    def write_bytes(self):
+        return sum(s.write_bytes for s in self.steps)
+
+    @property
+    def tool_invocations(self):
+        return sum(s.tool_invocations for s in self.steps)
+
+    def describe(self):
+        """Return a human-readable description of the plan."""
+        lines = []
+        numbers = {}
+
+        for i, step in enumerate(self.steps, 1):
+            numbers[step] = i
+            line = '%3d. %s' % (i, step)
+
+            if step.inputs:
+                line += ' [after %s]' % ', '.join(
+                        str(numbers[s]) for s in step.inputs)
+
+            lines.append(line)
+
+        if not self.steps:
+            lines.append('nothing to do')
+
+        for package, missing in sorted(self.missing.items()):
+            if missing:
+                lines.append('%s: cannot find %s' % (package,
+                    ', '.join(sorted(missing))))
+            else:
+                lines.append('%s: possible' % package)
+
+        lines.append('estimated total: read %s, download %s, write %s' % (
+            human_size(self.read_bytes), human_size(self.download_bytes),
+            human_size(self.write_bytes)))
+        return '\n'.join(lines)
+
+class ResourceEstimate(object):
+    """How much work and disk space it will take to carry out a Plan
+    and build the packages.
+    """
+
+    def __init__(self):
+        self.download_bytes = 0
+        self.hash_bytes = 0
+        self.tool_invocations = 0
+        # [(what, directory, bytes)]
+        self.space = []
+
+    def add_space(self, label, path, size):
+        if size:
+            self.space.append((label, path, size))
+
+    def filesystems(self):
+        """Yield (labels, directories, bytes needed, bytes free) for
+        each filesystem that we will write to.
+        """
+        by_dev = {}
+
+        for label, path, size in self.space:
+            try:
+                dev = os.stat(path).st_dev
+                statvfs = os.statvfs(path)
+            except OSError:
+                continue
+
+            if dev not in by_dev:
+                by_dev[dev] = [[], [], 0, statvfs.f_frsize * statvfs.f_bavail]
+
+            labels, paths, _, _ = by_dev[dev]
+
+            if label not in labels:
+                labels.append(label)
+
+            if path not in paths:
+                paths.append(path)
+
+            by_dev[dev][2] += size
+
+        for labels, paths, needed, free in by_dev.values():
+            yield labels, paths, needed, free
+
+    def describe(self):
+        """Return a human-readable description of the estimate."""
+        lines = [
+                'bytes to download: %s' % human_size(self.download_bytes),
+                'bytes to hash: %s' % human_size(self.hash_bytes),
+                'external tool invocations: %d' % self.tool_invocations,
+        ]
+
+        for label, path, size in self.space:
+            lines.append('%s: %s in %s' % (label, human_size(size), path))
+
+        for labels, paths, needed, free in self.filesystems():
+            lines.append('peak usage of filesystem containing %s: %s, '
+                    '%s free%s' % (', '.join(paths), human_size(needed),
+                        human_size(free),
+                        ' (not enough)' if needed > free else ''))
+
+        return '\n'.join(lines)
+
+class _Route(object):
+    # How to get target: action None means we already have it
+    def __init__(self, action=None, wanted=None, target=None, inputs=(),
+            download_bytes=0):
+        self.action = action
+        self.wanted = wanted
+        self.target = target
+        self.inputs = inputs
+        self.download_bytes = download_bytes
+
+_ALREADY_FOUND = _Route()
+_IN_PROGRESS = object()
+
+class Planner(object):
+    """Work out how to get the files for some packages, making the same
+    decisions that PackagingTask.fill_gap() would, but without actually
+    doing anything.
+    """
+
+    def __init__(self, task, download=False):
+        self.task = task
+        self.game = task.game
+        self.download = download
+        # {(file name, download allowed, package name): _Route or None}
+        self.__routes = {}
+        # {Step.key: Step}
+        self.__steps = {}
+
+    def plan(self, packages):
+        """Return a Plan for packages."""
+        plan = Plan()
+
+        for package in sorted(packages, key=lambda p: p.name):
+            missing = set()
+
+            for wanted in sorted(package.install_files |
+                    package.optional_files, key=lambda f: f.name):
+                route = self.__route(wanted, self.download, package)
+
+                if route is None:
+                    if wanted in package.install_files:
+                        missing.add(wanted.name)
+                else:
+                    self.__add(plan, route, package)
+
+            plan.missing[package.name] = missing
+
+        return plan
+
+    def __add(self, plan, route, package):
+        if route.action is None:
+            return None
+
+        step = self.__steps.get((route.action, route.wanted.name))
+
+        if step is None:
+            inputs = []
+
+            for r in route.inputs:
+                s = self.__add(plan, r, package)
+
+                if s is not None:
+                    inputs.append(s)
+
+            step = Step(self.game, route.action, route.wanted, package,
+                    inputs, runs_tool=(route.action == 'unpack' and
+                        self.task.runs_tool(route.wanted)))
+            self.__steps[step.key] = step
+            plan.steps.append(step)
+
+        step.targets.add(route.target.name)
+        return step
+
+    def __route(self, wanted, download, package):
+        # the package affects which provider is cheapest, as in fill_gap()
+        key = (wanted.name, download, package.name)
+        route = self.__routes.get(key)
+
+        if route is _IN_PROGRESS:
+            # a loop, which fill_gap() would also give up on
+            return None
+
+        if key not in self.__routes:
+            self.__routes[key] = _IN_PROGRESS
+            route = self.__find_route(wanted, download, package)
+            self.__routes[key] = route
+
+        return route
+
+    def __find_route(self, wanted, download, package):
+        task = self.task
+
+        if wanted.name in task.found or wanted.name in task.unpacked_in_memory:
+            return _ALREADY_FOUND
+
+        # fill_gap() has already given up on it
+        if task.file_status[wanted.name] is FillResult.IMPOSSIBLE:
+            return None
+
+        if wanted.alternatives:
+            routes = []
+
+            for alt in wanted.alternatives:
+                route = self.__route(self.game.files[alt], download,
+                        package)
+
+                if route is not None:
+                    routes.append(route)
+
+            return self.__cheapest(routes)
+
+        routes = []
+
+        if wanted.download and download:
+            routes.append(_Route('download', wanted, wanted, (),
+                wanted.size or 0))
+
+        providers = task.order_providers(wanted, package)
+
+        for provider_name in providers:
+            provider = self.game.files[provider_name]
+
+            if provider_name in task.unpack_tried:
+                continue
+
+            if not task.check_unpacker(provider):
+                continue
+
+            provider_route = self.__route(provider, download, package)
+
+            if provider_route is None:
+                continue
+
+            inputs = [provider_route]
+
+            # fill_gap() never downloads other parts
+            for part in provider.unpack.get('other_parts', ()):
+                part_route = self.__route(self.game.files[part], False,
+                        package)
+
+                if part_route is None:
+                    break
+
+                inputs.append(part_route)
+            else:
+                routes.append(_Route('unpack', provider, wanted, inputs,
+                    sum(r.download_bytes for r in inputs)))
+
+        if not routes and wanted.size == 0 and providers:
+            # fill_gap() will make an empty file
+            return _ALREADY_FOUND
+
+        return self.__cheapest(routes)
+
+    def __cheapest(self, routes):
+        # the first of the routes that needs the least downloading
+        best = None
+
+        for route in routes:
+            if best is None or route.download_bytes < best.download_bytes:
+                best = route
+
+        return best
+
+class Executor(object):
+    """Run the Steps in a Plan, with each one starting as soon as the
+    steps it depends on have finished.
+
+    limits is a dict {resource: number of steps}, where the resources
+    are 'network' (downloads), 'cpu' (unpacking compressed archives) and
+    'io' (concatenating, patching).
+    """
+
+    def __init__(self, task, limits):
+        self.task = task
+        self.limits = limits
+        # {provider name: names of the files that unpacking it might
+        # write to the workdir, including those in nested archives}
+        self.__writes = {}
+
+    def run(self, plan):
+        """Run plan. Return the set of Steps that were not successful,
+        including those that were skipped because an earlier step failed.
+        """
+        task = self.task
+        failed = set()
+
+        if not plan.steps:
+            return failed
+
+        # make sure this exists before the workers want it
+        task.get_workdir()
+
+        workers = sum(self.limits.values())
+        progress_factory = task.progress_factory
+        extraction_threads = task.extraction_threads
+
+        # If several archives can be unpacked at once, they share the
+        # CPUs instead of each one using all of them
+        cpu_steps = min(self.limits['cpu'],
+                sum(1 for s in plan.steps if s.resource == 'cpu'))
+
+        if cpu_steps > 1:
+            task.extraction_threads = max(1, extraction_threads // cpu_steps)
+
+        if workers > 1 and len(plan.steps) > 1:
+            # progress reports from several steps at once would be
+            # unreadable
+            task.progress_factory = lambda info=None: None
+
+        try:
+            self.__run(plan, workers, failed)
+        finally:
+            task.progress_factory = progress_factory
+            task.extraction_threads = extraction_threads
+
+        return failed
+
+    def __run(self, plan, workers, failed):
+        pending = list(plan.steps)
+        done = set()
+        busy = defaultdict(int)
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            while pending or running:
+                for step in list(pending):
+                    if any(s in failed for s in step.inputs):
+                        logger.debug('not trying to %s: an earlier step '
+                                'failed', step)
+                        pending.remove(step)
+                        failed.add(step)
+                        continue
+
+                    if not all(s in done for s in step.inputs):
+                        continue
+
+                    if busy[step.resource] >= self.limits[step.resource]:
+                        continue
+
+                    if self.__conflicts(step, running.values()):
+                        continue
+
+                    pending.remove(step)
+                    busy[step.resource] += 1
+                    running[pool.submit(self.__run_step, step)] = step
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in finished:
+                    step = running.pop(future)
+                    busy[step.resource] -= 1
+
+                    if future.result():
+                        done.add(step)
+                    else:
+                        failed.add(step)
+
+    def __step_writes(self, step):
+        if step.action == 'download':
+            return set([step.wanted.name])
+
+        writes = self.__writes.get(step.wanted.name)
+
+        if writes is None:
+            writes = set()
+            todo = [step.wanted]
+
+            while todo:
+                for f in todo.pop().provides_files:
+                    if f.name not in writes:
+                        writes.add(f.name)
+                        todo.append(f)
+
+            self.__writes[step.wanted.name] = writes
+
+        return writes
+
+    def __conflicts(self, step, running):
+        # Two steps that can produce the same file, directly or from an
+        # archive nested in what they unpack, must not run at the same
+        # time, or they would both write it to the same temporary file
+        writes = self.__step_writes(step)
+
+        for other in running:
+            if writes & self.__step_writes(other):
+                return True
+
+        return False
+
+    def __run_step(self, step):
+        task = self.task
+        logger.debug('starting to %s', step)
+
+        if step.action == 'download':
+            if step.wanted.name not in task.found:
+                task.download_file(step.wanted)
+        elif step.wanted.name not in task.unpack_tried:
+            target = self.task.game.files[sorted(step.targets)[0]]
+            task.unpack_provider(step.package, step.wanted, target)
+
+        return all((t in task.found or t in task.unpacked_in_memory)
+                for t in step.targets)
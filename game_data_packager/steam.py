@@ -15,20 +15,25 @@
 # You can find the GPL license text on a Debian system under
 # /usr/share/common-licenses/GPL-2.
 
+import concurrent.futures
 import glob
 import logging
 import os
+import re
 import tempfile
+import threading
 import xml.etree.ElementTree
 import urllib.request
 
 from .build import (BinaryExecutablesNotAllowed,
         DownloadsFailed,
         NoPackagesPossible)
+from .owned import (OwnedGamesCache)
 from .packaging import (get_native_packaging_system)
 from .util import (AGENT,
         ascii_safe,
         lang_score,
+        physical_device,
         rm_rf)
 
 logger = logging.getLogger(__name__)
@@ -56,32 +61,42 @@ def parse_acf(path):
                 acf_struct['name'] = acf_struct['installdir']
             yield acf_struct
 
-def owned_steam_games(steam_id=None):
+STEAM_COMMUNITY = 'http://steamcommunity.com'
+
+def owned_steam_games(steam_id=None, refresh=False, url=STEAM_COMMUNITY):
     if steam_id is None:
         steam_id = get_steam_id()
-    if owned_steam_games.STEAM_GAMES is not None:
-        return owned_steam_games.STEAM_GAMES
-    owned_steam_games.STEAM_GAMES = []
     if steam_id is None:
         return []
-    url = "http://steamcommunity.com/profiles/" + steam_id + "/games?xml=1"
-    try:
-        html = urllib.request.urlopen(urllib.request.Request(url, headers={'User-Agent': AGENT}))
-        tree = xml.etree.ElementTree.ElementTree()
-        tree.parse(html)
-        games_xml = tree.getiterator('game')
-        for game in games_xml:
-            appid = int(game.find('appID').text)
-            name = game.find('name').text
-            #print(appid, name)
-            owned_steam_games.STEAM_GAMES.append((appid, name))
-    except urllib.error.URLError:
-        # e="[Errno 111] Connection refused" but e.errno=None ?
-        pass
-
-    return owned_steam_games.STEAM_GAMES
-
-owned_steam_games.STEAM_GAMES = None
+    if not refresh and steam_id in owned_steam_games.STEAM_GAMES:
+        return owned_steam_games.STEAM_GAMES[steam_id]
+
+    def fetch():
+        games = []
+        try:
+            html = urllib.request.urlopen(urllib.request.Request(
+                url + '/profiles/' + steam_id + '/games?xml=1',
+                headers={'User-Agent': AGENT}))
+            tree = xml.etree.ElementTree.ElementTree()
+            tree.parse(html)
+            games_xml = tree.iter('game')
+            for game in games_xml:
+                appid = int(game.find('appID').text)
+                name = game.find('name').text
+                #print(appid, name)
+                games.append((appid, name))
+        except urllib.error.URLError:
+            # e="[Errno 111] Connection refused" but e.errno=None ?
+            return None
+        return games
+
+    owned_steam_games.STEAM_GAMES[steam_id] = [tuple(g) for g in
+            owned_steam_games.CACHE.get(steam_id, fetch, refresh=refresh)]
+    return owned_steam_games.STEAM_GAMES[steam_id]
+
+# { steam_id: [(appid, name)] } for this run
+owned_steam_games.STEAM_GAMES = {}
+owned_steam_games.CACHE = OwnedGamesCache('steam')
 
 def get_steam_id():
     path = os.path.expanduser('~/.steam/config/loginusers.vdf')
@@ -102,6 +117,159 @@ def get_steam_account():
             if 'AccountName' in line:
                 return line.split('"')[-2]
 
+def parse_vdf(text):
+    """Parse Valve's KeyValues text format, as used in
+    libraryfolders.vdf, into nested dicts.
+    """
+    tokens = re.findall(r'"((?:[^"\\]|\\.)*)"|([{}])', text)
+    stack = [{}]
+    key = None
+
+    for string, brace in tokens:
+        if brace == '{':
+            child = {}
+            stack[-1][key] = child
+            stack.append(child)
+            key = None
+        elif brace == '}':
+            if len(stack) > 1:
+                stack.pop()
+            key = None
+        elif key is None:
+            key = string
+        else:
+            stack[-1][key] = string.replace('\\\\', '\\')
+            key = None
+
+    return stack[0]
+
+def iter_steam_roots():
+    """Yield directories where Steam might be installed."""
+    data_home = os.environ.get('XDG_DATA_HOME',
+            os.path.expanduser('~/.local/share'))
+
+    # avoid import loop
+    from .build import (iter_fat_mounts)
+
+    for prefix in (
+            os.path.expanduser('~/.steam'),
+            os.path.join(data_home,
+                'wineprefixes/steam/drive_c/Program Files/Steam'),
+            os.path.join(data_home,
+                'wineprefixes/steam/drive_c/Program Files (x86)/Steam'),
+            os.path.expanduser('~/Steam'),
+            os.path.expanduser('~/.wine/drive_c/Program Files/Steam'),
+            os.path.expanduser('~/.wine/drive_c/Program Files (x86)/Steam'),
+            os.path.expanduser('~/.PlayOnLinux/wineprefix/Steam/drive_c/Program Files/Steam'),
+            ) + tuple(iter_fat_mounts('Steam')):
+        if os.path.isdir(prefix):
+            yield prefix
+
+class SteamLocator(object):
+    """Where Steam games are installed, found by reading each Steam
+    library's libraryfolders.vdf and appmanifest_*.acf once.
+    """
+
+    def __init__(self, roots=None):
+        if roots is None:
+            roots = iter_steam_roots()
+
+        # realpaths of steamapps directories, in the order we found them
+        self.libraries = []
+        # { appid as str: [(steamapps directory, installdir)] }
+        self.apps = {}
+
+        todo = list(roots)
+
+        while todo:
+            root = todo.pop(0)
+
+            for middle in ('steamapps', 'steam/steamapps', 'SteamApps',
+                    'steam/SteamApps'):
+                steamapps = os.path.join(root, middle)
+
+                if not os.path.isdir(steamapps):
+                    continue
+
+                steamapps = os.path.realpath(steamapps)
+
+                if steamapps in self.libraries:
+                    continue
+
+                logger.debug('Steam library at %s', steamapps)
+                self.libraries.append(steamapps)
+
+                for acf in parse_acf(steamapps):
+                    if 'appid' in acf and 'installdir' in acf:
+                        self.apps.setdefault(acf['appid'], []).append(
+                                (steamapps, acf['installdir']))
+
+                todo.extend(self.__iter_library_folders(steamapps))
+
+    def __iter_library_folders(self, steamapps):
+        path = os.path.join(steamapps, 'libraryfolders.vdf')
+
+        try:
+            with open(path, encoding='utf-8', errors='replace') as reader:
+                vdf = parse_vdf(reader.read())
+        except OSError:
+            return
+
+        for k, v in vdf.items():
+            if k.lower() != 'libraryfolders' or not isinstance(v, dict):
+                continue
+
+            for k, v in v.items():
+                if not k.isdigit():
+                    continue
+
+                # the newer format has { "path": "...", "label": "", ... }
+                if isinstance(v, dict):
+                    v = v.get('path')
+
+                if v and os.path.isdir(v):
+                    yield v
+
+    def iter_paths(self, appid, path):
+        """Yield existing directories for the Steam game with the given
+        appid and path (relative to steamapps), either of which may be
+        None.
+        """
+        found = False
+
+        if appid is not None:
+            for steamapps, installdir in self.apps.get(str(appid), ()):
+                if path is None:
+                    candidate = os.path.join(steamapps, 'common', installdir)
+                else:
+                    candidate = os.path.join(steamapps, path)
+
+                if os.path.isdir(candidate):
+                    found = True
+                    yield os.path.realpath(candidate)
+
+        if found or path is None:
+            return
+
+        # no manifest, perhaps because the files were copied from
+        # elsewhere: look in each library
+        for steamapps in self.libraries:
+            candidate = os.path.join(steamapps, path)
+
+            if os.path.isdir(candidate):
+                yield os.path.realpath(candidate)
+
+def get_steam_locator():
+    """Return a SteamLocator shared by everything in this process."""
+    with get_steam_locator.LOCK:
+        if get_steam_locator.LOCATOR is None:
+            get_steam_locator.LOCATOR = SteamLocator()
+
+        return get_steam_locator.LOCATOR
+
+get_steam_locator.LOCATOR = None
+get_steam_locator.LOCK = threading.Lock()
+
 def run_steam_meta_mode(args, games):
     logger.info('Visit our community page: https://steamcommunity.com/groups/debian_gdp#curation')
     owned = set()
@@ -187,53 +355,74 @@ def run_steam_meta_mode(args, games):
         # anyway
         args.compress = preserve_debs
 
-    all_debs = set()
+    if args.destination is None:
+        destination = workdir = tempfile.mkdtemp(prefix='gdptmp.')
+    else:
+        workdir = None
+        destination = args.destination
+
+    todo = {}
 
-    for shortname in sorted(found_games):
+    for packages in found_packages:
+        if packages['paths']:
+            todo.setdefault(packages['game'], []).append(packages)
+
+    jobs = max(1, getattr(args, 'jobs', 1))
+    game_locks = lock_devices(dict((shortname,
+        [path for p in packages for path in p['paths']])
+        for shortname, packages in todo.items()))
+
+    progress_lock = threading.Lock()
+    done = []
+    generated = {}
+    failed = []
+
+    def package_game(shortname):
         task = tasks[shortname]
-        task.verbose = getattr(args, 'verbose', False)
-        task.save_downloads = args.save_downloads
-        try:
-            task.look_for_files(binary_executables=args.binary_executables)
-        except BinaryExecutablesNotAllowed:
-            continue
-        except NoPackagesPossible:
-            continue
+        debs = package_steam_game(task, args,
+                [task.game.packages[p['package']] for p in todo[shortname]],
+                destination, locks=game_locks[shortname])
 
-        todo = list()
-        for packages in found_packages:
-            if packages['game'] == shortname and packages['paths']:
-                todo.append(task.game.packages[packages['package']])
+        with progress_lock:
+            done.append(shortname)
 
-        if not todo:
-            continue
+            if debs:
+                generated[shortname] = debs
+            else:
+                failed.append(shortname)
 
-        try:
-            ready = task.prepare_packages(log_immediately=False,
-                                          packages=todo)
-        except NoPackagesPossible:
-            logger.error('No package possible for %s.' % task.game.shortname)
-            continue
-        except DownloadsFailed:
-            logger.error('Unable to complete any packages of %s'
-                         ' because downloads failed.' % task.game.shortname)
-            continue
+            if jobs > 1:
+                logger.info('[%d/%d] %s: %s', len(done), len(todo),
+                        shortname, 'generated %d package(s)' % len(debs)
+                        if debs else 'failed')
 
-        if args.destination is None:
-            destination = workdir = tempfile.mkdtemp(prefix='gdptmp.')
-        else:
-            workdir = None
-            destination = args.destination
+    if jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(package_game, shortname)
+                    for shortname in sorted(todo)]
+
+            for future in futures:
+                future.result()
+    else:
+        for shortname in sorted(todo):
+            package_game(shortname)
+
+    all_debs = set()
 
-        debs = task.build_packages(ready,
-                compress=getattr(args, 'compress', True),
-                destination=destination)
-        rm_rf(os.path.join(task.get_workdir(), 'tmp'))
+    for shortname, debs in sorted(generated.items()):
+        all_debs |= debs
 
-        if preserve_debs:
-            for deb in debs:
+        if preserve_debs or jobs > 1:
+            for deb in sorted(debs):
                 print('generated "%s"' % os.path.abspath(deb))
-        all_debs = all_debs.union(debs)
+
+    if failed and jobs > 1:
+        logger.warning('Unable to package: %s', ', '.join(sorted(failed)))
+
+    if all_debs and getattr(args, 'repository', False):
+        # do this once at the end, so that concurrent jobs don't race
+        # to update the index
+        all_debs = packaging.update_repository(destination, all_debs)
 
     if not all_debs:
         logger.error('Unable to package any game.')
@@ -245,3 +434,74 @@ def run_steam_meta_mode(args, games):
         packaging.install_packages(all_debs, args.install_method, args.gain_root_command)
     if workdir:
         rm_rf(workdir)
+
+def lock_devices(paths_by_game):
+    """Given {game: [paths]}, return {game: [lock]} with one lock for
+    each physical disk that the game's files are on, shared between
+    games on the same disk, so that they are not read at the same time.
+
+    Each list is in the same order, so acquiring the locks in list order
+    can't deadlock.
+    """
+    # { physical device: lock }
+    device_locks = {}
+    ret = {}
+
+    for game, paths in paths_by_game.items():
+        devices = set()
+
+        for path in paths:
+            device = physical_device(path)
+
+            if device is not None:
+                devices.add(device)
+
+        for device in devices:
+            device_locks.setdefault(device, threading.Lock())
+
+        ret[game] = [device_locks[d] for d in sorted(devices, key=str)]
+
+    return ret
+
+def package_steam_game(task, args, packages, destination, locks=()):
+    """Look for the files for some packages of one Steam game and build
+    them into destination. Return the set of packages generated.
+
+    locks are held while reading the game's files (see lock_devices()),
+    but not while building the packages.
+    """
+    task.verbose = getattr(args, 'verbose', False)
+    task.save_downloads = args.save_downloads
+    task.destination = args.destination
+
+    for lock in locks:
+        lock.acquire()
+
+    try:
+        try:
+            task.look_for_files(binary_executables=args.binary_executables)
+        except BinaryExecutablesNotAllowed:
+            return set()
+        except NoPackagesPossible:
+            return set()
+
+        try:
+            ready = task.prepare_packages(log_immediately=False,
+                                          packages=packages)
+        except NoPackagesPossible:
+            logger.error('No package possible for %s.' %
+                    task.game.shortname)
+            return set()
+        except DownloadsFailed:
+            logger.error('Unable to complete any packages of %s'
+                         ' because downloads failed.' % task.game.shortname)
+            return set()
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+    debs = task.build_packages(ready,
+            compress=getattr(args, 'compress', True),
+            destination=destination)
+    rm_rf(os.path.join(task.get_workdir(), 'tmp'))
+    return set(debs)
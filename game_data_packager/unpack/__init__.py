@@ -25,6 +25,8 @@ import tarfile
 import time
 import zipfile
 
+from .tar_index import (TarIndex, TarMemberReader)
+
 class UnpackableEntry(metaclass=ABCMeta):
     """An entry in a StreamUnpackable.
     """
@@ -50,6 +52,13 @@ class UnpackableEntry(metaclass=ABCMeta):
         """
         return self.is_regular_file
 
+    @property
+    def crc32(self):
+        """The CRC32 of the contents as 8 lower-case hex digits, if the
+        archive records it, or None.
+        """
+        return None
+
     @property
     def mtime(self):
         """The last-modification time, or None if unspecified."""
@@ -174,6 +183,30 @@ class StreamUnpackable(metaclass=ABCMeta):
         """
         return False
 
+    def reopen(self):
+        """Return a new unpacker for the same archive, with its own file
+        handle, so that entries can be read from another thread; or
+        None if that is not possible. The caller is responsible for
+        closing it.
+
+        Entries from this unpacker may be passed to the new unpacker's
+        open().
+        """
+        return None
+
+    @property
+    def wants_prefetch(self):
+        """True if prefetch() should be called with the entries that are
+        going to be opened, before opening any of them.
+        """
+        return False
+
+    def prefetch(self, entries):
+        """Prepare to open the given entries, for instance by
+        extracting them all at once.
+        """
+        pass
+
 class WrapperUnpacker(StreamUnpackable):
     """Base class for a StreamUnpackable that wraps a TarFile-like object."""
 
@@ -231,10 +264,36 @@ class TarEntry(UnpackableEntry):
         return self.impl.size
 
 class TarUnpacker(WrapperUnpacker):
-    def __init__(self, name, reader=None, compression='*', skip=0):
+    def __init__(self, name, reader=None, compression='*', skip=0,
+            use_index=False, index_key=None, index=None):
+        """Open a tar archive for streaming.
+
+        If use_index is true and name is a regular file, its members are
+        recorded in a cache the first time we stream through it (see
+        tar_index.py). If that cache already exists, the unpacker becomes
+        seekable, listing the members does not decompress anything, and
+        opening a member only decompresses as far as that member.
+        index_key can be a hash of the archive, to share the cache between
+        copies of it. index can be a TarIndex that was already loaded.
+        """
         super(TarUnpacker, self).__init__()
         self.skip = skip
         self.compression = compression
+        self.__index = index
+        self.__stream = None
+
+        if index is not None:
+            assert index.members is not None
+            return
+
+        if use_index:
+            self.__index = TarIndex.for_archive(name, reader, skip,
+                    index_key)
+
+        if self.__index is not None and self.__index.load():
+            if reader is not None:
+                reader.close()
+            return
 
         if reader is None:
             reader = open(name, 'rb')
@@ -246,14 +305,67 @@ class TarUnpacker(WrapperUnpacker):
         self._impl = tarfile.open(name, mode='r|' + compression,
                 fileobj=reader)
 
+    def __iter__(self):
+        if self._impl is None:
+            # we have a complete index
+            for info in self.__index.members:
+                yield TarEntry(info)
+            return
+
+        if self.__index is None:
+            members = None
+        else:
+            members = []
+
+        for info in self._impl:
+            if members is not None:
+                members.append(info)
+
+            yield TarEntry(info)
+
+        if members is not None:
+            # we got to the end, so the index is complete
+            self.__index.save(members)
+
+    def __exit__(self, ex_type, ex_value, ex_traceback):
+        if self.__stream is not None:
+            self.__stream.close()
+            self.__stream = None
+
+        super(TarUnpacker, self).__exit__(ex_type, ex_value, ex_traceback)
+
     @property
     def format(self):
         return 'tar.' + self.compression
 
     def open(self, entry):
         assert isinstance(entry, TarEntry)
+
+        if self._impl is None:
+            if self.__stream is None:
+                self.__stream = self.__index.open_stream()
+
+            return TarMemberReader(self.__stream, entry.impl.offset_data,
+                    entry.impl.size)
+
         return self._impl.extractfile(entry.impl)
 
+    def seekable(self):
+        return self._impl is None
+
+    def reopen(self):
+        if self._impl is not None:
+            # still streaming through it
+            return None
+
+        if self.__index.compression not in ('gz', ''):
+            # without checkpoints, another bz2 or xz reader would
+            # decompress everything before its member all over again
+            return None
+
+        return TarUnpacker(self.__index.path, compression=self.compression,
+                skip=self.skip, index=self.__index)
+
     def _is_entry(self, entry):
         return isinstance(entry, TarEntry)
 
@@ -274,6 +386,10 @@ class ZipEntry(UnpackableEntry):
     def is_regular_file(self):
         return not self.name.endswith('/')
 
+    @property
+    def crc32(self):
+        return '%08x' % self.impl.CRC
+
     @property
     def mtime(self):
         return time.mktime(self.impl.date_time + (0, 0, -1))
@@ -295,6 +411,14 @@ class ZipUnpacker(WrapperUnpacker):
             # zip files based on an on-disk file are seekable
             self.__seekable = True
 
+        if isinstance(file_or_name, str):
+            self.__path = file_or_name
+        elif self.__seekable and isinstance(getattr(file_or_name, 'name',
+                None), str) and os.path.isfile(file_or_name.name):
+            self.__path = file_or_name.name
+        else:
+            self.__path = None
+
         self._impl = zipfile.ZipFile(file_or_name, 'r')
 
     def __iter__(self):
@@ -313,3 +437,9 @@ class ZipUnpacker(WrapperUnpacker):
 
     def seekable(self):
         return self.__seekable
+
+    def reopen(self):
+        if self.__path is None:
+            return None
+
+        return ZipUnpacker(self.__path)
@@ -79,11 +79,25 @@ def automatic_unpacker(archive, reader=None):
         if zipfile.is_zipfile(reader):
             return ZipUnpacker(reader)
 
+        from .cab import (Cab, is_cab)
+        if is_cab(reader):
+            return Cab(reader)
+
         if archive.endswith(('.umod', '.exe')):
             from .umod import (Umod, is_umod)
             if is_umod(reader):
                 return Umod(reader)
 
+        if archive.lower().endswith(('.lha', '.lzh', '.exe')):
+            from .lha import (Lha, is_lha)
+            if is_lha(reader):
+                try:
+                    return Lha(reader)
+                except ValueError:
+                    # something that looked like an LHA header, but
+                    # wasn't (NotLha is a ValueError)
+                    pass
+
     if is_plain_file and tarfile.is_tarfile(archive):
         return TarUnpacker(archive)
 
@@ -0,0 +1,1218 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+"""Reader for Microsoft Cabinet (.cab) archives.
+
+Uncompressed, MSZIP and LZX folders are decompressed here. Quantum
+folders are delegated to cabextract, which is asked for all the members
+that we want in a single run.
+
+A set of cabinets that continue into each other (Setup1.cab,
+Setup2.cab...) is read as one archive. The other cabinets are looked for
+next to the first, or can be passed as other_parts.
+"""
+
+import io
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import zlib
+
+from . import (StreamUnpackable, UnpackableEntry)
+
+logger = logging.getLogger(__name__)
+
+COMPRESS_NONE = 0
+COMPRESS_MSZIP = 1
+COMPRESS_QUANTUM = 2
+COMPRESS_LZX = 3
+
+_COMPRESSION_NAMES = {
+        COMPRESS_NONE: 'none',
+        COMPRESS_MSZIP: 'MSZIP',
+        COMPRESS_QUANTUM: 'Quantum',
+        COMPRESS_LZX: 'LZX',
+        }
+
+# CFHEADER.flags
+_FLAG_PREV_CABINET = 0x0001
+_FLAG_NEXT_CABINET = 0x0002
+_FLAG_RESERVE_PRESENT = 0x0004
+
+# special values of CFFILE.iFolder
+_IFOLD_CONTINUED_FROM_PREV = 0xfffd
+_IFOLD_CONTINUED_TO_NEXT = 0xfffe
+_IFOLD_CONTINUED_PREV_AND_NEXT = 0xffff
+
+# CFFILE.attribs
+_ATTRIB_NAME_IS_UTF = 0x80
+
+_MSZIP_WINDOW = 32768
+
+# Constants from the LZX format. The minimum match length is 2; the
+# main alphabet has 256 literals and 8 match length headers for each
+# position slot, the 8th meaning that the length continues in the
+# length alphabet. Code lengths are sent as deltas, using the 20-symbol
+# pretree. A cabinet's LZX folder is a series of frames of (normally)
+# 32K of output, each in its own data block.
+_LZX_MIN_MATCH = 2
+_LZX_NUM_CHARS = 256
+_LZX_NUM_PRIMARY_LENGTHS = 7
+_LZX_NUM_SECONDARY_LENGTHS = 249
+_LZX_PRETREE_SIZE = 20
+_LZX_ALIGNED_SIZE = 8
+
+_LZX_BLOCK_VERBATIM = 1
+_LZX_BLOCK_ALIGNED = 2
+_LZX_BLOCK_UNCOMPRESSED = 3
+
+# x86 CALL instructions are only translated in the first 1G of output
+_LZX_E8_MAX_FRAMES = 32768
+
+# { log2(window size): number of position slots }
+_LZX_POSITION_SLOTS = {15: 30, 16: 32, 17: 34, 18: 36, 19: 38, 20: 42,
+        21: 50}
+
+def _make_lzx_position_tables():
+    extra_bits = []
+    position_base = []
+    bits = 0
+    base = 0
+
+    # 0, 0, 0, 0, 1, 1, 2, 2, ... 16, 16, 17, 17, 17...
+    for i in range(max(_LZX_POSITION_SLOTS.values())):
+        extra_bits.append(bits)
+        position_base.append(base)
+        base += 1 << bits
+
+        if i & 1 and i > 1 and bits < 17:
+            bits += 1
+
+    return extra_bits, position_base
+
+_LZX_EXTRA_BITS, _LZX_POSITION_BASE = _make_lzx_position_tables()
+
+class NotCab(ValueError):
+    pass
+
+def _dos_time(date, time_):
+    try:
+        return time.mktime((1980 + (date >> 9), (date >> 5) & 0x0f,
+            date & 0x1f, time_ >> 11, (time_ >> 5) & 0x3f,
+            (time_ & 0x1f) * 2, 0, 0, -1))
+    except (OverflowError, ValueError):
+        return None
+
+def _read_asciiz(reader):
+    ret = b''
+
+    while True:
+        c = reader.read(1)
+
+        if not c:
+            raise ValueError('unexpected end of cabinet header')
+
+        if c == b'\0':
+            return ret
+
+        ret += c
+
+def _cabinet_key(cabinet):
+    if isinstance(cabinet.name, str) and os.path.isfile(cabinet.name):
+        return os.path.realpath(cabinet.name)
+
+    return id(cabinet.reader)
+
+def find_sibling(name, near):
+    """Return the path to the cabinet name in the same directory as
+    the cabinet near, or None.
+    """
+    if near is None:
+        return None
+
+    name = name.replace('\\', '/').split('/')[-1]
+    directory = os.path.dirname(near)
+    path = os.path.join(directory, name)
+
+    if os.path.isfile(path):
+        return path
+
+    # cabinets usually come from case-insensitive filesystems
+    try:
+        for candidate in os.listdir(directory or '.'):
+            if candidate.lower() == name.lower():
+                return os.path.join(directory, candidate)
+    except OSError:
+        pass
+
+    return None
+
+class _Cabinet(object):
+    """One file in a set of cabinets."""
+
+    def __init__(self, name, reader):
+        self.name = name
+        self.reader = reader
+
+        header = reader.read(36)
+
+        if len(header) != 36 or header[:4] != b'MSCF':
+            raise NotCab('"%s" is not a cabinet' % name)
+
+        (self.size, self.files_offset, minor, major, n_folders, n_files,
+                self.flags, self.set_id, self.index) = struct.unpack(
+                        '<8xI4xI4xBBHHHHH', header)
+
+        if major != 1:
+            raise ValueError('"%s": unsupported cabinet version %d.%d' %
+                    (name, major, minor))
+
+        if self.flags & _FLAG_RESERVE_PRESENT:
+            header_reserve, folder_reserve, self.data_reserve = (
+                    struct.unpack('<HBB', reader.read(4)))
+            reader.seek(header_reserve, io.SEEK_CUR)
+        else:
+            folder_reserve = 0
+            self.data_reserve = 0
+
+        if self.flags & _FLAG_PREV_CABINET:
+            self.prev_name = _read_asciiz(reader).decode('cp1252')
+            _read_asciiz(reader)
+        else:
+            self.prev_name = None
+
+        if self.flags & _FLAG_NEXT_CABINET:
+            self.next_name = _read_asciiz(reader).decode('cp1252')
+            _read_asciiz(reader)
+        else:
+            self.next_name = None
+
+        # [(offset of first CFDATA, number of CFDATA, compression)]
+        self.folders = []
+
+        for i in range(n_folders):
+            self.folders.append(struct.unpack('<IHH', reader.read(8)))
+            reader.seek(folder_reserve, io.SEEK_CUR)
+
+        # [(size, offset in folder, folder index, date, time, attribs,
+        #   name)]
+        self.files = []
+        reader.seek(self.files_offset)
+
+        for i in range(n_files):
+            fields = struct.unpack('<IIHHHH', reader.read(16))
+            name = _read_asciiz(reader)
+
+            if fields[5] & _ATTRIB_NAME_IS_UTF:
+                name = name.decode('utf-8')
+            else:
+                name = name.decode('cp1252')
+
+            self.files.append(fields + (name,))
+
+    def iter_data_blocks(self, folder_index):
+        """Yield (cabinet, offset of compressed data, compressed size,
+        uncompressed size) for each CFDATA in the folder.
+        """
+        offset, n_blocks, compression = self.folders[folder_index]
+
+        for i in range(n_blocks):
+            self.reader.seek(offset)
+            checksum, compressed_size, size = struct.unpack('<IHH',
+                    self.reader.read(8))
+            offset += 8 + self.data_reserve
+            yield (self, offset, compressed_size, size)
+            offset += compressed_size
+
+class CabFolder(object):
+    """A folder (compressed stream) in a set of cabinets, possibly
+    spanning more than one cabinet.
+    """
+
+    def __init__(self, compression):
+        self.compression = compression & 0x000f
+        # LZX keeps log2(window size) in the high byte
+        self.window_bits = (compression >> 8) & 0x1f
+        # [(cabinet, folder index in that cabinet)]
+        self.parts = []
+
+    @property
+    def is_native(self):
+        """True if we can decompress this folder without cabextract."""
+        return self.compression in (COMPRESS_NONE, COMPRESS_MSZIP,
+                COMPRESS_LZX)
+
+    def iter_blocks(self):
+        """Yield (compressed data, uncompressed size) for each block.
+        Blocks that were split across cabinets are joined up.
+        """
+        pending = b''
+
+        for cabinet, folder_index in self.parts:
+            for cabinet, offset, compressed_size, size in (
+                    cabinet.iter_data_blocks(folder_index)):
+                cabinet.reader.seek(offset)
+                data = cabinet.reader.read(compressed_size)
+
+                if len(data) != compressed_size:
+                    raise ValueError('"%s" is truncated' % cabinet.name)
+
+                if size == 0:
+                    # continued in the next cabinet
+                    pending += data
+                    continue
+
+                yield pending + data, size
+                pending = b''
+
+        if pending:
+            raise ValueError('last data block of cabinet set is incomplete')
+
+class _LzxBitReader(object):
+    """Read bit fields from the compressed data for one LZX frame. The
+    data is a series of little-endian 16-bit words, each read starting
+    from its most significant bit. Reading past the end yields zero bits.
+
+    As in unpack.lha, the next bitcount bits of input are the low bits
+    of bitbuf, and the decoder's inner loop manipulates these directly.
+    """
+
+    def __init__(self, data):
+        self.__load(data)
+
+    def __load(self, data):
+        self.__data = data
+        self.__size = len(data)
+
+        if len(data) & 1:
+            data += b'\0'
+
+        # swap each pair of bytes so that we can read it big-endian
+        swapped = bytearray(len(data))
+        swapped[0::2] = data[1::2]
+        swapped[1::2] = data[0::2]
+        self.__swapped = bytes(swapped)
+        self.__pos = 0
+        self.bitbuf = 0
+        self.bitcount = 0
+
+    def fill(self, n):
+        """Make sure at least n bits are available."""
+        bitbuf = self.bitbuf & ((1 << self.bitcount) - 1)
+
+        while self.bitcount < n:
+            # take up to 4 words at a time
+            take = self.__swapped[self.__pos:self.__pos + 8] or bytes(8)
+            self.__pos += len(take)
+            bitbuf = (bitbuf << (8 * len(take))) | int.from_bytes(take, 'big')
+            self.bitcount += 8 * len(take)
+
+        self.bitbuf = bitbuf
+
+    def getbits(self, n):
+        if n == 0:
+            return 0
+
+        if self.bitcount < n:
+            self.fill(n)
+
+        self.bitcount -= n
+        return (self.bitbuf >> self.bitcount) & ((1 << n) - 1)
+
+    def decode(self, table):
+        """Decode one symbol using a table from _make_lzx_table()."""
+        lookup, bits = table
+
+        if self.bitcount < bits:
+            self.fill(bits)
+
+        symbol, length = lookup[(self.bitbuf >> (self.bitcount - bits)) &
+                ((1 << bits) - 1)]
+
+        if length == 0:
+            raise ValueError('invalid Huffman code in LZX data')
+
+        self.bitcount -= length
+        return symbol
+
+    def align(self):
+        """Skip 1 to 16 bits to reach the start of a 16-bit word, as
+        done before an uncompressed block.
+        """
+        if self.bitcount < 16:
+            self.fill(16)
+
+        self.bitcount -= (self.bitcount & 15) or 16
+
+    def bytes_left(self):
+        return max(0, self.__size - self.__pos + self.bitcount // 8)
+
+    def read_bytes(self, n):
+        """Read n bytes from the current position, which must be at a
+        byte boundary. The words that follow start after them, even if
+        that is an odd number of bytes into the frame.
+        """
+        assert self.bitcount % 8 == 0
+        position = max(0, self.__pos - self.bitcount // 8)
+        ret = self.__data[position:position + n]
+        self.__load(self.__data[position + n:])
+        return ret
+
+def _make_lzx_table(lengths):
+    """Return a lookup table for the canonical Huffman code in which
+    symbol i has code length lengths[i] (0 meaning unused), or None if
+    no symbols are used.
+
+    The table is a tuple (lookup, bits) such that if the next bits
+    bits of input are n, lookup[n] is (symbol, code length).
+    """
+    bits = max(lengths)
+
+    if bits == 0:
+        return None
+
+    lookup = [(0, 0)] * (1 << bits)
+    code = 0
+
+    for length in range(1, bits + 1):
+        for symbol, symbol_length in enumerate(lengths):
+            if symbol_length != length:
+                continue
+
+            span = 1 << (bits - length)
+            start = code << (bits - length)
+
+            if start + span > len(lookup):
+                raise ValueError('oversubscribed Huffman code in LZX data')
+
+            lookup[start:start + span] = [(symbol, length)] * span
+            code += 1
+
+        code <<= 1
+
+    return (lookup, bits)
+
+def _lzx_e8_translate(data, position, file_size):
+    """Undo the encoder's translation of the targets of x86 CALL
+    instructions (E8 xx xx xx xx) from relative to absolute, in a frame
+    of output that starts at position.
+    """
+    end = len(data) - 10
+    i = data.find(0xe8, 0, end)
+
+    if i < 0:
+        return data
+
+    out = bytearray(data)
+
+    while i >= 0:
+        absolute = int.from_bytes(out[i + 1:i + 5], 'little', signed=True)
+        current = position + i
+
+        if -current <= absolute < file_size:
+            if absolute >= 0:
+                relative = absolute - current
+            else:
+                relative = absolute + file_size
+
+            out[i + 1:i + 5] = (relative & 0xffffffff).to_bytes(4, 'little')
+
+        i = data.find(0xe8, i + 5, end)
+
+    return bytes(out)
+
+class _LzxDecoder(object):
+    """Decompress the frames of an LZX folder in order. The window,
+    Huffman code lengths and repeated offsets carry on from one frame
+    to the next.
+    """
+
+    def __init__(self, window_bits):
+        if window_bits not in _LZX_POSITION_SLOTS:
+            raise ValueError('unsupported LZX window size 2**%d' %
+                    window_bits)
+
+        self.__window_size = 1 << window_bits
+        self.__main_size = (_LZX_NUM_CHARS +
+                _LZX_POSITION_SLOTS[window_bits] * 8)
+        self.__window = bytearray()
+        self.__main_lengths = [0] * self.__main_size
+        self.__length_lengths = [0] * _LZX_NUM_SECONDARY_LENGTHS
+        self.__main_table = None
+        self.__length_table = None
+        self.__aligned_table = None
+        self.__repeated = (1, 1, 1)
+        self.__block_type = None
+        self.__block_length = 0
+        self.__block_remaining = 0
+        self.__skip_padding = False
+        self.__header_read = False
+        self.__e8_file_size = 0
+        self.__frames = 0
+        self.__position = 0
+
+    def decompress(self, data, size):
+        """Return the size bytes of output from the next frame, whose
+        compressed form is data.
+        """
+        bits = _LzxBitReader(data)
+        window = self.__window
+        start = len(window)
+        end = start + size
+
+        if not self.__header_read:
+            if bits.getbits(1):
+                high = bits.getbits(16)
+                self.__e8_file_size = (high << 16) | bits.getbits(16)
+
+                if self.__e8_file_size >= 1 << 31:
+                    self.__e8_file_size -= 1 << 32
+
+            self.__header_read = True
+
+        while len(window) < end:
+            if self.__block_remaining == 0:
+                self.__read_block_header(bits)
+
+            run = min(self.__block_remaining, end - len(window))
+
+            if self.__block_type == _LZX_BLOCK_UNCOMPRESSED:
+                chunk = bits.read_bytes(run)
+
+                if len(chunk) != run:
+                    raise ValueError('LZX data is truncated')
+
+                window += chunk
+            else:
+                self.__decode(bits, window, run)
+
+            self.__block_remaining -= run
+
+            if (self.__block_remaining == 0 and
+                    self.__block_type == _LZX_BLOCK_UNCOMPRESSED and
+                    self.__block_length & 1):
+                # an uncompressed block is padded to a 16-bit boundary
+                if bits.bytes_left():
+                    bits.read_bytes(1)
+                else:
+                    self.__skip_padding = True
+
+        out = bytes(window[start:end])
+
+        if (self.__e8_file_size and self.__frames < _LZX_E8_MAX_FRAMES
+                and size > 10):
+            out = _lzx_e8_translate(out, self.__position,
+                    self.__e8_file_size)
+
+        self.__frames += 1
+        self.__position += size
+        del window[:-self.__window_size]
+        return out
+
+    def __read_block_header(self, bits):
+        if self.__skip_padding:
+            bits.read_bytes(1)
+            self.__skip_padding = False
+
+        self.__block_type = bits.getbits(3)
+        high = bits.getbits(16)
+        self.__block_length = (high << 8) | bits.getbits(8)
+        self.__block_remaining = self.__block_length
+
+        if self.__block_type == _LZX_BLOCK_UNCOMPRESSED:
+            bits.align()
+            header = bits.read_bytes(12)
+
+            if len(header) != 12:
+                raise ValueError('LZX data is truncated')
+
+            self.__repeated = struct.unpack('<III', header)
+            return
+
+        if self.__block_type == _LZX_BLOCK_ALIGNED:
+            self.__aligned_table = _make_lzx_table([bits.getbits(3)
+                for i in range(_LZX_ALIGNED_SIZE)])
+
+            if self.__aligned_table is None:
+                raise ValueError('empty aligned offset tree in LZX data')
+        elif self.__block_type != _LZX_BLOCK_VERBATIM:
+            raise ValueError('unknown LZX block type %d' %
+                    self.__block_type)
+
+        self.__read_lengths(bits, self.__main_lengths, 0, _LZX_NUM_CHARS)
+        self.__read_lengths(bits, self.__main_lengths, _LZX_NUM_CHARS,
+                self.__main_size)
+        self.__read_lengths(bits, self.__length_lengths, 0,
+                _LZX_NUM_SECONDARY_LENGTHS)
+        self.__main_table = _make_lzx_table(self.__main_lengths)
+        # this one is empty if there are no long matches
+        self.__length_table = _make_lzx_table(self.__length_lengths)
+
+        if self.__main_table is None:
+            raise ValueError('empty main tree in LZX data')
+
+    def __read_lengths(self, bits, lengths, first, last):
+        """Update lengths[first:last], which are sent as differences
+        from the previous block's lengths, encoded with a pretree.
+        """
+        pretree = _make_lzx_table([bits.getbits(4)
+            for i in range(_LZX_PRETREE_SIZE)])
+
+        if pretree is None:
+            raise ValueError('empty pretree in LZX data')
+
+        x = first
+
+        while x < last:
+            code = bits.decode(pretree)
+
+            if code == 17:
+                run = bits.getbits(4) + 4
+                value = 0
+            elif code == 18:
+                run = bits.getbits(5) + 20
+                value = 0
+            elif code == 19:
+                run = bits.getbits(1) + 4
+                value = (lengths[x] - bits.decode(pretree)) % 17
+            else:
+                run = 1
+                value = (lengths[x] - code) % 17
+
+            # a run may spill over into the next range, but not off the
+            # end of the tree
+            lengths[x:x + run] = [value] * (min(x + run, len(lengths)) - x)
+            x += run
+
+    def __decode(self, bits, window, count):
+        """Decode count bytes of a verbatim or aligned offset block
+        into window.
+        """
+        target = len(window) + count
+        aligned = (self.__block_type == _LZX_BLOCK_ALIGNED)
+        extra_bits_table = _LZX_EXTRA_BITS
+        position_base = _LZX_POSITION_BASE
+        r0, r1, r2 = self.__repeated
+
+        # This is the hot loop, so it is written out in full with local
+        # variables, as in unpack.lha.
+        main_lookup, main_bits = self.__main_table
+        main_mask = (1 << main_bits) - 1
+
+        if self.__length_table is None:
+            length_lookup, length_bits = None, 0
+        else:
+            length_lookup, length_bits = self.__length_table
+
+        length_mask = (1 << length_bits) - 1
+
+        if aligned:
+            aligned_lookup, aligned_bits = self.__aligned_table
+            aligned_mask = (1 << aligned_bits) - 1
+
+        bitbuf = bits.bitbuf
+        bitcount = bits.bitcount
+
+        while len(window) < target:
+            # enough for the longest main code, length code, verbatim
+            # bits and aligned offset code
+            if bitcount < 64:
+                bits.bitbuf = bitbuf
+                bits.bitcount = bitcount
+                bits.fill(64)
+                bitbuf = bits.bitbuf
+                bitcount = bits.bitcount
+
+            symbol, length = main_lookup[(bitbuf >> (bitcount - main_bits)) &
+                    main_mask]
+
+            if not length:
+                raise ValueError('invalid Huffman code in LZX data')
+
+            bitcount -= length
+
+            if symbol < _LZX_NUM_CHARS:
+                window.append(symbol)
+                continue
+
+            symbol -= _LZX_NUM_CHARS
+            match_length = symbol & 7
+
+            if match_length == _LZX_NUM_PRIMARY_LENGTHS:
+                if length_lookup is None:
+                    raise ValueError('LZX match length tree is empty')
+
+                footer, length = length_lookup[(bitbuf >>
+                    (bitcount - length_bits)) & length_mask]
+
+                if not length:
+                    raise ValueError('invalid Huffman code in LZX data')
+
+                bitcount -= length
+                match_length += footer
+
+            match_length += _LZX_MIN_MATCH
+            slot = symbol >> 3
+
+            if slot > 2:
+                extra = extra_bits_table[slot]
+                offset = position_base[slot] - 2
+
+                if aligned and extra >= 3:
+                    if extra > 3:
+                        bitcount -= extra - 3
+                        offset += ((bitbuf >> bitcount) &
+                                ((1 << (extra - 3)) - 1)) << 3
+
+                    footer, length = aligned_lookup[(bitbuf >>
+                        (bitcount - aligned_bits)) & aligned_mask]
+
+                    if not length:
+                        raise ValueError('invalid Huffman code in LZX data')
+
+                    bitcount -= length
+                    offset += footer
+                elif extra:
+                    bitcount -= extra
+                    offset += (bitbuf >> bitcount) & ((1 << extra) - 1)
+                else:
+                    offset = 1
+
+                r0, r1, r2 = offset, r0, r1
+            elif slot == 0:
+                offset = r0
+            elif slot == 1:
+                offset = r1
+                r0, r1 = r1, r0
+            else:
+                offset = r2
+                r0, r2 = r2, r0
+
+            source = len(window) - offset
+
+            if source < 0:
+                raise ValueError('LZX match offset out of range')
+
+            if len(window) + match_length > target:
+                raise ValueError('LZX match runs past the end of a block '
+                        'or frame')
+
+            if offset >= match_length:
+                window += window[source:source + match_length]
+            else:
+                # the match overlaps its own output, so it repeats
+                period = window[source:]
+                window += (period * (match_length // offset + 1))[
+                        :match_length]
+
+        bits.bitbuf = bitbuf
+        bits.bitcount = bitcount
+        self.__repeated = (r0, r1, r2)
+
+class _FolderReader(io.RawIOBase):
+    """The decompressed contents of a CabFolder, read sequentially."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.__blocks = folder.iter_blocks()
+        self.__buffer = b''
+        self.__position = 0
+        self.__history = b''
+        self.__lzx = None
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.__position
+
+    def __next_block(self):
+        try:
+            data, size = next(self.__blocks)
+        except StopIteration:
+            return False
+
+        if self.folder.compression == COMPRESS_NONE:
+            out = data
+        elif self.folder.compression == COMPRESS_MSZIP:
+            if data[:2] != b'CK':
+                raise ValueError('bad MSZIP block signature')
+
+            # each block is a complete deflate stream, but can refer back
+            # to the previous block's output
+            if self.__history:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS,
+                        zdict=self.__history)
+            else:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+            out = decompressor.decompress(data[2:]) + decompressor.flush()
+            self.__history = (self.__history + out)[-_MSZIP_WINDOW:]
+        elif self.folder.compression == COMPRESS_LZX:
+            if self.__lzx is None:
+                self.__lzx = _LzxDecoder(self.folder.window_bits)
+
+            out = self.__lzx.decompress(data, size)
+        else:
+            raise NotImplementedError('cannot decompress %s folders' %
+                    _COMPRESSION_NAMES.get(self.folder.compression,
+                        self.folder.compression))
+
+        if len(out) != size:
+            raise ValueError('cabinet data block decompressed to %d bytes, '
+                    'expected %d' % (len(out), size))
+
+        self.__buffer += out
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self.__next_block():
+                pass
+
+            size = len(self.__buffer)
+
+        while len(self.__buffer) < size:
+            if not self.__next_block():
+                break
+
+        ret = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        self.__position += len(ret)
+        return ret
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def skip_to(self, position):
+        assert position >= self.__position
+
+        while self.__position < position:
+            if not self.read(min(position - self.__position,
+                    _MSZIP_WINDOW)):
+                raise ValueError('cabinet folder is shorter than expected')
+
+class CabEntryFile(io.BufferedIOBase):
+    """File-like object allowing a member to be read from a cabinet.
+
+    Each Cab can have at most one CabEntryFile open at a time.
+    """
+
+    def __init__(self, folder_reader, entry):
+        self.entry = entry
+        self.__folder_reader = folder_reader
+        self.__remaining = entry.size
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        if size is None or size < 0 or size > self.__remaining:
+            size = self.__remaining
+
+        if size <= 0:
+            return b''
+
+        ret = self.__folder_reader.read(size)
+
+        if len(ret) != size:
+            raise ValueError('"%s" is truncated' % self.entry.name)
+
+        self.__remaining -= len(ret)
+        return ret
+
+    def read1(self, size=-1):
+        """read1() is the same as read() for this class."""
+        return self.read(size)
+
+class CabEntry(UnpackableEntry):
+    """A file in a set of cabinets."""
+
+    def __init__(self, name, size, folder, offset, mtime, attribs):
+        self._name = name.replace('\\', '/')
+        self._size = size
+        self.folder = folder
+        # offset in the decompressed folder
+        self.offset = offset
+        self._mtime = mtime
+        self.attribs = attribs
+
+    def __repr__(self):
+        return '<%s "%s" size=%d offset=%d>' % (self.__class__.__name__,
+                self.name, self.size, self.offset)
+
+    @property
+    def is_directory(self):
+        return False
+
+    @property
+    def is_regular_file(self):
+        return True
+
+    @property
+    def is_extractable(self):
+        return self.folder is not None
+
+    @property
+    def mtime(self):
+        return self._mtime
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def size(self):
+        return self._size
+
+class Cab(StreamUnpackable):
+    """Object representing a Microsoft Cabinet file, or a set of them.
+
+    The API of this class is similar to tarfile.TarFile and zipfile.ZipFile.
+    """
+
+    def __init__(self, path_or_file, other_parts=(), find_part=None,
+            tmpdir=None):
+        """Constructor.
+
+        path_or_file and each of other_parts may be a string or a
+        seekable file object open in binary mode. If given, other_parts
+        are the cabinets that follow this one in a set.
+
+        If the set continues before or after the cabinets we were given,
+        find_part(name, near) is called with the name of the missing
+        cabinet and the path to the cabinet that refers to it (or None
+        if it is not a file on disk). It may return the path to the
+        missing cabinet, or None. The default is to look for it in the
+        same directory.
+
+        Members of Quantum folders are extracted by cabextract into a
+        temporary directory below tmpdir.
+        """
+        self.__to_close = []
+        self.__cabinets = []
+        self.__reader = None
+        self.__tmpdir_parent = tmpdir
+        self.__tmpdir = None
+        # { CabEntry: path to which cabextract extracted it }
+        self.__extracted = {}
+        self.entries = []
+
+        if find_part is None:
+            find_part = find_sibling
+
+        try:
+            for part in (path_or_file,) + tuple(other_parts):
+                self.__cabinets.append(self.__open_cabinet(part))
+
+            self.name = self.__cabinets[0].name
+            self.__find_other_parts(find_part)
+            self.__load()
+        except:
+            self.__exit__(None, None, None)
+            raise
+
+    def __open_cabinet(self, part):
+        if isinstance(part, str):
+            name = part
+            reader = open(part, 'rb')
+            self.__to_close.append(reader)
+        else:
+            name = getattr(part, 'name', repr(part))
+            reader = part
+            reader.seek(0)
+
+        return _Cabinet(name, reader)
+
+    def __find_other_parts(self, find_part):
+        seen = set(_cabinet_key(c) for c in self.__cabinets)
+
+        def find(cabinet, name):
+            if isinstance(cabinet.name, str) and os.path.isfile(
+                    cabinet.name):
+                near = cabinet.name
+            else:
+                near = None
+
+            path = find_part(name, near)
+
+            if path is None:
+                logger.debug('cabinet "%s" continues in "%s", which we do '
+                        'not have', cabinet.name, name)
+                return None
+
+            if os.path.realpath(path) in seen:
+                return None
+
+            seen.add(os.path.realpath(path))
+            return self.__open_cabinet(path)
+
+        while self.__cabinets[0].prev_name is not None:
+            cabinet = find(self.__cabinets[0], self.__cabinets[0].prev_name)
+
+            if cabinet is None:
+                break
+
+            self.__cabinets.insert(0, cabinet)
+
+        while self.__cabinets[-1].next_name is not None:
+            cabinet = find(self.__cabinets[-1], self.__cabinets[-1].next_name)
+
+            if cabinet is None:
+                break
+
+            self.__cabinets.append(cabinet)
+
+    def __load(self):
+        previous = None
+
+        for cabinet in self.__cabinets:
+            folders = []
+
+            for i, (offset, n_blocks, compression) in enumerate(
+                    cabinet.folders):
+                if (i == 0 and previous is not None and
+                        cabinet.flags & _FLAG_PREV_CABINET):
+                    # continuation of the previous cabinet's last folder
+                    folder = previous
+                else:
+                    folder = CabFolder(compression)
+
+                folder.parts.append((cabinet, i))
+                folders.append(folder)
+
+            for (size, offset, folder_index, date, time_, attribs,
+                    name) in cabinet.files:
+                if folder_index in (_IFOLD_CONTINUED_FROM_PREV,
+                        _IFOLD_CONTINUED_PREV_AND_NEXT):
+                    if cabinet is not self.__cabinets[0]:
+                        # we already listed it in the previous cabinet
+                        continue
+
+                    # we don't have the start of it
+                    folder = None
+                elif folder_index == _IFOLD_CONTINUED_TO_NEXT:
+                    if cabinet.next_name is None or not folders:
+                        folder = None
+                    elif cabinet is self.__cabinets[-1]:
+                        logger.debug('%s continues in %s, which we do not '
+                                'have', name, cabinet.next_name)
+                        folder = None
+                    else:
+                        folder = folders[-1]
+                elif folder_index < len(folders):
+                    folder = folders[folder_index]
+                else:
+                    raise ValueError('"%s": file "%s" is in folder %d, '
+                            'which does not exist' % (cabinet.name, name,
+                                folder_index))
+
+                self.entries.append(CabEntry(name, size, folder, offset,
+                    _dos_time(date, time_), attribs))
+
+            if folders:
+                previous = folders[-1]
+            else:
+                previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _et, _ev, _tb):
+        for reader in self.__to_close:
+            reader.close()
+
+        self.__to_close = []
+
+        if self.__tmpdir is not None:
+            shutil.rmtree(self.__tmpdir, ignore_errors=True)
+            self.__tmpdir = None
+            self.__extracted = {}
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield entry
+
+    @property
+    def needs_cabextract(self):
+        """True if some of the folders use a compression method that we
+        cannot decompress ourselves.
+        """
+        for entry in self.entries:
+            if entry.folder is not None and not entry.folder.is_native:
+                return True
+
+        return False
+
+    @property
+    def wants_prefetch(self):
+        return self.needs_cabextract
+
+    def prefetch(self, entries):
+        """Extract the members of Quantum folders among entries with a
+        single run of cabextract, so that open() can return them.
+        """
+        entries = [e for e in entries
+                if e.folder is not None and not e.folder.is_native and
+                e not in self.__extracted]
+
+        if not entries:
+            return
+
+        for cabinet in self.__cabinets:
+            if not isinstance(cabinet.name, str) or not os.path.isfile(
+                    cabinet.name):
+                logger.debug('cannot run cabextract on "%s", which is not '
+                        'a file', cabinet.name)
+                return
+
+        if self.__tmpdir is None:
+            self.__tmpdir = tempfile.mkdtemp(prefix='gdp-cab.',
+                    dir=self.__tmpdir_parent)
+
+        out = tempfile.mkdtemp(dir=self.__tmpdir)
+
+        # cabextract follows the set by looking for each next_name in
+        # the same directory as the first cabinet, but ours might have
+        # different names (Setup3.cab?en) or be in different places
+        first = self.__cabinets[0].name
+
+        if len(self.__cabinets) > 1:
+            cabinets = tempfile.mkdtemp(dir=self.__tmpdir)
+            first = os.path.join(cabinets, os.path.basename(first))
+            os.symlink(os.path.abspath(self.__cabinets[0].name), first)
+
+            for previous, cabinet in zip(self.__cabinets,
+                    self.__cabinets[1:]):
+                if previous.next_name is None:
+                    break
+
+                link = os.path.join(cabinets,
+                        previous.next_name.replace('\\', '/').split('/')[-1])
+
+                if not os.path.lexists(link):
+                    os.symlink(os.path.abspath(cabinet.name), link)
+
+        argv = ['cabextract', '-q', '-d', out]
+
+        for entry in entries:
+            # cabextract matches the pattern against names with
+            # backslashes, and interprets glob characters: use ? for
+            # both. Anything else that this matches is ignored.
+            argv.append('-F')
+            argv.append(''.join(c if c not in '/\\*?[]' else '?'
+                for c in entry.name))
+
+        argv.append(first)
+        logger.debug('%r', argv)
+
+        if subprocess.call(argv) != 0:
+            logger.warning('cabextract did not extract everything from '
+                    '"%s"', self.name)
+
+        for entry in entries:
+            path = os.path.join(out, entry.name.lstrip('/'))
+
+            if os.path.isfile(path) and os.path.getsize(path) == entry.size:
+                self.__extracted[entry] = path
+
+    def open(self, member):
+        """Open a binary file-like object for the given filename or CabEntry.
+        """
+        if isinstance(member, str):
+            entry = self.getinfo(member)
+        else:
+            entry = member
+
+        assert isinstance(entry, CabEntry)
+
+        if entry.folder is None:
+            raise ValueError('"%s" starts in another cabinet' % entry.name)
+
+        if not entry.folder.is_native:
+            if entry not in self.__extracted:
+                self.prefetch([entry])
+
+            if entry not in self.__extracted:
+                raise NotImplementedError('cannot decompress "%s" from '
+                        '%s folder' % (entry.name, _COMPRESSION_NAMES.get(
+                            entry.folder.compression,
+                            entry.folder.compression)))
+
+            return open(self.__extracted[entry], 'rb')
+
+        # Carry on from where we are if possible, otherwise start
+        # decompressing the folder from the beginning
+        if (self.__reader is None or self.__reader.folder is not entry.folder
+                or self.__reader.tell() > entry.offset):
+            self.__reader = _FolderReader(entry.folder)
+
+        self.__reader.skip_to(entry.offset)
+        return CabEntryFile(self.__reader, entry)
+
+    def getinfo(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+
+        raise KeyError(name)
+
+    def infolist(self):
+        return list(self.entries)
+
+    def namelist(self):
+        return [x.name for x in self.entries]
+
+    @property
+    def format(self):
+        return 'cabextract'
+
+    def seekable(self):
+        return True
+
+def is_cab(path_or_file):
+    if isinstance(path_or_file, str):
+        with open(path_or_file, 'rb') as reader:
+            return reader.read(4) == b'MSCF'
+
+    path_or_file.seek(0)
+    return path_or_file.read(4) == b'MSCF'
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', '-o', help='extract to OUTPUT',
+            default=None)
+    parser.add_argument('cab')
+    parser.add_argument('other_parts', nargs='*')
+    args = parser.parse_args()
+
+    with Cab(args.cab, args.other_parts) as cab:
+        if args.output:
+            cab.extractall(args.output)
+        else:
+            cab.printdir()
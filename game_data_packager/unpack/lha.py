@@ -0,0 +1,796 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+"""Reader for LHA (.lzh) archives, including self-extracting .exe files.
+
+Header levels 0, 1 and 2 are supported, with the -lh0- (stored), -lh4-,
+-lh5-, -lh6- and -lh7- methods, which covers the archives that are
+likely to contain game data.
+"""
+
+import io
+import logging
+import re
+import struct
+import time
+
+from . import (StreamUnpackable, UnpackableEntry)
+
+logger = logging.getLogger(__name__)
+
+# Self-extracting archives have an executable stub before the first
+# header. Look this far into the file for it.
+MAX_SFX_STUB = 256 * 1024
+
+# Matches the compression method at offset 2 of a header
+_METHOD_RE = re.compile(br'-(?:lh[0-7d]|lz[s45])-')
+
+# { method: log2(dictionary size) } for the -lh4- family
+_LZH_DICTIONARY_BITS = {
+        b'-lh4-': 12,
+        b'-lh5-': 13,
+        b'-lh6-': 15,
+        b'-lh7-': 16,
+        }
+
+_STORED_METHODS = (b'-lh0-', b'-lz4-')
+
+# Constants from the LHA format: the maximum match length is 256, the
+# minimum is 3; there are 510 symbols in the main alphabet (256
+# literals and 254 match lengths), and 19 symbols in the alphabet used
+# to encode its code lengths
+_MIN_MATCH = 3
+_NC = 256 + 256 + 2 - _MIN_MATCH
+_NT = 19
+_CBIT = 9
+_TBIT = 5
+
+# Extended header types
+_EXT_FILENAME = 0x01
+_EXT_DIRNAME = 0x02
+_EXT_UNIX_MTIME = 0x54
+
+def _make_crc16_table():
+    table = []
+
+    for i in range(256):
+        crc = i
+
+        for j in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xa001
+            else:
+                crc >>= 1
+
+        table.append(crc)
+
+    return table
+
+_CRC16_TABLE = _make_crc16_table()
+
+def crc16(data, crc=0):
+    """The CRC-16 (polynomial 0x8005, reflected, as used by ARC and LHA)
+    of data, continuing from crc.
+    """
+    table = _CRC16_TABLE
+
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+
+    return crc
+
+def _dos_time(value):
+    """Convert an MS-DOS date and time to a Unix timestamp."""
+    t = value & 0xffff
+    d = value >> 16
+
+    try:
+        return time.mktime((1980 + (d >> 9), (d >> 5) & 0x0f, d & 0x1f,
+            t >> 11, (t >> 5) & 0x3f, (t & 0x1f) * 2, 0, 0, -1))
+    except (OverflowError, ValueError):
+        return None
+
+class _BitReader(object):
+    """Read big-endian bit fields from size bytes of reader. Reading
+    past the end yields zero bits, as in the reference implementation.
+
+    The next bitcount bits of input are the low bits of bitbuf (any
+    higher bits are garbage). The decoder's inner loop manipulates
+    these directly, calling fill() when it runs low.
+    """
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, reader, size):
+        self.__reader = reader
+        self.__remaining = size
+        self.__data = b''
+        self.__pos = 0
+        self.bitbuf = 0
+        self.bitcount = 0
+
+    def fill(self, n):
+        """Make sure at least n bits are available."""
+        bitbuf = self.bitbuf & ((1 << self.bitcount) - 1)
+
+        while self.bitcount < n:
+            if self.__pos >= len(self.__data):
+                if self.__remaining > 0:
+                    self.__data = self.__reader.read(min(self.CHUNK,
+                        self.__remaining))
+                    self.__remaining -= len(self.__data)
+                else:
+                    self.__data = b''
+
+                self.__pos = 0
+
+                if not self.__data:
+                    self.__data = bytes(8)
+
+            # take up to 8 bytes at a time
+            take = self.__data[self.__pos:self.__pos + 8]
+            self.__pos += len(take)
+            bitbuf = (bitbuf << (8 * len(take))) | int.from_bytes(take, 'big')
+            self.bitcount += 8 * len(take)
+
+        self.bitbuf = bitbuf
+
+    def peek(self, n):
+        if self.bitcount < n:
+            self.fill(n)
+
+        return (self.bitbuf >> (self.bitcount - n)) & ((1 << n) - 1)
+
+    def skip(self, n):
+        self.bitcount -= n
+
+    def getbits(self, n):
+        if n == 0:
+            return 0
+
+        value = self.peek(n)
+        self.skip(n)
+        return value
+
+    def decode(self, table):
+        """Decode one symbol using a table from _make_table()."""
+        lookup, bits = table
+
+        if bits == 0:
+            return lookup[0][0]
+
+        symbol, length = lookup[self.peek(bits)]
+
+        if length == 0:
+            raise ValueError('invalid Huffman code in LHA data')
+
+        self.skip(length)
+        return symbol
+
+def _make_table(lengths):
+    """Return a lookup table for the canonical Huffman code in which
+    symbol i has code length lengths[i] (0 meaning unused).
+
+    The table is a tuple (lookup, bits) such that if the next bits
+    bits of input are n, lookup[n] is (symbol, code length).
+    """
+    bits = max(lengths)
+
+    if bits == 0:
+        raise ValueError('empty Huffman code in LHA data')
+
+    lookup = [(0, 0)] * (1 << bits)
+    code = 0
+
+    for length in range(1, bits + 1):
+        for symbol, symbol_length in enumerate(lengths):
+            if symbol_length != length:
+                continue
+
+            span = 1 << (bits - length)
+            start = code << (bits - length)
+
+            if start + span > len(lookup):
+                raise ValueError('oversubscribed Huffman code in LHA data')
+
+            lookup[start:start + span] = [(symbol, length)] * span
+            code += 1
+
+        code <<= 1
+
+    return (lookup, bits)
+
+def _single_code_table(symbol):
+    """A table for a code where symbol is the only possibility and
+    takes no bits to encode.
+    """
+    return ([(symbol, 0)], 0)
+
+def _read_pt_table(bits, n_symbols, nbit, special):
+    """Read the code lengths for the length-encoding alphabet or the
+    match position alphabet, and return the corresponding table.
+    """
+    n = bits.getbits(nbit)
+
+    if n == 0:
+        return _single_code_table(bits.getbits(nbit))
+
+    if n > n_symbols:
+        raise ValueError('too many symbols in LHA data')
+
+    lengths = []
+
+    while len(lengths) < n:
+        length = bits.getbits(3)
+
+        if length == 7:
+            # unary continuation: 7 + the number of 1 bits before a 0
+            while bits.getbits(1):
+                length += 1
+
+                if length > 16:
+                    raise ValueError('code too long in LHA data')
+
+        lengths.append(length)
+
+        if len(lengths) == special:
+            lengths.extend([0] * bits.getbits(2))
+
+    lengths.extend([0] * (n_symbols - len(lengths)))
+    return _make_table(lengths[:n_symbols])
+
+def _read_c_table(bits, t_table):
+    """Read the code lengths for the main alphabet, which are themselves
+    encoded using t_table, and return the corresponding table.
+    """
+    n = bits.getbits(_CBIT)
+
+    if n == 0:
+        return _single_code_table(bits.getbits(_CBIT))
+
+    if n > _NC:
+        raise ValueError('too many symbols in LHA data')
+
+    lengths = []
+
+    while len(lengths) < n:
+        c = bits.decode(t_table)
+
+        if c == 0:
+            lengths.append(0)
+        elif c == 1:
+            lengths.extend([0] * (bits.getbits(4) + 3))
+        elif c == 2:
+            lengths.extend([0] * (bits.getbits(_CBIT) + 20))
+        else:
+            lengths.append(c - 2)
+
+    lengths.extend([0] * (_NC - len(lengths)))
+    return _make_table(lengths[:_NC])
+
+def _iter_lzh(reader, compressed_size, original_size, dictionary_bits):
+    """Decompress the -lh4- to -lh7- methods (LZSS with static Huffman
+    coding), yielding chunks of output.
+    """
+    dictionary_size = 1 << dictionary_bits
+
+    if dictionary_bits <= 13:
+        n_positions = 14
+        position_bits = 4
+    else:
+        n_positions = dictionary_bits + 1
+        position_bits = 5
+
+    bits = _BitReader(reader, compressed_size)
+
+    # The sliding dictionary is initially full of spaces. We keep the
+    # last dictionary_size bytes of output after them.
+    window = bytearray(b' ' * dictionary_size)
+    done = 0
+
+    while done < original_size:
+        block_size = bits.getbits(16)
+        t_table = _read_pt_table(bits, _NT, _TBIT, 3)
+        c_table = _read_c_table(bits, t_table)
+        p_table = _read_pt_table(bits, n_positions, position_bits, -1)
+        start = len(window)
+
+        # This is the hot loop, so it is written out in full with local
+        # variables rather than using bits.decode() and bits.getbits().
+        c_lookup, c_bits = c_table
+        c_mask = (1 << c_bits) - 1
+        p_lookup, p_bits = p_table
+        p_mask = (1 << p_bits) - 1
+        bitbuf = bits.bitbuf
+        bitcount = bits.bitcount
+
+        for i in range(block_size):
+            # enough for the longest possible c code, p code and
+            # position bits
+            if bitcount < 48:
+                bits.bitbuf = bitbuf
+                bits.bitcount = bitcount
+                bits.fill(48)
+                bitbuf = bits.bitbuf
+                bitcount = bits.bitcount
+
+            c, length = c_lookup[(bitbuf >> (bitcount - c_bits)) & c_mask]
+
+            if c_bits:
+                if not length:
+                    raise ValueError('invalid Huffman code in LHA data')
+
+                bitcount -= length
+
+            if c < 256:
+                window.append(c)
+                continue
+
+            length = c - 256 + _MIN_MATCH
+            p, p_length = p_lookup[(bitbuf >> (bitcount - p_bits)) & p_mask]
+
+            if p_bits:
+                if not p_length:
+                    raise ValueError('invalid Huffman code in LHA data')
+
+                bitcount -= p_length
+
+            if p > 1:
+                bitcount -= p - 1
+                p = (1 << (p - 1)) + ((bitbuf >> bitcount) &
+                        ((1 << (p - 1)) - 1))
+
+            source = len(window) - p - 1
+
+            if source < 0:
+                raise ValueError('LHA match position out of range')
+
+            if p + 1 >= length:
+                window += window[source:source + length]
+            else:
+                # the match overlaps its own output, so it repeats
+                period = window[source:]
+                window += (period * (length // len(period) + 1))[:length]
+
+        bits.bitbuf = bitbuf
+        bits.bitcount = bitcount
+
+        chunk = window[start:start + original_size - done]
+        done += len(chunk)
+
+        if chunk:
+            yield bytes(chunk)
+
+        del window[:-dictionary_size]
+
+def _iter_stored(reader, size):
+    while size > 0:
+        chunk = reader.read(min(size, 64 * 1024))
+
+        if not chunk:
+            raise ValueError('unexpected end of LHA archive')
+
+        size -= len(chunk)
+        yield chunk
+
+class LhaEntryFile(io.BufferedIOBase):
+    """File-like object allowing a member to be read from an LHA archive.
+
+    Each Lha can have at most one LhaEntryFile open at a time.
+    """
+
+    def __init__(self, lha, entry):
+        self.entry = entry
+        self.__buffer = b''
+        self.__crc = 0
+        self.__position = 0
+
+        if entry.method in _STORED_METHODS:
+            self.__chunks = _iter_stored(lha.reader, entry.compressed_size)
+        else:
+            self.__chunks = _iter_lzh(lha.reader, entry.compressed_size,
+                    entry.size, _LZH_DICTIONARY_BITS[entry.method])
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        if size is None or size < 0:
+            size = self.entry.size
+
+        while len(self.__buffer) < size and self.__chunks is not None:
+            chunk = next(self.__chunks, None)
+
+            if chunk is None:
+                self.__chunks = None
+
+                if self.__position + len(self.__buffer) != self.entry.size:
+                    raise ValueError('%s: expected %d bytes, got %d' %
+                            (self.entry.name, self.entry.size,
+                                self.__position + len(self.__buffer)))
+
+                if self.__crc != self.entry.crc16:
+                    raise ValueError('%s: CRC-16 mismatch' % self.entry.name)
+
+                break
+
+            self.__crc = crc16(chunk, self.__crc)
+            self.__buffer += chunk
+
+        ret = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        self.__position += len(ret)
+        return ret
+
+    def read1(self, size=-1):
+        """read1() is the same as read() for this class."""
+        return self.read(size)
+
+class LhaEntry(UnpackableEntry):
+    """A file or directory in an LHA archive."""
+
+    def __init__(self, name, method, size, compressed_size, offset, mtime,
+            crc16, level):
+        self._name = name
+        self.method = method
+        self._size = size
+        self.compressed_size = compressed_size
+        # offset of the compressed data in the archive
+        self.offset = offset
+        self._mtime = mtime
+        self.crc16 = crc16
+        self.level = level
+
+    def __repr__(self):
+        return '<%s "%s" method=%s size=%d offset=%d level=%d>' % (
+                self.__class__.__name__, self.name,
+                self.method.decode('ascii'), self.size, self.offset,
+                self.level)
+
+    @property
+    def is_directory(self):
+        return self.method == b'-lhd-'
+
+    @property
+    def is_regular_file(self):
+        return not self.is_directory
+
+    @property
+    def is_extractable(self):
+        return (self.method in _STORED_METHODS or
+                self.method in _LZH_DICTIONARY_BITS)
+
+    @property
+    def mtime(self):
+        return self._mtime
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def size(self):
+        return self._size
+
+class NotLha(ValueError):
+    pass
+
+def _check_level2_header(header):
+    """Raise NotLha unless header, a complete level 2 header, has a
+    consistent chain of extended headers including a common header
+    with the right CRC-16.
+    """
+    header_size = len(header)
+    position = 26
+    next_size, = struct.unpack('<H', header[24:26])
+    checked = False
+
+    while next_size:
+        if next_size < 3 or position + next_size > header_size:
+            raise NotLha('bad LHA extended header size')
+
+        if header[position] == 0 and next_size >= 5:
+            # the common header: CRC-16 of the whole header, calculated
+            # with this field set to 0
+            crc, = struct.unpack('<H', header[position + 1:position + 3])
+
+            if crc16(header[:position + 1] + b'\0\0' +
+                    header[position + 3:]) != crc:
+                raise NotLha('bad LHA header CRC')
+
+            checked = True
+
+        position += next_size
+        next_size, = struct.unpack('<H', header[position - 2:position])
+
+    # LHa for Unix pads the header by one byte in some cases
+    if position not in (header_size, header_size - 1):
+        raise NotLha('LHA extended headers do not fill the header')
+
+    if not checked:
+        raise NotLha('LHA header has no CRC')
+
+def _find_first_header(reader):
+    """Return the offset of the first header in reader, which is
+    positioned at the beginning of the archive (or of a self-extracting
+    executable containing it).
+    """
+    start = reader.tell()
+    block = reader.read(MAX_SFX_STUB + 22)
+
+    for match in _METHOD_RE.finditer(block):
+        offset = match.start() - 2
+
+        if offset < 0 or offset + 22 > len(block):
+            continue
+
+        level = block[offset + 20]
+
+        if level in (0, 1):
+            header_size = block[offset]
+
+            if header_size < 22 or offset + 2 + header_size > len(block):
+                continue
+
+            if (sum(block[offset + 2:offset + 2 + header_size]) & 0xff !=
+                    block[offset + 1]):
+                continue
+        elif level == 2:
+            header_size = struct.unpack('<H', block[offset:offset + 2])[0]
+
+            if header_size < 26 or offset + header_size > len(block):
+                continue
+
+            try:
+                _check_level2_header(block[offset:offset + header_size])
+            except NotLha:
+                continue
+        else:
+            continue
+
+        return start + offset
+
+    raise NotLha('no LHA header found')
+
+class Lha(StreamUnpackable):
+    """Object representing an LHA archive.
+
+    The API of this class is similar to tarfile.TarFile and zipfile.ZipFile.
+    """
+
+    def __init__(self, path_or_file, encoding='cp437'):
+        """Constructor.
+
+        path_or_file may be a string or a seekable file object open in
+        binary mode.
+        """
+        if isinstance(path_or_file, str):
+            self.__close_file = True
+            self.name = path_or_file
+            self.reader = open(path_or_file, 'rb')
+        else:
+            self.__close_file = False
+            self.name = getattr(path_or_file, 'name', repr(path_or_file))
+            self.reader = path_or_file
+
+        self.encoding = encoding
+        self.entries = []
+
+        try:
+            self.reader.seek(0)
+            offset = _find_first_header(self.reader)
+
+            while True:
+                entry, offset = self.__read_header(offset)
+
+                if entry is None:
+                    break
+
+                self.entries.append(entry)
+        except:
+            if self.__close_file:
+                self.reader.close()
+            raise
+
+    def __read_header(self, offset):
+        """Read the header at offset. Return the entry (or None at the
+        end of the archive) and the offset of the next header.
+        """
+        self.reader.seek(offset)
+        base = self.reader.read(24)
+
+        if not base or base[0] == 0:
+            return None, offset
+
+        if len(base) < 22:
+            raise ValueError('%s: truncated LHA header at %d' %
+                    (self.name, offset))
+
+        method = base[2:7]
+        level = base[20]
+        compressed_size, size, timestamp = struct.unpack('<III', base[7:19])
+        dirname = b''
+        mtime = None
+
+        if level in (0, 1):
+            header_size = base[0] + 2
+            self.reader.seek(offset)
+            header = self.reader.read(header_size)
+
+            if len(header) != header_size:
+                raise ValueError('%s: truncated LHA header at %d' %
+                        (self.name, offset))
+
+            if sum(header[2:]) & 0xff != header[1]:
+                raise ValueError('%s: bad LHA header checksum at %d' %
+                        (self.name, offset))
+
+            name_length = header[21]
+            filename = header[22:22 + name_length]
+            crc, = struct.unpack('<H',
+                    header[22 + name_length:24 + name_length])
+            mtime = _dos_time(timestamp)
+
+            if level == 0:
+                next_size = 0
+            else:
+                next_size, = struct.unpack('<H', header[-2:])
+        elif level == 2:
+            header_size, = struct.unpack('<H', base[0:2])
+            self.reader.seek(offset)
+            header = self.reader.read(header_size)
+
+            if header_size < 26 or len(header) != header_size:
+                raise ValueError('%s: truncated LHA header at %d' %
+                        (self.name, offset))
+
+            try:
+                _check_level2_header(header)
+            except NotLha as e:
+                raise ValueError('%s: %s at %d' % (self.name, e, offset))
+
+            crc, = struct.unpack('<H', base[21:23])
+            filename = b''
+            mtime = timestamp
+            self.reader.seek(offset + 24)
+            next_size, = struct.unpack('<H', self.reader.read(2))
+        else:
+            raise ValueError('%s: unsupported LHA header level %d at %d' %
+                    (self.name, level, offset))
+
+        # extended headers: each is a type byte, some data and the size
+        # of the next one
+        extended_total = 0
+
+        while next_size:
+            extended = self.reader.read(next_size)
+
+            if len(extended) != next_size or next_size < 3:
+                raise ValueError('%s: truncated LHA extended header' %
+                        self.name)
+
+            extended_total += next_size
+            ext_type = extended[0]
+            data = extended[1:-2]
+            next_size, = struct.unpack('<H', extended[-2:])
+
+            if ext_type == _EXT_FILENAME:
+                filename = data
+            elif ext_type == _EXT_DIRNAME:
+                dirname = data
+            elif ext_type == _EXT_UNIX_MTIME and len(data) >= 4:
+                mtime, = struct.unpack('<I', data[:4])
+
+        if level == 1:
+            # the "compressed size" includes the extended headers
+            compressed_size -= extended_total
+            data_offset = offset + header_size + extended_total
+        else:
+            data_offset = offset + header_size
+
+        if dirname:
+            filename = dirname.rstrip(b'\xff') + b'\xff' + filename
+
+        name = filename.replace(b'\xff', b'/').replace(b'\\', b'/')
+        name = name.decode(self.encoding).strip('/')
+
+        entry = LhaEntry(name, method, size, compressed_size, data_offset,
+                mtime, crc, level)
+        return entry, data_offset + compressed_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _et, _ev, _tb):
+        if self.__close_file:
+            self.reader.close()
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield entry
+
+    def open(self, member):
+        """Open a binary file-like object for the given filename or LhaEntry.
+        """
+        if isinstance(member, str):
+            for entry in self.entries:
+                if entry.name == member:
+                    break
+            else:
+                raise KeyError(member)
+        else:
+            entry = member
+
+        assert isinstance(entry, LhaEntry)
+
+        if not entry.is_extractable:
+            raise NotImplementedError('%s: unsupported LHA method %s' %
+                    (entry.name, entry.method.decode('ascii')))
+
+        self.reader.seek(entry.offset)
+        return LhaEntryFile(self, entry)
+
+    def getinfo(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+
+        raise KeyError(name)
+
+    def infolist(self):
+        return list(self.entries)
+
+    def namelist(self):
+        return [x.name for x in self.entries]
+
+    @property
+    def format(self):
+        return 'lha'
+
+    def seekable(self):
+        return True
+
+def is_lha(path_or_file):
+    try:
+        if isinstance(path_or_file, str):
+            with open(path_or_file, 'rb') as reader:
+                _find_first_header(reader)
+        else:
+            path_or_file.seek(0)
+            _find_first_header(path_or_file)
+
+        return True
+    except:
+        return False
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', '-o', help='extract to OUTPUT',
+            default=None)
+    parser.add_argument('lha')
+    args = parser.parse_args()
+
+    with Lha(args.lha) as lha:
+        if args.output:
+            lha.extractall(args.output)
+        else:
+            lha.printdir()
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+"""Random access to members of compressed tar archives.
+
+A tar archive has no table of contents, and its usual compression
+formats can only be decompressed from the beginning, so reading one
+member normally means decompressing everything before it.
+
+The first time we stream through an archive, TarIndex records each
+member's header in a cache file. On later runs that lets us list the
+archive without decompressing it, and only decompress as far as the
+last member that we actually want.
+
+Within one process, GzipCheckpointReader additionally remembers copies
+of the zlib state at intervals, so that going back to an earlier
+member does not mean decompressing from the start again. Python's zlib
+module cannot prime a decompressor with a partial byte
+(inflatePrime()), so these checkpoints cannot be saved to disk.
+"""
+
+import bz2
+import hashlib
+import io
+import json
+import logging
+import lzma
+import os
+import tarfile
+import threading
+import zlib
+
+from ..util import (get_cache_dir)
+
+logger = logging.getLogger(__name__)
+
+# Bump this if the format of the cache files changes
+INDEX_VERSION = 1
+
+# Approximate number of bytes of decompressed output between checkpoints
+CHECKPOINT_INTERVAL = 16 * 1024 * 1024
+
+# { TarIndex.key: [(uncompressed offset, compressed offset, zlib state)] }
+_gzip_checkpoints = {}
+# Held while adding to one of those lists, which readers for the same
+# archive in other threads share
+_gzip_checkpoints_lock = threading.Lock()
+
+class GzipCheckpointReader(io.RawIOBase):
+    """Seekable reader for the decompressed contents of a gzip stream
+    that starts skip bytes into path.
+
+    Seeking forwards decompresses and discards data, as with
+    gzip.GzipFile, but seeking backwards resumes from the closest
+    checkpoint instead of from the start.
+    """
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, path, skip=0, checkpoints=None):
+        self.__raw = open(path, 'rb')
+        self.__skip = skip
+
+        if checkpoints is None:
+            checkpoints = []
+
+        # sorted list of (uncompressed offset, compressed offset, zlib
+        # state) shared with other readers for the same archive
+        self.__checkpoints = checkpoints
+        self.__restart(0, skip, None)
+
+    def __restart(self, position, offset, state):
+        self.__raw.seek(offset)
+
+        if state is None:
+            self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.__decompressor = state.copy()
+
+        self.__position = position
+        self.__buffer = b''
+        self.__eof = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.__position
+
+    def __fill(self):
+        """Decompress some more data into the buffer."""
+        d = self.__decompressor
+
+        if d.unconsumed_tail:
+            data = d.decompress(d.unconsumed_tail, self.CHUNK)
+        else:
+            compressed = self.__raw.read(self.CHUNK)
+
+            if not compressed:
+                # there might be output that was held back by the
+                # length limit
+                self.__buffer += d.flush()
+                self.__eof = True
+                return
+
+            data = d.decompress(compressed, self.CHUNK)
+
+        if d.eof:
+            # Possibly another gzip member, possibly trailing garbage:
+            # go back to the end of this member and take a look
+            self.__raw.seek(-len(d.unused_data), io.SEEK_CUR)
+            magic = self.__raw.read(2)
+            self.__raw.seek(-len(magic), io.SEEK_CUR)
+
+            if magic == b'\x1f\x8b':
+                self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                self.__eof = True
+        elif not d.unconsumed_tail:
+            self.__maybe_checkpoint(self.__position + len(self.__buffer) +
+                    len(data))
+
+        self.__buffer += data
+
+    def __maybe_checkpoint(self, position):
+        with _gzip_checkpoints_lock:
+            if self.__checkpoints:
+                last = self.__checkpoints[-1][0]
+            else:
+                last = 0
+
+            if position >= last + CHECKPOINT_INTERVAL:
+                self.__checkpoints.append((position, self.__raw.tell(),
+                    self.__decompressor.copy()))
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(io.DEFAULT_BUFFER_SIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+
+        while len(self.__buffer) < size and not self.__eof:
+            self.__fill()
+
+        ret = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        self.__position += len(ret)
+        return ret
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, target, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            target += self.__position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('can only seek relative to start '
+                    'or current position')
+
+        # resume from the latest checkpoint before target, if that is
+        # better than where we are now
+        best = None
+
+        for checkpoint in self.__checkpoints:
+            if checkpoint[0] > target:
+                break
+
+            best = checkpoint
+
+        if target < self.__position:
+            if best is None:
+                self.__restart(0, self.__skip, None)
+            else:
+                self.__restart(*best)
+        elif best is not None and best[0] > self.__position:
+            self.__restart(*best)
+
+        while self.__position < target:
+            if not self.read(min(target - self.__position,
+                    io.DEFAULT_BUFFER_SIZE * 16)):
+                break
+
+        return self.__position
+
+    def close(self):
+        if not self.closed:
+            self.__raw.close()
+        super(GzipCheckpointReader, self).close()
+
+class _OffsetReader(io.RawIOBase):
+    """The contents of a file, starting skip bytes in."""
+
+    def __init__(self, path, skip):
+        self.__raw = open(path, 'rb')
+        self.__skip = skip
+        self.__raw.seek(skip)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        return self.__raw.readinto(b)
+
+    def seek(self, target, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            target += self.__skip
+        return self.__raw.seek(target, whence) - self.__skip
+
+    def tell(self):
+        return self.__raw.tell() - self.__skip
+
+    def close(self):
+        if not self.closed:
+            self.__raw.close()
+        super(_OffsetReader, self).close()
+
+class TarMemberReader(io.BufferedIOBase):
+    """One member of a tar archive, read from a shared seekable stream
+    of the decompressed archive. Only one member can be read at a time.
+    """
+
+    def __init__(self, stream, offset, size):
+        self.__stream = stream
+        self.__offset = offset
+        self.__position = 0
+        self.__size = size
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        remaining = self.__size - self.__position
+
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+
+        if size <= 0:
+            return b''
+
+        if self.__stream.tell() != self.__offset + self.__position:
+            self.__stream.seek(self.__offset + self.__position)
+
+        ret = self.__stream.read(size)
+        self.__position += len(ret)
+        return ret
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+class TarIndex(object):
+    """A cached list of the members of a tar archive, with their offsets
+    in the decompressed stream.
+    """
+
+    def __init__(self, path, skip=0, key=None):
+        self.path = path
+        self.skip = skip
+
+        if key is None:
+            stat_res = os.stat(path)
+            key = json.dumps([os.path.realpath(path), stat_res.st_size,
+                stat_res.st_mtime_ns, skip])
+        else:
+            key = json.dumps([key, skip])
+
+        self.key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.compression = None
+        self.members = None
+
+    @classmethod
+    def for_archive(cls, path, reader=None, skip=0, key=None):
+        """Return a TarIndex for the archive at path, or None if it is
+        not a regular file that we can reopen.
+        """
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return None
+
+        if reader is not None and getattr(reader, 'name', None) != path:
+            return None
+
+        return cls(path, skip, key)
+
+    @property
+    def cache_file(self):
+        return os.path.join(get_cache_dir('tar-index'), self.key + '.json')
+
+    def load(self):
+        """Load the index from the cache. Return True on success."""
+        try:
+            with open(self.cache_file, encoding='utf-8') as reader:
+                data = json.load(reader)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('version') != INDEX_VERSION:
+            return False
+
+        self.compression = data['compression']
+        self.members = []
+
+        for name, type_, size, mtime, linkname, offset_data in data['members']:
+            info = tarfile.TarInfo(name)
+            info.type = type_.encode('ascii')
+            info.size = size
+            info.mtime = mtime
+            info.linkname = linkname
+            info.offset_data = offset_data
+            self.members.append(info)
+
+        logger.debug('using cached index of %s with %d members', self.path,
+                len(self.members))
+        return True
+
+    def save(self, members):
+        """Save the index, given the TarInfo objects that were read by
+        streaming through the whole archive.
+        """
+        data = dict(
+                version=INDEX_VERSION,
+                compression=self.sniff_compression(),
+                members=[[m.name, m.type.decode('ascii'), m.size,
+                    int(m.mtime), m.linkname, m.offset_data]
+                    for m in members],
+                )
+
+        cache = self.cache_file
+
+        try:
+            with open(cache + '.tmp', 'w', encoding='utf-8') as writer:
+                json.dump(data, writer)
+            os.rename(cache + '.tmp', cache)
+        except OSError as e:
+            logger.debug('unable to save index of %s: %s', self.path, e)
+
+    def sniff_compression(self):
+        with open(self.path, 'rb') as reader:
+            reader.seek(self.skip)
+            magic = reader.read(6)
+
+        if magic.startswith(b'\x1f\x8b'):
+            return 'gz'
+        elif magic.startswith(b'BZh'):
+            return 'bz2'
+        elif magic.startswith(b'\xfd7zXZ\x00'):
+            return 'xz'
+        else:
+            return ''
+
+    def open_stream(self):
+        """Return a seekable binary stream of the decompressed archive."""
+        if self.compression == 'gz':
+            return GzipCheckpointReader(self.path, self.skip,
+                    _gzip_checkpoints.setdefault(self.key, []))
+
+        raw = _OffsetReader(self.path, self.skip)
+
+        if self.compression == 'bz2':
+            return bz2.BZ2File(raw)
+        elif self.compression == 'xz':
+            return lzma.LZMAFile(raw)
+        else:
+            return io.BufferedReader(raw)
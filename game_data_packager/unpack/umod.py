@@ -15,11 +15,14 @@
 # You can find the GPL license text on a Debian system under
 # /usr/share/common-licenses/GPL-2.
 
+import copy
 import io
 import logging
 import os
+import stat
 import struct
 import re
+import threading
 
 from . import (StreamUnpackable, UnpackableEntry)
 
@@ -38,13 +41,28 @@ class UmodSection(object):
         # Stuff we didn't parse
         self.unparsed = []
 
+def _read_text_line(reader):
+    line = b';'
+
+    # Lines starting with ; or // are comments.
+    while line.startswith(b';') or line.startswith(b'//'):
+        line = reader.readline(MAX_LINE_LENGTH)
+
+    if not line:
+        raise ValueError('Unexpected end of file')
+    elif not line.endswith(b'\r\n'):
+        raise ValueError('Unterminated line: %r' % line)
+
+    line = line[:-2].decode('windows-1252')
+    return line
+
 class UmodEntryFile(io.BufferedIOBase):
     """File-like object allowing an embedded file to be read from a umod.
 
-    Each Umod can currently have at most one UmodEntryFile open at a time.
+    Each UmodEntryFile has its own position, so any number of them can be
+    open at the same time, and read from different threads.
     """
     def __init__(self, umod, entry, offset, length):
-        assert isinstance(umod.reader, io.BufferedIOBase)
         self.__umod = umod
         self.entry = entry
         self.__offset = offset
@@ -61,7 +79,7 @@ class UmodEntryFile(io.BufferedIOBase):
         if size <= 0:
             return b''
 
-        ret = self.__umod.reader.read(size)
+        ret = self.__umod._read_at(self.__offset + self.__position, size)
         self.__position += len(ret)
 
         return ret
@@ -70,23 +88,60 @@ class UmodEntryFile(io.BufferedIOBase):
         """read1() is the same as read() for this class."""
         return self.read(size)
 
-    def close(self):
-        self.__position = None
+    def readinto(self, b):
+        if self.__position is None:
+            raise OSError('File closed')
+
+        view = memoryview(b).cast('B')
+        size = min(len(view), self.__length - self.__position)
+
+        if size <= 0:
+            return 0
+
+        n = self.__umod._read_into_at(self.__offset + self.__position,
+                view[:size])
+        self.__position += n
+        return n
+
+    def readinto1(self, b):
+        """readinto1() is the same as readinto() for this class."""
+        return self.readinto(b)
 
-    def _read_text_line(self):
-        line = b';'
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if self.__position is None:
+            raise OSError('File closed')
+
+        if whence == os.SEEK_CUR:
+            offset += self.__position
+        elif whence == os.SEEK_END:
+            offset += self.__length
+        elif whence != os.SEEK_SET:
+            raise ValueError('Invalid whence %r' % whence)
+
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+
+        self.__position = offset
+        return offset
+
+    def tell(self):
+        if self.__position is None:
+            raise OSError('File closed')
 
-        # Lines starting with ; or // are comments.
-        while line.startswith(b';') or line.startswith(b'//'):
-            line = self.readline(MAX_LINE_LENGTH)
+        return self.__position
 
-        if not line:
-            raise ValueError('Unexpected end of file')
-        elif not line.endswith(b'\r\n'):
-            raise ValueError('Unterminated line: %r' % line)
+    @property
+    def closed(self):
+        return self.__position is None
 
-        line = line[:-2].decode('windows-1252')
-        return line
+    def close(self):
+        self.__position = None
 
 class UmodEntry(UnpackableEntry):
     """Base class for files and edit instructions in a umod."""
@@ -249,6 +304,45 @@ class UmodRequirement(UmodSection):
             raise ValueError('Unexpected key in requirement: %r (value %r)' %
                     (k, v))
 
+_TOC_ENTRY = struct.Struct('<III')
+
+def _decode_compact_index(buf, pos):
+    """Decode the compact index starting at buf[pos] and return
+    (value, position after it).
+    """
+    # http://wiki.beyondunreal.com/Legacy:Package_File_Format/Data_Details
+    byte = buf[pos]
+    pos += 1
+    value = byte & 0x3f
+
+    # the common case: a single byte
+    if not byte & 0x40:
+        return (-value if byte & 0x80 else value), pos
+
+    negative = bool(byte & 0x80)
+    more = True
+    shift = 6
+
+    while more:
+        byte = buf[pos]
+        pos += 1
+
+        # fifth byte contributes 8 bits 27..34 inclusive
+        # (but we should never see that large an index in a umod)
+        if shift >= 27:
+            more = False
+            value += (byte << shift)
+
+        # second..fourth bytes contribute 7 bits 6..12, 13..19, 20. 26
+        # inclusive
+        more = bool(byte & 0x80)
+        value += ((byte & 0x7f) << shift)
+        shift += 7
+
+    if negative:
+        return -value, pos
+    return value, pos
+
 class NotUmod(ValueError):
     pass
 
@@ -320,29 +414,49 @@ class Umod(StreamUnpackable):
         self.reader, self.name, toc_offset, trailer_offset, flags, \
                 checksum, self.__close_file = _open(path_or_file)
 
-        self.reader.seek(toc_offset)
+        # If we have a real file, entries are read with os.pread(), which
+        # doesn't involve the shared file position; otherwise we have to
+        # take turns to seek and read.
+        try:
+            self.__fd = self.reader.fileno()
+
+            if not stat.S_ISREG(os.fstat(self.__fd).st_mode):
+                self.__fd = None
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self.__fd = None
 
-        n_entries = self.__read_compact_index()
+        self.__lock = threading.Lock()
+
+        # The table of contents is made up of lots of tiny fields, so
+        # read it all at once and decode it from memory
+        toc = memoryview(self._read_at(toc_offset,
+            trailer_offset - toc_offset))
+        n_entries, pos = _decode_compact_index(toc, 0)
 
         for i in range(n_entries):
-            strlen = self.__read_compact_index()
-            name = self.reader.read(strlen).decode('windows-1252')
+            strlen, pos = _decode_compact_index(toc, pos)
+            name = str(toc[pos:pos + strlen], 'windows-1252')
             assert name[-1] == '\0', name
             name = name[:-1]
-            offset, length, flags = struct.unpack('<III', self.reader.read(12))
+            offset, length, flags = _TOC_ENTRY.unpack_from(toc, pos + strlen)
+            pos += strlen + _TOC_ENTRY.size
             entry = UmodEntry(name, length, offset, flags, 0)
             self.entry_order.append(entry.name)
             self.entries[entry.name] = entry
 
-        assert self.reader.tell() == trailer_offset
-        manifest = self.open(self.entries['System/Manifest.ini'])
+        assert pos == len(toc)
+
+        # likewise for the manifest, which is read a line at a time
+        with self.open(self.entries['System/Manifest.ini']) as reader:
+            manifest = io.BytesIO(reader.read())
+
         line = manifest.readline()
         assert line == b'[Setup]\r\n', line
 
         expected_sections = {}
 
         while True:
-            line = manifest._read_text_line()
+            line = _read_text_line(manifest)
 
             # A blank line terminates the Setup section. The next line
             # is expected to be a requirement or group.
@@ -382,7 +496,7 @@ class Umod(StreamUnpackable):
                 raise ValueError('Unknown Umod [Setup] key: %r' % k)
 
         while expected_sections:
-            line = manifest._read_text_line()
+            line = _read_text_line(manifest)
 
             if not line.startswith('[') or not line.endswith(']'):
                 raise ValueError('Expected [*], got %r' % line)
@@ -400,7 +514,7 @@ class Umod(StreamUnpackable):
 
     def __parse_section(self, manifest, section):
         while True:
-            line = manifest._read_text_line()
+            line = _read_text_line(manifest)
 
             if not line:
                 break
@@ -418,6 +532,47 @@ class Umod(StreamUnpackable):
         if self.__close_file:
             self.reader.close()
 
+    def _read_at(self, offset, size):
+        """Return up to size bytes starting from offset."""
+        if self.__fd is None:
+            with self.__lock:
+                self.reader.seek(offset)
+                return self.reader.read(size)
+
+        chunks = []
+
+        while size > 0:
+            chunk = os.pread(self.__fd, size, offset)
+
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+
+        return b''.join(chunks)
+
+    def _read_into_at(self, offset, view):
+        """Fill the writable memoryview view with bytes starting from
+        offset, and return the number of bytes read."""
+        if self.__fd is None:
+            with self.__lock:
+                self.reader.seek(offset)
+                return self.reader.readinto(view)
+
+        done = 0
+
+        while done < len(view):
+            n = os.preadv(self.__fd, [view[done:]], offset + done)
+
+            if not n:
+                break
+
+            done += n
+
+        return done
+
     def open(self, member):
         """Open a binary file-like object for the given filename or UmodEntry.
         """
@@ -427,9 +582,15 @@ class Umod(StreamUnpackable):
             entry = member
 
         assert isinstance(entry, UmodEntry)
-        self.reader.seek(entry.offset)
         return UmodEntryFile(self, entry, entry.offset, entry.size)
 
+    def reopen(self):
+        # entries don't share a file position, so the same file handle
+        # can be used; just don't close it twice
+        other = copy.copy(self)
+        other.__close_file = False
+        return other
+
     def getinfo(self, name):
         return self.entries[name]
 
@@ -443,33 +604,6 @@ class Umod(StreamUnpackable):
         for name in self.entry_order:
             yield self.entries[name]
 
-    def __read_compact_index(self):
-        # http://wiki.beyondunreal.com/Legacy:Package_File_Format/Data_Details
-        byte = self.reader.read(1)[0]
-        negative = bool(byte & 0x80)
-        more = bool(byte & 0x40)
-        value = byte & 0x3f
-        shift = 6
-
-        while more:
-            byte = self.reader.read(1)[0]
-
-            # fifth byte contributes 8 bits 27..34 inclusive
-            # (but we should never see that large an index in a umod)
-            if shift >= 27:
-                more = False
-                value += (byte << shift)
-
-            # second..fourth bytes contribute 7 bits 6..12, 13..19, 20. 26
-            # inclusive
-            more = bool(byte & 0x80)
-            value += ((byte & 0x7f) << shift)
-            shift += 7
-
-        if negative:
-            return -value
-        return value
-
     @property
     def format(self):
         return 'umod'
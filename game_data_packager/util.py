@@ -16,6 +16,7 @@
 # You can find the GPL license text on a Debian system under
 # /usr/share/common-licenses/GPL-2.
 
+import fcntl
 import grp
 import logging
 import os
@@ -59,12 +60,72 @@ class TemporaryUmask(object):
 def mkdir_p(path):
     if not os.path.isdir(path):
         with TemporaryUmask(0o022):
-            os.makedirs(path)
+            os.makedirs(path, exist_ok=True)
 
 def rm_rf(path):
     if os.path.exists(path):
         shutil.rmtree(path)
 
+def get_cache_dir(*subdirs):
+    """Return the path to a subdirectory of game-data-packager's
+    per-user cache directory, creating it if necessary.
+    """
+    path = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                os.path.expanduser('~/.cache')),
+            'game-data-packager', *subdirs)
+    mkdir_p(path)
+    return path
+
+# from <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+def clone_file(source, dest):
+    """Copy source to dest, preserving timestamps like
+    cp --reflink=auto --preserve=timestamps. If the filesystem supports
+    it (btrfs, XFS), dest shares storage with source.
+
+    Return True if a reflink was made, or False if the data was copied.
+    """
+    try:
+        with open(source, 'rb') as reader, open(dest, 'wb') as writer:
+            fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+    except OSError:
+        shutil.copyfile(source, dest)
+        cloned = False
+    else:
+        cloned = True
+
+    stat_res = os.stat(source)
+    os.utime(dest, ns=(stat_res.st_atime_ns, stat_res.st_mtime_ns))
+    return cloned
+
+def physical_device(path):
+    """Return something that identifies the disk on which path is
+    stored, so that partitions of the same disk give the same result.
+    Return None if path doesn't exist.
+    """
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return None
+
+    sysfs = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+
+    try:
+        sysfs = os.path.realpath(sysfs)
+
+        if os.path.exists(os.path.join(sysfs, 'partition')):
+            # e.g. /sys/devices/.../block/sda/sda1 -> sda
+            return os.path.basename(os.path.dirname(sysfs))
+
+        if os.path.isdir(sysfs):
+            return os.path.basename(sysfs)
+    except OSError:
+        pass
+
+    # not a block device (tmpfs, NFS...)
+    return dev
+
 def which(exe):
     for path in os.environ.get('PATH', '/usr/bin:/bin').split(os.pathsep):
         try:
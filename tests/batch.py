@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import argparse
+import os
+import tempfile
+import unittest
+
+from game_data_packager import (load_games)
+from game_data_packager.batch import (CombinedIndex,
+        resolve_batch_arguments,
+        scan)
+
+from tests.plan import (set_contents)
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+        self.games = {}
+
+        for shortname in ('doom', 'heretic'):
+            self.games.update(load_games(game=shortname, use_vfs=False,
+                use_yaml=True))
+
+    def test_arguments(self):
+        args = argparse.Namespace(games_and_paths=['doom', 'heretic',
+            'doom-e1m4b-wad', '/media/cdrom', 'no-such-game'])
+        wanted, paths = resolve_batch_arguments(args, self.games)
+        self.assertEqual(wanted, {
+            'doom': set(['doom', 'doom-e1m4b-wad']),
+            'heretic': set(['heretic']),
+        })
+        self.assertEqual(paths, ['/media/cdrom', 'no-such-game'])
+
+    def test_scan(self):
+        doom = self.games['doom'].construct_task()
+        heretic = self.games['heretic'].construct_task()
+        tasks = {'doom': doom, 'heretic': heretic}
+        heretic.hash_cache = doom.hash_cache
+
+        with doom, heretic:
+            wanted = self.games['doom'].files['e1m4b.wad']
+            data = b'contents of e1m4b.wad\n'
+            set_contents(wanted, data)
+            self.games['doom'].known_md5s[wanted.md5] = set([wanted.name])
+
+            os.makedirs(os.path.join(self.tmp.name, 'wads'))
+            path = os.path.join(self.tmp.name, 'wads', 'E1M4B.WAD')
+
+            with open(path, 'wb') as writer:
+                writer.write(data)
+
+            with open(os.path.join(self.tmp.name, 'README'), 'w') as writer:
+                writer.write('nothing to see here\n')
+
+            index = CombinedIndex(tasks)
+            self.assertEqual(index.by_name_or_size(path, len(data)),
+                    set(['doom']))
+
+            scan([self.tmp.name], tasks, index)
+
+            self.assertEqual(doom.found['e1m4b.wad'], path)
+            self.assertEqual(heretic.found, {})
+            # the file was hashed once, on behalf of both games
+            self.assertEqual(list(doom.hash_cache), [path])
+            self.assertIs(doom.hash_file(path),
+                    doom.hash_cache[path][2])
+
+            # a file on the command line is identified by its hashes too
+            renamed = os.path.join(self.tmp.name, 'renamed')
+            os.rename(path, renamed)
+            doom.found.clear()
+            scan([renamed], tasks, CombinedIndex(tasks))
+            self.assertEqual(doom.found['e1m4b.wad'], renamed)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,792 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import base64
+import heapq
+import io
+import os
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+from game_data_packager.unpack.cab import (Cab, is_cab)
+
+HELLO_TXT = b'Hello, world!\n'
+
+# more than one 32K MSZIP block, with back-references across blocks
+DATA_PAK = b''.join(b'%06d All work and no play\n' % i for i in range(5000))
+
+LOGO_BMP = bytes(range(256)) * 200
+
+def _jack_txt():
+    line = b'All work and no play makes Jack a dull boy.\n'
+    parts = []
+
+    for i in range(900):
+        parts.append(line)
+
+        if i % 40 == 0:
+            # something that looks like an x86 CALL instruction, which
+            # LZX translates to an absolute address
+            parts.append(b'\xe8' + (i * 13 - 200).to_bytes(4, 'little',
+                signed=True))
+
+    return b''.join(parts)
+
+JACK_TXT = _jack_txt() + bytes(range(256))
+AGAIN_TXT = JACK_TXT[:3000]
+
+# A cabinet with an LZX folder (64K window) containing JACK_TXT and
+# AGAIN_TXT: two frames, a verbatim block that continues into an
+# uncompressed block and an aligned offset block, and translation of
+# CALL instructions. It was made with LzxEncoder below, but checked with
+# libarchive's bsdtar, so it does not depend on the encoder and the
+# decoder agreeing with each other.
+FIXED_LZX_CAB = base64.b64decode('''
+TVNDRgAAAAAqBAAAAAAAACwAAAAAAAAAAwEBAAIAAADSBAAAZAAAAAIAAxAjnAAAAAAA
+AAAAIUgAACAASmFja1xkdWxsLnR4dAC4CwAAI5wAAAAAIUgAACAAYWdhaW4udHh0AAAA
+AAB+AgCAW4CAjQQQAuIAAAAANUIAAAYlDg4uOo6LwIejxgMKgwIDAjECeTIOc8jOJqJb
++ZubmZutNAAYAAAAAABAyAA9wv4baCS8UW/ek/4AAAAAAABEIAYiy8fj982Vf7qa4W9o
+ZKOMsELyIXporg3Tl1HYTo5j5o5uErnwpujl56tXv65+WgBcrDp2v3ss7A99AD9YHH4C
+4P61CwDI+i8AYKu6AADd0gUA+HguAYDIcgsAYI5cAAwiAGCgJeUGAAAsAAAADQEAACBh
+bmQgbm8gcGxheSBtYWtlcyBKYWNrIGEgZHVsbCBib3kuCkFsbCB3b3JrIGFuZCBubyBw
+bGF5IG1ha2VzIEphY2sgYSBkdWxsIGJveS4KQWxsIHdvcmsgYW5kIG5vIHBsYXkgbWFr
+ZXMgSmFjayBhIGR1bGwgYm95LgpBbGwgd29yayBhbmQgbm8gcGxheSBtYWtlcyBKYWNr
+IGEgZHVsbCBib3kuCkFsbCB3b3JrIGFuZCBubyBwbGF5IG1ha2VzIEphY2sgYSBkdWxs
+IGJveS4KQWxsIHdvcmsgYW5kIG5vIHBsYXkgbWFrZXMgSmFjayBhIGR1bGwgYm95LgpB
+bGwgd29yayBhbmQgbm8gcGxheSBtYWtlcyBKYWNrIGEgZHVsbCBib3kuCkEAC0DAEYIA
+AC4OAEgEygAAiG9XaU4HSinNDnQopdIaNJRLab2v3NcE3QgGaNADAgQECtFVuarsVuZc
+tWqt6q+q1r/iAMAAAMAAAACEDO8j35FHIwPfQEiAAAAASAAGADFBYA7nt504P+2AJ6sD
+oEoBACsrAICoBACyEgDYmgAAS0oAoCgBAK8EAMCgPgAAAAAAOAHbJxoAxE4AAAgSAIBM
+AgCMJABAiS0HmxauVW3ZW7cX7pUb6c5QdV27F+/Vm/nuv33wXxwYDxaFCWHDcdScGC9W
+jRljxxnylhwpT8uV82WVGdYsOW/PnfRnHRqPFqVJadMa9VadT62tWWvXG/aWHWnP27X3
+bZ0b79a9ed9U+G8eHA8XxYlx4xz5V56YL82rK+f6cx4dTZdjXdWpdesd+9Keb8/due9a
+/HcVHhK/j+flyXnzC/2fvq9X7dl79wv+H9/Nl+l/+/XYfR8/05/vD/35/2LYfxnZmVkR
+2rU0tjW3Nrg3cSNzcnV0d3aVSOXh7en18f75BgIOChYSHho0IVRMZFx0bIR8lIyknLSs
+xLzSzHMTs5P00zQUdFS0lPXUNRV1VeuJq2v27KTfFxdH7LAADHBhQciGAOAAeA==
+''')
+
+def mszip_blocks(data):
+    blocks = []
+    history = b''
+
+    for i in range(0, len(data), 32768):
+        chunk = data[i:i + 32768]
+
+        if history:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS,
+                    zdict=history)
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        blocks.append((b'CK' + compressor.compress(chunk) + compressor.flush(),
+            len(chunk)))
+        history = chunk
+
+    return blocks
+
+def stored_blocks(data, block_size=32768):
+    return [(data[i:i + block_size], len(data[i:i + block_size]))
+            for i in range(0, len(data), block_size)]
+
+class LzxWriter(object):
+    """Write LZX bit fields: 16-bit little-endian words, each filled
+    from its most significant bit.
+    """
+
+    def __init__(self):
+        self.out = bytearray()
+        self.value = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        assert 0 <= value < (1 << bits) or bits == 0
+        self.value = (self.value << bits) | value
+        self.bits += bits
+
+    def align(self):
+        """Pad to a 16-bit boundary and move the bits to out."""
+        padding = -self.bits % 16
+        data = (self.value << padding).to_bytes((self.bits + padding) // 8,
+                'big')
+        self.out += bytes(b for pair in zip(data[1::2], data[0::2])
+                for b in pair)
+        self.value = 0
+        self.bits = 0
+
+    def take(self):
+        self.align()
+        ret = bytes(self.out)
+        self.out = bytearray()
+        return ret
+
+def huffman_lengths(freqs, n, limit):
+    """Return code lengths of at most limit for the symbols in freqs,
+    using at least two symbols.
+    """
+    freqs = dict((s, f) for s, f in freqs.items() if f)
+
+    for s in (0, 1):
+        if len(freqs) < 2:
+            freqs.setdefault(s, 1)
+
+    while True:
+        heap = [(f, [s]) for s, f in freqs.items()]
+        heapq.heapify(heap)
+        lengths = [0] * n
+
+        while len(heap) > 1:
+            f1, s1 = heapq.heappop(heap)
+            f2, s2 = heapq.heappop(heap)
+
+            for s in s1 + s2:
+                lengths[s] += 1
+
+            heapq.heappush(heap, (f1 + f2, s1 + s2))
+
+        if max(lengths) <= limit:
+            return lengths
+
+        freqs = dict((s, f // 2 + 1) for s, f in freqs.items())
+
+def canonical_codes(lengths):
+    codes = {}
+    code = 0
+
+    for length in range(1, max(lengths) + 1):
+        for symbol, symbol_length in enumerate(lengths):
+            if symbol_length == length:
+                codes[symbol] = (code, length)
+                code += 1
+
+        code <<= 1
+
+    return codes
+
+def lzx_slot(formatted):
+    slot = 0
+
+    while (slot + 1 < len(LZX_POSITION_BASE) and
+            LZX_POSITION_BASE[slot + 1] <= formatted):
+        slot += 1
+
+    return slot
+
+def _lzx_position_tables():
+    extra_bits = []
+    position_base = []
+    bits = 0
+    base = 0
+
+    for i in range(50):
+        extra_bits.append(bits)
+        position_base.append(base)
+        base += 1 << bits
+
+        if i & 1 and i > 1 and bits < 17:
+            bits += 1
+
+    return extra_bits, position_base
+
+LZX_EXTRA_BITS, LZX_POSITION_BASE = _lzx_position_tables()
+
+def e8_encode(data, file_size):
+    """Translate the targets of x86 CALL instructions from relative to
+    absolute, the other way round from the decoder.
+    """
+    out = bytearray(data)
+
+    for frame in range(0, len(data), 32768):
+        end = min(frame + 32768, len(data)) - 10
+        i = frame
+
+        while i < end:
+            if out[i] != 0xe8:
+                i += 1
+                continue
+
+            relative = int.from_bytes(out[i + 1:i + 5], 'little',
+                    signed=True)
+
+            if -i <= relative < file_size:
+                if relative < file_size - i:
+                    absolute = relative + i
+                else:
+                    absolute = relative - file_size
+
+                out[i + 1:i + 5] = (absolute & 0xffffffff).to_bytes(4,
+                        'little')
+
+            i += 5
+
+    return bytes(out)
+
+class LzxEncoder(object):
+    """Just enough of an LZX compressor to exercise the decoder. Blocks
+    are given explicitly as a list of (block type, size).
+    """
+
+    def __init__(self, window_bits=16):
+        self.window_bits = window_bits
+        self.main_size = 256 + {15: 30, 16: 32, 17: 34, 18: 36, 19: 38,
+                20: 42, 21: 50}[window_bits] * 8
+        self.main_lengths = [0] * self.main_size
+        self.length_lengths = [0] * 249
+        self.repeated = [1, 1, 1]
+
+    def tokens(self, data, start, end):
+        """Yield (literal, None, None) or (None, offset, length), never
+        crossing a 32K frame boundary.
+        """
+        window = 1 << self.window_bits
+        positions = {}
+        i = start
+
+        for j in range(max(0, start - window), start):
+            positions.setdefault(data[j:j + 3], []).append(j)
+
+        while i < end:
+            frame_end = min(end, (i // 32768 + 1) * 32768)
+            limit = min(257, frame_end - i)
+            best = (0, None)
+
+            # prefer the repeated offsets, if they're any good
+            candidates = list(self.repeated) + [i - j for j in
+                    reversed(positions.get(data[i:i + 3], [])[-32:])]
+
+            for offset in candidates:
+                if offset > i or offset >= window - 3:
+                    continue
+
+                length = 0
+
+                while (length < limit and
+                        data[i + length - offset] == data[i + length]):
+                    length += 1
+
+                if length > best[0]:
+                    best = (length, offset)
+
+            length = best[0] if best[0] >= 3 else 1
+
+            for j in range(i, i + length):
+                positions.setdefault(data[j:j + 3], []).append(j)
+
+            if length == 1:
+                yield (data[i], None, None)
+            else:
+                yield (None, best[1], length)
+
+            i += length
+
+    def encode_match(self, offset, length, aligned):
+        """Return (main symbol, length footer, [(verbatim bits, count)],
+        aligned symbol) and update the repeated offsets.
+        """
+        r = self.repeated
+        verbatim = []
+        aligned_symbol = None
+
+        if offset in r:
+            slot = r.index(offset)
+            r[0], r[slot] = r[slot], r[0]
+        else:
+            formatted = offset + 2
+            slot = lzx_slot(formatted)
+            extra = LZX_EXTRA_BITS[slot]
+            footer = formatted - LZX_POSITION_BASE[slot]
+
+            if aligned and extra >= 3:
+                verbatim.append((footer >> 3, extra - 3))
+                aligned_symbol = footer & 7
+            else:
+                verbatim.append((footer, extra))
+
+            r[2] = r[1]
+            r[1] = r[0]
+            r[0] = offset
+
+        header = min(length - 2, 7)
+        footer = length - 2 - 7 if header == 7 else None
+        return (256 + slot * 8 + header, footer, verbatim, aligned_symbol)
+
+    def write_lengths(self, w, previous, lengths):
+        # runs of zeros with 17 and 18, runs of the same length with 19
+        symbols = []
+        x = 0
+
+        while x < len(lengths):
+            run = 1
+
+            while (x + run < len(lengths) and
+                    lengths[x + run] == lengths[x]):
+                run += 1
+
+            delta = (previous[x] - lengths[x]) % 17
+
+            if lengths[x] == 0 and run >= 20:
+                run = min(run, 51)
+                symbols.append((18, (run - 20, 5)))
+            elif lengths[x] == 0 and run >= 4:
+                run = min(run, 19)
+                symbols.append((17, (run - 4, 4)))
+            elif run >= 4:
+                run = min(run, 5)
+                symbols.append((19, (run - 4, 1), delta))
+            else:
+                run = 1
+                symbols.append((delta,))
+
+            x += run
+
+        freqs = {}
+
+        for symbol in symbols:
+            freqs[symbol[0]] = freqs.get(symbol[0], 0) + 1
+
+            if symbol[0] == 19:
+                freqs[symbol[2]] = freqs.get(symbol[2], 0) + 1
+
+        pre_lengths = huffman_lengths(freqs, 20, 15)
+        codes = canonical_codes(pre_lengths)
+
+        for length in pre_lengths:
+            w.write(length, 4)
+
+        for symbol in symbols:
+            w.write(*codes[symbol[0]])
+
+            if len(symbol) > 1:
+                w.write(*symbol[1])
+
+            if symbol[0] == 19:
+                w.write(*codes[symbol[2]])
+
+        previous[:] = lengths
+
+    def compress(self, data, blocks, e8_file_size=None):
+        """Return a list of (compressed data, size) for each frame."""
+        assert sum(size for block_type, size in blocks) == len(data)
+        w = LzxWriter()
+        frames = []
+        done = 0
+
+        if e8_file_size is None:
+            w.write(0, 1)
+            source = data
+        else:
+            w.write(1, 1)
+            w.write(e8_file_size >> 16, 16)
+            w.write(e8_file_size & 0xffff, 16)
+            source = e8_encode(data, e8_file_size)
+
+        def end_frames(position):
+            nonlocal done
+
+            while position - done >= 32768 or (position == len(data) and
+                    position > done):
+                size = min(32768, position - done)
+                frames.append((w.take(), size))
+                done += size
+
+        position = 0
+
+        for block_type, size in blocks:
+            w.write(block_type, 3)
+            w.write(size >> 8, 16)
+            w.write(size & 0xff, 8)
+
+            if block_type == 3:
+                # 1 to 16 bits of padding
+                w.write(0, 16 - w.bits % 16)
+                w.align()
+                w.out += struct.pack('<III', *self.repeated)
+
+                end = position + size
+
+                while position < end:
+                    w.out.append(source[position])
+                    position += 1
+
+                    # padding to a 16-bit boundary
+                    if position == end and size & 1:
+                        w.out.append(0)
+
+                    end_frames(position)
+
+                continue
+
+            aligned = (block_type == 2)
+            tokens = []
+
+            for literal, offset, length in self.tokens(source, position,
+                    position + size):
+                if literal is None:
+                    tokens.append(self.encode_match(offset, length,
+                        aligned) + (length,))
+                else:
+                    tokens.append((literal, None, [], None, 1))
+
+            main_freqs = {}
+            length_freqs = {}
+            aligned_freqs = {}
+
+            for main, footer, verbatim, aligned_symbol, length in tokens:
+                main_freqs[main] = main_freqs.get(main, 0) + 1
+
+                if footer is not None:
+                    length_freqs[footer] = length_freqs.get(footer, 0) + 1
+
+                if aligned_symbol is not None:
+                    aligned_freqs[aligned_symbol] = (
+                            aligned_freqs.get(aligned_symbol, 0) + 1)
+
+            if aligned:
+                aligned_lengths = huffman_lengths(aligned_freqs, 8, 7)
+                aligned_codes = canonical_codes(aligned_lengths)
+
+                for length in aligned_lengths:
+                    w.write(length, 3)
+
+            main_lengths = huffman_lengths(main_freqs, self.main_size, 16)
+            length_lengths = huffman_lengths(length_freqs, 249, 16)
+            previous = self.main_lengths[:256]
+            self.write_lengths(w, previous, main_lengths[:256])
+            self.main_lengths[:256] = previous
+            previous = self.main_lengths[256:]
+            self.write_lengths(w, previous, main_lengths[256:])
+            self.main_lengths[256:] = previous
+            self.write_lengths(w, self.length_lengths, length_lengths)
+            main_codes = canonical_codes(main_lengths)
+            length_codes = canonical_codes(length_lengths)
+
+            for main, footer, verbatim, aligned_symbol, length in tokens:
+                w.write(*main_codes[main])
+
+                if footer is not None:
+                    w.write(*length_codes[footer])
+
+                for value, bits in verbatim:
+                    w.write(value, bits)
+
+                if aligned_symbol is not None:
+                    w.write(*aligned_codes[aligned_symbol])
+
+                position += length
+                end_frames(position)
+
+        end_frames(position)
+        return frames
+
+# Stands in for cabextract: it logs its arguments, then "extracts" the
+# members matching each -F pattern from the JSON file $FAKE_CAB_MEMBERS
+FAKE_CABEXTRACT = '''#!%s
+import fnmatch, json, os, sys
+with open(os.environ['FAKE_CAB_LOG'], 'a') as log:
+    log.write(json.dumps(sys.argv[1:]) + '\\n')
+out = sys.argv[sys.argv.index('-d') + 1]
+patterns = [sys.argv[i + 1] for i, a in enumerate(sys.argv) if a == '-F']
+with open(os.environ['FAKE_CAB_MEMBERS']) as reader:
+    members = json.load(reader)
+for name, data in members.items():
+    if any(fnmatch.fnmatchcase(name, p) for p in patterns):
+        path = os.path.join(out, name.replace('\\\\', '/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as writer:
+            writer.write(data)
+''' % sys.executable
+
+def make_cab(folders, files, flags=0, prev_cab=None, next_cab=None):
+    """folders is a list of (compression, [(data, uncompressed size)]).
+    files is a list of (name, size, offset in folder, folder index).
+    """
+    header_size = 36
+
+    if prev_cab is not None:
+        flags |= 1
+        header_size += len(prev_cab) + 1 + 1
+
+    if next_cab is not None:
+        flags |= 2
+        header_size += len(next_cab) + 1 + 1
+
+    files_offset = header_size + 8 * len(folders)
+    file_table = b''
+
+    for name, size, offset, folder_index in files:
+        file_table += struct.pack('<IIHHHH', size, offset, folder_index,
+                0x4821, 0, 0x20) + name + b'\0'
+
+    data_offset = files_offset + len(file_table)
+    folder_table = b''
+    data = b''
+
+    for compression, blocks in folders:
+        folder_table += struct.pack('<IHH', data_offset + len(data),
+                len(blocks), compression)
+
+        for block, size in blocks:
+            data += struct.pack('<IHH', 0, len(block), size) + block
+
+    total = data_offset + len(data)
+    header = b'MSCF' + struct.pack('<IIIIIBBHHHHH', 0, total, 0,
+            files_offset, 0, 3, 1, len(folders), len(files), flags, 1234, 0)
+
+    if prev_cab is not None:
+        header += prev_cab + b'\0\0'
+
+    if next_cab is not None:
+        header += next_cab + b'\0\0'
+
+    ret = header + folder_table + file_table + data
+    assert len(ret) == total
+    return ret
+
+def get_sample_cab():
+    mszip = mszip_blocks(DATA_PAK + HELLO_TXT)
+
+    return make_cab(
+            [(0, stored_blocks(LOGO_BMP)), (1, mszip)],
+            [
+                (b'bin\\Logo.bmp', len(LOGO_BMP), 0, 0),
+                (b'data.pak', len(DATA_PAK), 0, 1),
+                (b'HELLO.TXT', len(HELLO_TXT), len(DATA_PAK), 1),
+            ])
+
+class CabTestCase(unittest.TestCase):
+    def test_cab(self):
+        sample = io.BytesIO(get_sample_cab())
+        self.assertTrue(is_cab(sample))
+        self.assertFalse(is_cab(io.BytesIO(HELLO_TXT)))
+
+        with Cab(sample) as cab:
+            self.assertEqual(cab.namelist(),
+                    ['bin/Logo.bmp', 'data.pak', 'HELLO.TXT'])
+
+            # skipping data.pak, then going backwards
+            with cab.open('HELLO.TXT') as reader:
+                self.assertEqual(reader.read(), HELLO_TXT)
+
+            with cab.open('data.pak') as reader:
+                self.assertEqual(reader.read(7), DATA_PAK[:7])
+                self.assertEqual(reader.read(), DATA_PAK[7:])
+
+            with cab.open('bin/Logo.bmp') as reader:
+                self.assertEqual(reader.read(), LOGO_BMP)
+
+    def test_cabinet_set(self):
+        blocks = stored_blocks(LOGO_BMP, 10000)
+        # split the third block across the two cabinets
+        split, size = blocks[2]
+        first = make_cab([(0, blocks[:2] + [(split[:3000], 0)])],
+                [(b'Logo.bmp', len(LOGO_BMP), 0, 0xfffe),
+                    (b'hello.txt', len(HELLO_TXT), 100, 0)],
+                next_cab=b'second.cab')
+        second = make_cab([(0, [(split[3000:], size)] + blocks[3:])],
+                [(b'Logo.bmp', len(LOGO_BMP), 0, 0xfffd)],
+                prev_cab=b'first.cab')
+
+        with Cab(io.BytesIO(first), [io.BytesIO(second)]) as cab:
+            self.assertEqual(cab.namelist(), ['Logo.bmp', 'hello.txt'])
+
+            with cab.open('Logo.bmp') as reader:
+                self.assertEqual(reader.read(), LOGO_BMP)
+
+            with cab.open('hello.txt') as reader:
+                self.assertEqual(reader.read(), LOGO_BMP[100:114])
+
+        # without the second cabinet, we can't get it
+        with Cab(io.BytesIO(first)) as cab:
+            self.assertFalse(cab.getinfo('Logo.bmp').is_extractable)
+
+    def test_cabinet_set_on_disk(self):
+        blocks = stored_blocks(LOGO_BMP, 10000)
+        split, size = blocks[2]
+        first = make_cab([(0, blocks[:2] + [(split[:3000], 0)])],
+                [(b'Logo.bmp', len(LOGO_BMP), 0, 0xfffe)],
+                next_cab=b'SETUP2.CAB')
+        second = make_cab([(0, [(split[3000:], size)] + blocks[3:]),
+                    (0, stored_blocks(HELLO_TXT))],
+                [(b'Logo.bmp', len(LOGO_BMP), 0, 0xfffd),
+                    (b'hello.txt', len(HELLO_TXT), 0, 1)],
+                prev_cab=b'SETUP1.CAB')
+
+        with tempfile.TemporaryDirectory(prefix='gdptest.') as tmp:
+            for name, data in (('Setup1.cab', first), ('Setup2.cab', second)):
+                with open(os.path.join(tmp, name), 'wb') as writer:
+                    writer.write(data)
+
+            # the next and previous cabinets are found in the same
+            # directory, whichever one we start from
+            for name in ('Setup1.cab', 'Setup2.cab'):
+                with Cab(os.path.join(tmp, name)) as cab:
+                    self.assertEqual(cab.name, os.path.join(tmp, name))
+                    self.assertEqual(cab.namelist(),
+                            ['Logo.bmp', 'hello.txt'])
+
+                    with cab.open('Logo.bmp') as reader:
+                        self.assertEqual(reader.read(), LOGO_BMP)
+
+                    with cab.open('hello.txt') as reader:
+                        self.assertEqual(reader.read(), HELLO_TXT)
+
+            # or they can be found elsewhere
+            os.rename(os.path.join(tmp, 'Setup2.cab'),
+                    os.path.join(tmp, 'Setup2.cab?en'))
+            asked = []
+
+            def find_part(name, near):
+                asked.append((name, near))
+                return os.path.join(tmp, 'Setup2.cab?en')
+
+            with Cab(os.path.join(tmp, 'Setup1.cab'),
+                    find_part=find_part) as cab:
+                self.assertEqual(asked, [('SETUP2.CAB',
+                    os.path.join(tmp, 'Setup1.cab'))])
+
+                with cab.open('Logo.bmp') as reader:
+                    self.assertEqual(reader.read(), LOGO_BMP)
+
+            with Cab(os.path.join(tmp, 'Setup1.cab')) as cab:
+                self.assertFalse(cab.getinfo('Logo.bmp').is_extractable)
+
+    def test_lzx(self):
+        data = JACK_TXT + LOGO_BMP + DATA_PAK[:20000] + JACK_TXT[:5000]
+        n = len(data)
+
+        for window_bits, blocks in (
+                (15, [(1, n)]),
+                (16, [(2, n)]),
+                (16, [(3, n)]),
+                # blocks ending on and either side of frame boundaries,
+                # and odd-sized uncompressed blocks, which are padded
+                (16, [(1, 32767), (3, 2), (2, 32766), (3, 1), (1, 1001),
+                    (3, 1001), (2, n - 67538)]),
+                (21, [(2, 50000), (3, 15535), (1, n - 65535)])):
+            for e8_file_size in (None, 12000000):
+                frames = LzxEncoder(window_bits).compress(data, blocks,
+                        e8_file_size)
+                sample = make_cab([(3 | (window_bits << 8), frames)],
+                        [(b'one.dat', 70000, 0, 0),
+                            (b'two.dat', n - 70000, 70000, 0)])
+
+                with Cab(io.BytesIO(sample)) as cab:
+                    self.assertFalse(cab.needs_cabextract)
+
+                    with cab.open('two.dat') as reader:
+                        self.assertEqual(reader.read(), data[70000:])
+
+                    with cab.open('one.dat') as reader:
+                        self.assertEqual(reader.read(12345), data[:12345])
+                        self.assertEqual(reader.read(), data[12345:70000])
+
+        # a frame split between two cabinets
+        frames = LzxEncoder(16).compress(data, [(2, n)])
+        split, size = frames[1]
+        first = make_cab([(0x1003, frames[:1] + [(split[:100], 0)])],
+                [(b'data.bin', n, 0, 0xfffe)], next_cab=b'second.cab')
+        second = make_cab([(0x1003, [(split[100:], size)] + frames[2:])],
+                [(b'data.bin', n, 0, 0xfffd)], prev_cab=b'first.cab')
+
+        with Cab(io.BytesIO(first), [io.BytesIO(second)]) as cab:
+            with cab.open('data.bin') as reader:
+                self.assertEqual(reader.read(), data)
+
+        # corrupt data is detected
+        frames = LzxEncoder(16).compress(data, [(1, n)])
+        broken = bytearray(frames[0][0])
+        broken[100:110] = b'\xff' * 10
+        frames[0] = (bytes(broken), frames[0][1])
+
+        with Cab(io.BytesIO(make_cab([(0x1003, frames)],
+                [(b'data.bin', n, 0, 0)]))) as cab:
+            with cab.open('data.bin') as reader:
+                self.assertRaises(ValueError, reader.read)
+
+    def test_fixed_lzx(self):
+        with Cab(io.BytesIO(FIXED_LZX_CAB)) as cab:
+            self.assertEqual(cab.namelist(), ['Jack/dull.txt', 'again.txt'])
+
+            with cab.open('Jack/dull.txt') as reader:
+                self.assertEqual(reader.read(), JACK_TXT)
+
+            with cab.open('again.txt') as reader:
+                self.assertEqual(reader.read(), AGAIN_TXT)
+
+    def test_quantum(self):
+        # we can't decompress Quantum, so the contents don't matter
+        quantum = make_cab([(2, [(b'\0' * 100, 1000)])],
+                [(b'data\\one.pak', 500, 0, 0),
+                    (b'data\\two.pak', 500, 500, 0),
+                    (b'data\\unwanted.pak', 0, 1000, 0)])
+
+        with tempfile.TemporaryDirectory(prefix='gdptest.') as tmp:
+            bin = os.path.join(tmp, 'bin')
+            os.mkdir(bin)
+
+            with open(os.path.join(bin, 'cabextract'), 'w') as writer:
+                writer.write(FAKE_CABEXTRACT)
+
+            os.chmod(os.path.join(bin, 'cabextract'), 0o755)
+
+            with open(os.path.join(tmp, 'members.json'), 'w') as writer:
+                writer.write('{"data\\\\one.pak": "%s", '
+                        '"data\\\\two.pak": "%s", '
+                        '"data\\\\unwanted.pak": ""}' %
+                        ('1' * 500, '2' * 500))
+
+            with open(os.path.join(tmp, 'quantum.cab'), 'wb') as writer:
+                writer.write(quantum)
+
+            environ = dict(os.environ)
+            os.environ['PATH'] = bin + os.pathsep + os.environ['PATH']
+            os.environ['FAKE_CAB_LOG'] = os.path.join(tmp, 'log')
+            os.environ['FAKE_CAB_MEMBERS'] = os.path.join(tmp,
+                    'members.json')
+
+            try:
+                with Cab(os.path.join(tmp, 'quantum.cab'),
+                        tmpdir=tmp) as cab:
+                    self.assertTrue(cab.needs_cabextract)
+                    cab.prefetch(cab.entries[:2])
+
+                    with cab.open('data/two.pak') as reader:
+                        self.assertEqual(reader.read(), b'2' * 500)
+
+                    with cab.open('data/one.pak') as reader:
+                        self.assertEqual(reader.read(), b'1' * 500)
+
+                    # everything we asked for came from one run
+                    with open(os.path.join(tmp, 'log')) as reader:
+                        self.assertEqual(len(reader.readlines()), 1)
+
+                    with cab.open('data/unwanted.pak') as reader:
+                        self.assertEqual(reader.read(), b'')
+
+                    with open(os.path.join(tmp, 'log')) as reader:
+                        self.assertEqual(len(reader.readlines()), 2)
+
+                self.assertEqual(sorted(os.listdir(tmp)),
+                        ['bin', 'log', 'members.json', 'quantum.cab'])
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import json
+import os
+import tempfile
+import unittest
+
+from game_data_packager import (load_games)
+from game_data_packager.catalog import (Catalog,
+        describe_game,
+        identify_paths)
+
+from tests.plan import (set_contents)
+
+class CatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+        self.games = {}
+
+        for shortname in ('doom', 'heretic'):
+            self.games.update(load_games(game=shortname, use_vfs=False,
+                use_yaml=True))
+
+    def test_identify(self):
+        game = self.games['doom']
+        game.load_file_data()
+        provider = game.files['e1m4b.zip']
+        data = b'not really a zip file\n'
+        set_contents(provider, data)
+
+        catalog = Catalog.from_games(self.games)
+        # it survives being stored in vfs.zip
+        catalog = Catalog.from_data(json.loads(json.dumps(
+            catalog.to_data())))
+
+        self.assertEqual(catalog.candidates('/x/E1M4B.ZIP', len(data)),
+                set([('doom', 'e1m4b.zip')]))
+
+        os.makedirs(os.path.join(self.tmp.name, 'a', 'b'))
+        path = os.path.join(self.tmp.name, 'a', 'b', 'renamed.zip')
+
+        with open(path, 'wb') as writer:
+            writer.write(data)
+
+        # a hard link to the same file is not hashed again
+        os.link(path, os.path.join(self.tmp.name, 'a', 'link.zip'))
+
+        # a file of a size that no game has is never opened
+        unreadable = os.path.join(self.tmp.name, 'unreadable')
+
+        with open(unreadable, 'wb') as writer:
+            writer.write(b'x' * (len(data) + 1))
+
+        os.chmod(unreadable, 0)
+        self.assertEqual(catalog.candidates(unreadable, len(data) + 1),
+                set())
+
+        found = identify_paths(catalog, [self.tmp.name])
+        self.assertEqual(list(found), ['doom'])
+        self.assertEqual(list(found['doom']), ['e1m4b.zip'])
+
+        description = describe_game(game, found['doom'])
+        self.assertIn('  [x] doom-e1m4b-wad', description.splitlines())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import argparse
+import contextlib
+import io
+import os
+import signal
+import tempfile
+import time
+import unittest
+
+from game_data_packager import (load_games)
+from game_data_packager.command_line import (can_use_daemon)
+from game_data_packager.daemon import (Daemon, run_daemon_client)
+from game_data_packager.data import (HashedFile)
+
+from tests.plan import (set_contents)
+
+def log_hashing(log):
+    """Append the name of each file that is hashed to log."""
+    original = HashedFile.from_concatenated_files.__func__
+
+    def from_concatenated_files(cls, name, *args, **kwargs):
+        with open(log, 'a') as writer:
+            writer.write(name + '\n')
+
+        return original(cls, name, *args, **kwargs)
+
+    HashedFile.from_concatenated_files = classmethod(from_concatenated_files)
+
+class DaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+        self.socket = os.path.join(self.tmp.name, 'socket')
+        self.pid = None
+
+    def start_daemon(self, games, hashed=None):
+        self.pid = os.fork()
+
+        if self.pid == 0:
+            try:
+                if hashed is not None:
+                    log_hashing(hashed)
+
+                daemon = Daemon(games)
+                daemon.warm()
+                daemon.serve(self.socket)
+            finally:
+                os._exit(0)
+
+        for i in range(100):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.1)
+
+    def run_client(self, *argv):
+        out = io.StringIO()
+        err = io.StringIO()
+
+        with contextlib.redirect_stdout(out), \
+                contextlib.redirect_stderr(err):
+            status = run_daemon_client(self.socket, list(argv))
+
+        return status, out.getvalue(), err.getvalue()
+
+    def test_no_daemon(self):
+        self.assertIsNone(run_daemon_client(self.socket, ['--help']))
+
+    def test_identify(self):
+        games = load_games(game='doom', use_vfs=False, use_yaml=True)
+        games['doom'].load_file_data()
+        data = b'not really a zip file\n'
+        set_contents(games['doom'].files['e1m4b.zip'], data)
+
+        path = os.path.join(self.tmp.name, 'e1m4b.zip')
+
+        with open(path, 'wb') as writer:
+            writer.write(data)
+
+        hashed = os.path.join(self.tmp.name, 'hashed')
+        self.start_daemon(games, hashed=hashed)
+
+        # after the first time, the daemon already has the hashes
+        for i in range(3):
+            status, out, err = self.run_client('identify', path)
+            self.assertEqual(status, 0, err)
+            self.assertIn('e1m4b.zip: %s' % path, out)
+
+        with open(hashed) as reader:
+            self.assertEqual(reader.read(), path + '\n')
+
+        status, out, err = self.run_client('identify')
+        self.assertEqual(status, 2)
+        self.assertIn('Please specify some files', err)
+
+        # installing is not allowed
+        status, out, err = self.run_client('doom', '--install')
+        self.assertEqual(status, 2)
+        self.assertIn('cannot be installed by the daemon', err)
+
+    def test_can_use_daemon(self):
+        config = dict(install=False)
+
+        def args(game, **kwargs):
+            kwargs.setdefault('download', False)
+            return argparse.Namespace(game=game, **kwargs)
+
+        self.assertTrue(can_use_daemon(args('doom'), config))
+        self.assertTrue(can_use_daemon(args('identify'), config))
+        self.assertFalse(can_use_daemon(args('doom', install=True), config))
+        self.assertFalse(can_use_daemon(args('gog'), config))
+        self.assertFalse(can_use_daemon(args('steam'), config))
+        self.assertFalse(can_use_daemon(args('doom'), dict(install=True)))
+        self.assertTrue(can_use_daemon(args('doom', install=False),
+            dict(install=True)))
+
+        # steamcmd might ask for a password
+        bin = os.path.join(self.tmp.name, 'bin')
+        os.mkdir(bin)
+
+        with open(os.path.join(bin, 'steamcmd'), 'w') as writer:
+            writer.write('#!/bin/sh\nexit 1\n')
+
+        os.chmod(os.path.join(bin, 'steamcmd'), 0o755)
+        path = os.environ['PATH']
+
+        try:
+            os.environ['PATH'] = bin + os.pathsep + path
+            self.assertFalse(can_use_daemon(args('doom', download=True),
+                config))
+            self.assertTrue(can_use_daemon(args('doom', download=False),
+                config))
+        finally:
+            os.environ['PATH'] = path
+
+    def tearDown(self):
+        if self.pid:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
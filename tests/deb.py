@@ -15,6 +15,10 @@
 # You can find the GPL license text on a Debian system under
 # /usr/share/common-licenses/GPL-2.
 
+import gzip
+import lzma
+import os
+import tempfile
 import unittest
 
 from game_data_packager.data import (PackageRelation)
@@ -61,6 +65,130 @@ class DebTestCase(unittest.TestCase):
         t([dict(rpm='bar', generic='baz')], ['baz'])
         t([dict(rpm='bar')], [])
 
+    def test_package_database(self):
+        with tempfile.TemporaryDirectory(prefix='gdptest.') as root:
+            os.makedirs(os.path.join(root, 'var/lib/dpkg'))
+            os.makedirs(os.path.join(root, 'var/lib/apt/lists'))
+
+            with open(os.path.join(root, 'var/lib/dpkg/status'), 'w') as w:
+                w.write('''\
+Package: quake
+Status: install ok installed
+Version: 1:0.5.3
+Description: classic gothic/horror-themed first person shooter
+ Multi-line description, with a
+ Package: field that is not a package.
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+Version: 2.24-11
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Multi-Arch: same
+Version: 2.24-11
+
+Package: removed
+Status: deinstall ok config-files
+Version: 1.0
+''')
+
+            lists = os.path.join(root, 'var/lib/apt/lists')
+
+            with open(os.path.join(lists,
+                    'deb.debian.org_debian_dists_sid_main_binary-amd64_Packages'),
+                    'w') as w:
+                w.write('''\
+Package: quake
+Version: 1:0.5.3
+Depends: quake-engine,
+ libc6
+
+Package: libc6
+Version: 2.24-11
+''')
+
+            with gzip.open(os.path.join(lists,
+                    'deb.debian.org_debian_dists_sid_contrib_binary-amd64_Packages.gz'),
+                    'wt') as w:
+                w.write('''\
+Package: quake
+Version: 1:0.5.4
+''')
+
+            with open(os.path.join(lists, 'lock'), 'w') as w:
+                pass
+
+            dp = DebPackaging(root=root)
+
+            self.assertTrue(dp.is_installed('quake'))
+            self.assertTrue(dp.is_installed('libc6'))
+            self.assertFalse(dp.is_installed('removed'))
+            self.assertFalse(dp.is_installed('field'))
+            self.assertFalse(dp.is_installed('quake-engine'))
+            self.assertEqual(dp.current_version('quake'), '1:0.5.3')
+            self.assertEqual(dp.current_version('libc6'), '2.24-11')
+            self.assertIsNone(dp.current_version('removed'))
+
+            self.assertTrue(dp.is_available('quake'))
+            self.assertTrue(dp.is_available('libc6'))
+            self.assertFalse(dp.is_available('removed'))
+            self.assertEqual(dp.available_version('quake'), '1:0.5.4')
+
+    def test_no_package_database(self):
+        with tempfile.TemporaryDirectory(prefix='gdptest.') as root:
+            dp = DebPackaging(root=root)
+            self.assertFalse(dp.is_installed('quake'))
+            self.assertIsNone(dp.current_version('quake'))
+            self.assertFalse(dp.is_available('quake'))
+
+    def test_update_repository(self):
+        with tempfile.TemporaryDirectory(prefix='gdptest.') as repo:
+            dp = DebPackaging(root=repo)
+
+            def build(name, version):
+                deb = os.path.join(repo, '%s_%s_all.deb' % (name, version))
+                with open(deb, 'wb') as w:
+                    w.write(b'not really a .deb')
+                dp._built[deb] = (
+                        'Package: %s\n'
+                        'Version: %s\n'
+                        'Architecture: all\n'
+                        'Description: test\n'
+                        ' Long description.\n' % (name, version))
+                return deb
+
+            dp.update_repository(repo, [build('quake-registered', '1.0')])
+            gone = build('quake-music', '1.0')
+            dp.update_repository(repo, [gone])
+            os.remove(gone)
+            # forget about the first package to check that its existing
+            # entry is kept without needing its metadata
+            dp._built.clear()
+            debs = dp.update_repository(repo, [build('quake-shareware', '1.0')])
+
+            self.assertEqual(debs,
+                    set([os.path.join(repo, 'quake-shareware_1.0_all.deb')]))
+
+            with open(os.path.join(repo, 'Packages')) as r:
+                packages = r.read()
+            with lzma.open(os.path.join(repo, 'Packages.xz'), 'rt') as r:
+                self.assertEqual(r.read(), packages)
+
+            stanzas = packages.split('\n\n')
+            self.assertEqual(len(stanzas), 2)
+            self.assertTrue(stanzas[0].startswith('Package: quake-registered\n'))
+            self.assertIn('\n Long description.\n', stanzas[0])
+            self.assertIn('\nFilename: quake-registered_1.0_all.deb\n',
+                    stanzas[0])
+            self.assertIn('\nSize: 17\n', stanzas[0])
+            self.assertIn('\nMD5sum: ', stanzas[1])
+            self.assertIn('\nSHA256: ', stanzas[1])
+            self.assertNotIn('quake-music', packages)
+
     def tearDown(self):
         pass
 
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import json
+import os
+import tempfile
+import unittest
+
+from game_data_packager.gog import (Gog, GogMetadata)
+
+GAME_DETAILS = {
+    'date': '20160101T000000',
+    'games': [
+        {'gamename': 'the_ultimate_doom', 'installers': [
+            {'path': '/the_ultimate_doom/setup_the_ultimate_doom_2.0.0.3.exe',
+                'platform': 1}]},
+        {'gamename': 'teenagent', 'installers': [
+            {'path': '/teenagent/setup_teenagent_2.0.0.2.exe',
+                'platform': 1},
+            {'path': '/teenagent/gog_teenagent_2.0.0.3.sh',
+                'platform': 4}]},
+    ],
+}
+
+XML = ('<file name="%s" available="1" notavailablemsg="" md5="%s" '
+        'chunks="1" timestamp="1451606400" total_size="%d">\n'
+        '\t<chunk id="0" from="0" to="%d" method="md5">%s</chunk>\n'
+        '</file>\n')
+
+class CountingMetadata(GogMetadata):
+    def __init__(self, root):
+        super(CountingMetadata, self).__init__(root)
+        self.parsed = 0
+
+    def parse_xml(self, xml_file):
+        self.parsed += 1
+        return super(CountingMetadata, self).parse_xml(xml_file)
+
+class GogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+        self.gog = Gog()
+        self.gog.metadata = CountingMetadata(self.tmp.name)
+
+        with open(os.path.join(self.tmp.name, 'gamedetails.json'),
+                'w') as writer:
+            json.dump(GAME_DETAILS, writer)
+
+    def write_xml(self, game, basename, md5, size):
+        os.makedirs(os.path.join(self.tmp.name, 'xml', game), exist_ok=True)
+
+        with open(os.path.join(self.tmp.name, 'xml', game, basename + '.xml'),
+                'w') as writer:
+            writer.write(XML % (basename, md5, size, size - 1, md5))
+
+    def test_game_details(self):
+        self.assertIs(self.gog.is_native('teenagent'), True)
+        self.assertIs(self.gog.is_native('the_ultimate_doom'), False)
+        self.assertIsNone(self.gog.is_native('heretic'))
+        self.assertEqual(self.gog.get_id_from_archive(
+            '/tmp/setup_teenagent_2.0.0.2.exe'), 'teenagent')
+        self.assertIsNone(self.gog.get_id_from_archive('/tmp/setup_doom.exe'))
+
+        # "lgogdownloader --update-cache" replaces it
+        GAME_DETAILS['games'][0]['installers'][0]['platform'] = 4
+        path = os.path.join(self.tmp.name, 'gamedetails.json')
+
+        try:
+            with open(path, 'w') as writer:
+                json.dump(GAME_DETAILS, writer)
+        finally:
+            GAME_DETAILS['games'][0]['installers'][0]['platform'] = 1
+
+        os.utime(path, ns=(10**18, 10**18))
+        self.assertIs(self.gog.is_native('the_ultimate_doom'), True)
+
+        os.unlink(path)
+        self.assertIsNone(self.gog.is_native('the_ultimate_doom'))
+        self.assertIsNone(self.gog.get_id_from_archive(
+            '/tmp/setup_teenagent_2.0.0.2.exe'))
+
+    def test_verify_checksum(self):
+        exe = 'setup_teenagent_2.0.0.2.exe'
+        md5 = '0123456789abcdef0123456789abcdef'
+
+        self.assertFalse(self.gog.verify_checksum(exe, 1234, md5))
+
+        self.write_xml('teenagent', exe, md5, 1234)
+        self.write_xml('teenagent', 'gog_teenagent_2.0.0.3.sh', md5, 5678)
+
+        self.assertTrue(self.gog.verify_checksum('/srv/' + exe, 1234, md5))
+        self.assertFalse(self.gog.verify_checksum(exe, 1235, md5))
+        self.assertFalse(self.gog.verify_checksum(exe, 1234, 'f' * 32))
+        self.assertFalse(self.gog.verify_checksum('teenagent.exe', 1234, md5))
+        self.assertFalse(self.gog.verify_checksum(
+            'setup_doom_1.exe', 1234, md5))
+        self.assertEqual(self.gog.metadata.parsed, 1)
+
+        self.assertTrue(self.gog.verify_checksum(
+            'gog_teenagent_2.0.0.3.sh', 5678, md5))
+        self.assertEqual(self.gog.metadata.parsed, 2)
+
+        # a new installer in a new directory
+        self.write_xml('the_ultimate_doom', 'setup_the_ultimate_doom.exe',
+                md5, 42)
+        self.assertTrue(self.gog.verify_checksum(
+            'setup_the_ultimate_doom.exe', 42, md5))
+
+        # an updated installer
+        path = os.path.join(self.tmp.name, 'xml', 'teenagent', exe + '.xml')
+        self.write_xml('teenagent', exe, md5, 4321)
+        os.utime(path, ns=(10**18, 10**18))
+        self.assertFalse(self.gog.verify_checksum(exe, 1234, md5))
+        self.assertTrue(self.gog.verify_checksum(exe, 4321, md5))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
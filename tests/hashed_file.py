@@ -16,8 +16,12 @@
 # /usr/share/common-licenses/GPL-2.
 
 import hashlib
+import io
 import sys
 import unittest
+import zlib
+
+import yaml
 
 from game_data_packager.command_line import (TerminalProgress)
 from game_data_packager.data import (HashedFile)
@@ -95,6 +99,35 @@ class HashedFileTestCase(unittest.TestCase):
         self.assertIs(first.matches(second), False)
         self.assertIs(second.matches(first), False)
 
+    def test_crc32(self):
+        hf = HashedFile.from_concatenated_files('hello_world.txt',
+                [io.BytesIO(b'hello'), io.BytesIO(b', world!')])
+        self.assertEqual(hf.crc32, '%08x' % zlib.crc32(b'hello, world!'))
+
+        hf = HashedFile('hello.txt')
+        hf.crc32 = '3610A686'
+        self.assertEqual(hf.crc32, '3610a686')
+
+        with self.assertRaises(AssertionError):
+            hf.crc32 = '00000000'
+
+        # an unquoted CRC32 in YAML can come out as an int
+        hf = HashedFile('hello.txt')
+
+        with self.assertRaises(ValueError):
+            hf.crc32 = yaml.safe_load('crc32: 12345678')['crc32']
+
+        self.assertIsNone(hf.crc32)
+        hf.crc32 = yaml.safe_load('crc32: "12345678"')['crc32']
+        self.assertEqual(hf.crc32, '12345678')
+
+        # a CRC32 is not enough to say whether two files match
+        other = HashedFile('hello.txt')
+        other.crc32 = hf.crc32
+
+        with self.assertRaises(ValueError):
+            hf.matches(other)
+
     def test_progress(self):
         print('', file=sys.stderr)
         HashedFile.from_file('progress.bin', ZeroReader(SIZE),
@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import base64
+import hashlib
+import heapq
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+from game_data_packager.unpack.auto import (automatic_unpacker)
+from game_data_packager.unpack.lha import (Lha, crc16, is_lha)
+
+HELLO_TXT = b'Hello, world!\n'
+
+# something with long runs and repeated phrases, so that it exercises
+# overlapping matches as well as literals
+README_TXT = (b'All work and no play makes Jack a dull boy.\n' * 50 +
+        b'z' * 1000 + bytes(range(256)) * 4)
+
+# An archive with level 2 headers laid out the way LHa for UNIX writes
+# them (with Unix permissions, owner and mtime extended headers), with
+# one member compressed with -lh5- and one with -lh6-. The compressed data
+# uses several blocks per member, and data.bin repeats text from more
+# than 8K earlier, so it needs the larger -lh6- dictionary.
+# It was checked independently with libarchive's bsdtar and with
+# lhafile's C decoder, so unlike get_sample_lha() it does not depend on
+# the encoder in this file agreeing with the decoder.
+FIXED_LHA = base64.b64decode('''
+PwAtbGg1LS8GAAC4CwAAgMGFViACGrFVBQAAFPwNAAFyZWFkbWUudHh0BQBQpIEHAFHo
+A+gDBwBUgMGFVgAAAZBdkAKC44RjtAP8h5oeECIABJNOK223qAFsbLQfSPWGJ/e2K16/
+yzzESpZR5irihirg/OHpvZtCi3Xz9MThdQleLq4f7QUTgSkf3LvQ3BiY7Zw15RjQZSl/
+Lx5Eb0yrK0qCu+uHxl0UVqvSrHjkxJ5OYj8H+UiOdyiu5VT7YofTTu77Ie5SKPZIKM4z
+ORiNwOIuUuIkfznqnSEBSNHTdwx4Ymxwol0dYo2MGaiUL54mhUPqcpIa2U2zf8dzEsyP
+R9ok87iKt3eZNeieqCqOYQ6ksQUqSJxZvCmxCbssiKQZQX3iiqqsjDYusxI6Q6GNwn/R
+ChvjM6H70h6GXx95c85a1Nrdh/deF0w0YdMISkHvt2gmFRqrn3uw9vp2rrxB4FE7YVlE
+WbxJywXxyEqAZBmsANS47C+PcAPeRv1wPEQABEQYcf5u23d97AAMNGjVv091bEd9ji3/
+2hJH5ElzOXeOecIF24rnelo2LzP0RUK0Eh06P97R8CHrABxvXChLaMP5ltD+zLx7mN2R
+kkoUdmWyytaovrIugAmflL5s7/930n39aO9oIHzNv7qwIq6jWBG/CDjkuudwL6Y4vSYK
++mp54uhgmoyNaEun4Qgj0zPwSNAd2D4CO18LXl4FTMixiPC2GSChg4xvkBBErVgAvzoq
+UBIzuS502koFFXoR/sAuKSEUnmTcEo2y9hu29U5B3xJfHV2O9mz4HWvvDVTEa9ZFfTbX
+LQSTE1cqL0xXey0r0kE79/TnaNuv8Q1iUx0xuNgqsKccnCE24zMupYcmugNAmO552OTH
+x2ESehz+K7/tf9bgDuOzwO8azvwDrPBdOkf+CJ5gEM/njDOGaZt6i+4sSyY8H0FneiwO
+aAaBb1Tf2VPnmyi4lSQmIVaqi52bGdC/Jc7KJEN6jYwGQXrADUqyE8fcAPeRv24HqpUP
+EiEsOP/RW+wADu1jRl0vLbgc6QqYhdcIcEaiiphAvugvNzl8HBC1FXr4GjopNCvvy8WC
+aJEW62UuV4zy3afN5OQzCYpP6LkadF0VZCkZgJPzn9+T1AVbhSduiMY8M7AeIsggldYx
+A/zoL/flf0t0owg1BdeiQ9IhrDt8PIeW1LekO0Q2oVtlgax9OcBmC85/S0LFY3BhIES9
+zgKlAgFs/HmystQS08FGXrHRUeu4/EEt63NoJL8MzYpEuiY4E8R1glMk9C9t8LcUVtja
+8gPeppP5+KA/PLTlaQgJUp+qT9bNnxznpQA9HGcVEo5ckd6WAWZ689c5R4wCRvZm1SKY
+hLYJPEnqU/8152H2EJqnRO29J6iT14DAoy/opTjY9Mp5KRk4Cz0c9EASHZY+uzaMifHH
+fB6z/pcUAETLKQRRSUEu00KPEDO/TvjrcvBSi1Z7jrHYC7NGXmUAmawBizwm3tlWO1y3
+7QT3CAUybPutuc2hXPI9eDS7aXBYLwJ4SFcfZNDQIanhvq2eQYP4BS5i9nBwdSctgBe2
+ljblYEqeuBhQPF7PHd/CX0qEInCiCv9Cf0NZRx5XmFTeOb/STi97W/MQ/EBQF2QAsSbi
+GPdAJkX10PKMRWIqgCqacf9wcNmFNAAA10ZUVmgw/ZzXGmoI0jzV1c6TOMvn0THDfDbT
+1J0ZGm1UYcZvx1vDDc7pGfU3WhwsrbBAvAdkSMeLBakZc6LEH9YzunlTk8n4oQGXGGdC
+016zI86ad+azmhUFSlZAMpnixRpgD5jHfNdM6k3gpgE1s4L/irBy9UQxRHQ29mPpvmAH
+LX2vc8QcuoSblBd3ScSErIddVy2n42ZKa7OGq8RPCyan/jmSrw49IghxoDeWNsCxdpik
+masobKZFrMguSruRB4pAxVqIiHFlk2P6XZd7L2CDZ+DZB+NnvS9VDNU2bEaxIfuEodOt
+1evxThxrD1MEkxPAf5Oy6+VLj07kLHom0bkKjZb3nr7VzDEPC7s9wY0Sl9rsel4qwyjq
+6BRHgVt42DYzBTOIjeJNK/1QNaFkb30wV8/3E5IS2j+cJJYgCpG1ErwPNONMizBKrTKc
+Stuylog71c7kMoQIXVUZ87oua23frcAoI+4lOaEQb7HTm70L47zviS8wx1pQ2i5ASMSJ
+tsO7mANpyVYhjQ6v/vxFAC1saDYttwMAALQtAACAwYVWIALMP1UFAACjpwsAAWRhdGEu
+YmluCAACZGF0Yf8FAFCkgQcAUegD6AMHAFSAwYVWAAABkGWwAELDkH+7ADv4nmB4SBAN
+RpDDinXrVAACRFovWYK6lHgO/UkIXcQwVwE0Zc8XpSAtlFmJcBF7asOaCWWI5s+1z0Np
+WDl9BgGJr5UEcY0mwMnyvfTf16mikJLcn2wIokcrOZya1lKCROaXk+AcRDKgoAs8BhdT
+mR59UEjdO22tEtn7M7gaAsnt2Eyyc3j+A5RNksKQFLoOadXhLnvNFUdwH+oL67tc5iX9
+W7mw8ZJ6CD59OZ7hdsFSvsvdFDo5v+ixF900sn8eQlYb9XWroM5y/Hn5jHaHhPcSeDud
+YdEVB6+bPV8BAbeZoc3372VerIlg3Tt9WGbd4au2BzK6bDUH13iBxQVbxoh8Vbe0xaOO
+d4PZwGpp23dM3n2H9lluWXwE9lOZqb+5odT+ynueZEF2pLrVS0HOgGQVbAAMtwn77gDP
+xfbg8BCgKFW8cZdtdssAAWxoxKFYKVI84iBhttp6AAp8CR0BfJuV17vX5oYbIom/ufMW
+cfdEolU1XBNLcob58Y10AVCE63Vg8SCeFfPgbVaZ0V9Yjvtq+1hNXQMmNJJfdYpqhdh+
+SE4zrDAfdtAhd7KS/mhY3gTWWCsuS+MurthA9M0yD2lCqJmAsG7Gm64/YNIxL9eDz4oi
+4L2YA4vcgHeQQOCECplq1NdwnJbsKWP0ClLvXiaLeuZ/dXSTHnnvT7cpWf60XezWh10E
+uK8qqzguY61IBvAdWNIkehxZJjguY/D5OBlyBytWqfsXZfT++Ct7JzT5iX9LgYeqUgyd
+ESEjP37penM+K4SR3WmtZavnPE3YVyRCFUfYPdbfjdGqkESjzx4rr+PUBKDxvdlJFUPY
+QE1luMEPBH/++rWsjg1Wu+hEBnUyJWJR8RIzFKHFNQnktyeM3mtp9BP1QfTq/7Nxu4A0
+16MGoaa/zzMAN6H5geFphtSgABS2w4+DGxoB2HRg7/fQAhRbIAbKa632b/zmV0t7aUWa
+OULrpLJ130MmaLRQWF/HL2OFy5cuXLly5cuXLly5cuXLly5cuXLly5cuXLly5cv/XB9c
+H1wfXB9f/H172txwne+Xou66KSv2Edvpz+CCKpGQXJVHhFF/c45uRHoiIlE2me5ZLyY+
++e2+fd8ei91F9GmUEZgblDH2+aMqcc2Sflkio21tHTZdjs63uRUcmdiKLvBMryXAoopg
+2D64yRWdwX3stfU/wWfWS/NG3Z9EgcNu0XRuvoz0TncF3kaqvjyVvI1efmi0qbrezWYL
+0t1cGT1plXHczyRIFWAA
+''')
+FIXED_LHA_CONTENTS = {
+    'readme.txt': (3000,
+        '7f31755379221c03772701b2054fc94c862730fffe26ced505578eee6e9a8c45'),
+    'data/data.bin': (11700,
+        'b1cfc57a7f792dc6d37e12daa0c608ee3145ca55f6ff72650c40b76ae669bba6'),
+}
+
+class _BitWriter(object):
+    def __init__(self):
+        self.value = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        assert 0 <= value < (1 << bits) or bits == 0
+        self.value = (self.value << bits) | value
+        self.bits += bits
+
+    def getvalue(self):
+        padding = -self.bits % 8
+        return (self.value << padding).to_bytes((self.bits + padding) // 8,
+                'big')
+
+def _huffman_lengths(freqs, n):
+    """Return code lengths for the symbols in freqs."""
+    heap = [(f, [s]) for s, f in freqs.items() if f]
+    heapq.heapify(heap)
+    lengths = [0] * n
+
+    while len(heap) > 1:
+        f1, s1 = heapq.heappop(heap)
+        f2, s2 = heapq.heappop(heap)
+
+        for s in s1 + s2:
+            lengths[s] += 1
+
+        heapq.heappush(heap, (f1 + f2, s1 + s2))
+
+    assert max(lengths) <= 16
+    return lengths
+
+def _canonical_codes(lengths):
+    codes = {}
+    code = 0
+
+    for length in range(1, max(lengths) + 1):
+        for symbol, symbol_length in enumerate(lengths):
+            if symbol_length == length:
+                codes[symbol] = (code, length)
+                code += 1
+
+        code <<= 1
+
+    return codes
+
+def _write_pt_lengths(w, lengths, nbit, special):
+    n = max(i + 1 for i, l in enumerate(lengths) if l)
+    w.write(n, nbit)
+
+    for i in range(n):
+        if lengths[i] < 7:
+            w.write(lengths[i], 3)
+        else:
+            w.write(7, 3)
+            w.write((1 << (lengths[i] - 7)) - 1, lengths[i] - 7)
+            w.write(0, 1)
+
+        if i + 1 == special:
+            # no run of zeroes here
+            w.write(0, 2)
+
+def encode_lh5(data):
+    """A simple -lh5- compressor, for testing."""
+    tokens = []
+    last_seen = {}
+    i = 0
+
+    while i < len(data):
+        key = data[i:i + 3]
+        j = last_seen.get(key)
+        length = 0
+
+        if j is not None and i - j <= 8192:
+            while (length < 256 and i + length < len(data) and
+                    data[j + length] == data[i + length]):
+                length += 1
+
+        if len(key) == 3:
+            last_seen[key] = i
+
+        if length >= 3:
+            tokens.append((256 + length - 3, i - j - 1))
+            i += length
+        else:
+            tokens.append((data[i], None))
+            i += 1
+
+    assert len(tokens) < 65536
+
+    def position_code(p):
+        return p.bit_length()
+
+    c_freqs = {}
+    p_freqs = {}
+
+    for c, p in tokens:
+        c_freqs[c] = c_freqs.get(c, 0) + 1
+
+        if p is not None:
+            code = position_code(p)
+            p_freqs[code] = p_freqs.get(code, 0) + 1
+
+    c_lengths = _huffman_lengths(c_freqs, 510)
+    p_lengths = _huffman_lengths(p_freqs, 14)
+
+    # encode the c lengths using the t alphabet
+    t_symbols = []
+    n_c = max(i + 1 for i, l in enumerate(c_lengths) if l)
+    i = 0
+
+    while i < n_c:
+        if c_lengths[i]:
+            t_symbols.append((c_lengths[i] + 2, None, 0))
+            i += 1
+            continue
+
+        run = 0
+
+        while i + run < n_c and not c_lengths[i + run]:
+            run += 1
+
+        if run >= 20:
+            run = min(run, 20 + 511)
+            t_symbols.append((2, run - 20, 9))
+        elif run >= 3:
+            run = min(run, 18)
+            t_symbols.append((1, run - 3, 4))
+        else:
+            run = 1
+            t_symbols.append((0, None, 0))
+
+        i += run
+
+    t_freqs = {}
+
+    for t, _, _ in t_symbols:
+        t_freqs[t] = t_freqs.get(t, 0) + 1
+
+    t_lengths = _huffman_lengths(t_freqs, 19)
+
+    w = _BitWriter()
+    w.write(len(tokens), 16)
+
+    t_codes = _canonical_codes(t_lengths)
+    _write_pt_lengths(w, t_lengths, 5, 3)
+
+    w.write(n_c, 9)
+
+    for t, extra, extra_bits in t_symbols:
+        w.write(*t_codes[t])
+
+        if extra_bits:
+            w.write(extra, extra_bits)
+
+    c_codes = _canonical_codes(c_lengths)
+
+    if p_freqs:
+        p_codes = _canonical_codes(p_lengths)
+        _write_pt_lengths(w, p_lengths, 4, -1)
+    else:
+        p_codes = None
+        w.write(0, 4)
+        w.write(0, 4)
+
+    for c, p in tokens:
+        w.write(*c_codes[c])
+
+        if p is not None:
+            code = position_code(p)
+            w.write(*p_codes[code])
+
+            if code > 1:
+                w.write(p - (1 << (code - 1)), code - 1)
+
+    return w.getvalue()
+
+def level0_header(name, method, compressed, size, crc):
+    body = (method + struct.pack('<IIIBB', len(compressed), size,
+        0x48210000, 0x20, 0) + bytes([len(name)]) + name +
+        struct.pack('<H', crc))
+    return bytes([len(body), sum(body) & 0xff]) + body
+
+def level1_header(name, dirname, method, compressed, size, crc):
+    ext = bytes([0x02]) + dirname
+    ext += struct.pack('<H', 0)
+    body = (method + struct.pack('<IIIBB', len(compressed) + len(ext), size,
+        0x48210000, 0x20, 1) + bytes([len(name)]) + name +
+        struct.pack('<HBH', crc, ord('U'), len(ext)))
+    return bytes([len(body), sum(body) & 0xff]) + body + ext
+
+def level2_header(name, dirname, method, compressed, size, crc):
+    # the common header holds the CRC-16 of the whole header, which we
+    # fill in later
+    exts = [b'\0\0\0', bytes([0x01]) + name, bytes([0x02]) + dirname]
+    ext_data = b''
+
+    for i, ext in enumerate(exts):
+        if i + 1 < len(exts):
+            next_size = len(exts[i + 1]) + 2
+        else:
+            next_size = 0
+
+        ext_data += ext + struct.pack('<H', next_size)
+
+    fixed_size = 26
+    total = fixed_size + len(ext_data)
+    header = (struct.pack('<H', total) + method + struct.pack('<IIIBBHBH',
+        len(compressed), size, 1234567890, 0x20, 2, crc, ord('U'),
+        len(exts[0]) + 2) + ext_data)
+    return (header[:fixed_size + 1] + struct.pack('<H', crc16(header)) +
+            header[fixed_size + 3:])
+
+def get_sample_lha():
+    readme = encode_lh5(README_TXT)
+    hello = encode_lh5(HELLO_TXT)
+
+    return b''.join([
+        # pretend to be a self-extracting archive
+        b'MZ' + b'\0' * 100,
+        level0_header(b'README.TXT', b'-lh5-', readme, len(README_TXT),
+            crc16(README_TXT)),
+        readme,
+        level1_header(b'HELLO.TXT', b'DOCS\xff', b'-lh0-', HELLO_TXT,
+            len(HELLO_TXT), crc16(HELLO_TXT)),
+        HELLO_TXT,
+        level2_header(b'hello.txt', b'docs\xffen\xff', b'-lh5-', hello,
+            len(HELLO_TXT), crc16(HELLO_TXT)),
+        hello,
+        b'\0',
+        ])
+
+class LhaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sample = io.BytesIO(get_sample_lha())
+
+    def test_crc16(self):
+        # check value for CRC-16/ARC
+        self.assertEqual(crc16(b'123456789'), 0xbb3d)
+
+    def test_lha(self):
+        self.assertTrue(is_lha(self.sample))
+        self.assertFalse(is_lha(io.BytesIO(HELLO_TXT)))
+
+        with Lha(self.sample) as lha:
+            self.assertEqual(lha.format, 'lha')
+            self.assertEqual(lha.namelist(),
+                    ['README.TXT', 'DOCS/HELLO.TXT', 'docs/en/hello.txt'])
+            self.assertEqual([e.level for e in lha], [0, 1, 2])
+            self.assertEqual(lha.getinfo('docs/en/hello.txt').mtime,
+                    1234567890)
+
+            # in a different order than they appear in the archive
+            with lha.open('docs/en/hello.txt') as reader:
+                self.assertEqual(reader.read(), HELLO_TXT)
+
+            with lha.open('README.TXT') as reader:
+                self.assertEqual(reader.read(10), README_TXT[:10])
+                self.assertEqual(reader.read(), README_TXT[10:])
+
+            with lha.open('DOCS/HELLO.TXT') as reader:
+                self.assertEqual(reader.read(), HELLO_TXT)
+
+    def test_fixed(self):
+        with Lha(io.BytesIO(FIXED_LHA)) as lha:
+            self.assertEqual([(e.name, e.method, e.level) for e in lha],
+                    [('readme.txt', b'-lh5-', 2),
+                        ('data/data.bin', b'-lh6-', 2)])
+
+            for name, (size, sha256) in FIXED_LHA_CONTENTS.items():
+                with lha.open(name) as reader:
+                    data = reader.read()
+
+                self.assertEqual(len(data), size)
+                self.assertEqual(hashlib.sha256(data).hexdigest(), sha256)
+
+    def test_corrupt(self):
+        sample = bytearray(get_sample_lha())
+        # somewhere in README.TXT's compressed data
+        sample[sample.index(b'README.TXT') + 50] ^= 0xff
+
+        with Lha(io.BytesIO(sample)) as lha:
+            with lha.open('README.TXT') as reader:
+                self.assertRaises(ValueError, reader.read)
+
+    def test_not_lha(self):
+        header = level2_header(b'hello.txt', b'docs\xff', b'-lh5-', b'',
+                len(HELLO_TXT), crc16(HELLO_TXT))
+        self.assertTrue(is_lha(io.BytesIO(b'MZ' + header + b'\0')))
+
+        # something in an executable that happens to look a bit like a
+        # level 2 header, but has the wrong CRC
+        corrupt = bytearray(header)
+        corrupt[corrupt.index(b'hello.txt')] ^= 0x20
+        self.assertFalse(is_lha(io.BytesIO(b'MZ' + corrupt + b'\0')))
+
+        # or random data after the method
+        junk = header[:21] + bytes(range(40))
+        self.assertFalse(is_lha(io.BytesIO(b'MZ' + junk)))
+
+        with tempfile.TemporaryDirectory(prefix='gdptest.') as tmp:
+            path = os.path.join(tmp, 'setup.exe')
+
+            # the first header is fine, but the second is not
+            with open(path, 'wb') as writer:
+                writer.write(b'MZ' + header + corrupt + b'\0')
+
+            self.assertRaises(ValueError, Lha, path)
+
+            with open(path, 'rb') as reader:
+                self.assertIsNone(automatic_unpacker(path, reader))
+
+    def tearDown(self):
+        del self.sample
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
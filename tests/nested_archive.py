@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+
+import game_data_packager.config
+from game_data_packager import (load_games)
+from game_data_packager.build import (FillResult)
+from game_data_packager.config import (read_config)
+
+from tests.plan import (set_contents)
+
+def make_zip(members):
+    buf = io.BytesIO()
+
+    with zipfile.ZipFile(buf, 'w') as writer:
+        for name, data in members:
+            writer.writestr(name, data)
+
+    return buf.getvalue()
+
+class NestedArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+        self.game = load_games(game='compet-n', use_vfs=False,
+                use_yaml=True)['compet-n']
+        self.game.load_file_data()
+        self.package = self.game.packages['doom-compet-n-data']
+        files = self.game.files
+
+        # mm2.zip contains mm2info.zip, which is only wanted for its
+        # contents, so it does not need to be extracted to disk
+        inner_members = []
+
+        for wanted in files['mm2info.zip'].provides_files:
+            data = ('contents of %s\n' % wanted.name).encode('ascii')
+            inner_members.append((wanted.name, data))
+            set_contents(wanted, data)
+
+        inner = make_zip(inner_members)
+        set_contents(files['mm2info.zip'], inner)
+        outer_members = [('mm2info.zip', inner)]
+
+        for wanted in files['mm2.zip'].provides_files:
+            if wanted.name != 'mm2info.zip':
+                data = ('contents of %s\n' % wanted.name).encode('ascii')
+                outer_members.append((wanted.name, data))
+                set_contents(wanted, data)
+
+        self.inner_size = len(inner)
+        self.path = os.path.join(self.tmp.name, 'mm2.zip')
+
+        outer = make_zip(outer_members)
+        set_contents(files['mm2.zip'], outer)
+
+        with open(self.path, 'wb') as writer:
+            writer.write(outer)
+
+    def get_mm2info(self, task):
+        task.consider_file_or_dir(self.path)
+        self.assertIn('mm2.zip', task.found)
+        self.assertIs(task.fill_gap(self.package,
+            self.game.files['mm2info.wad']), FillResult.COMPLETE)
+        self.assertIn('mm2info.wad', task.found)
+        return os.path.join(task.get_workdir(), 'tmp', 'mm2info.zip')
+
+    def test_in_memory(self):
+        with self.game.construct_task() as task:
+            task.nested_archive_limit = self.inner_size
+            extracted = self.get_mm2info(task)
+
+            self.assertIn('mm2info.zip', task.unpacked_in_memory)
+            self.assertIn('mm2info.zip', task.unpack_tried)
+            self.assertNotIn('mm2info.zip', task.found)
+            self.assertIs(task.file_status['mm2info.zip'],
+                    FillResult.COMPLETE)
+            self.assertFalse(os.path.exists(extracted))
+
+            # it does not need to be considered again
+            self.assertIs(task.fill_gap(self.package,
+                self.game.files['mm2info.zip']), FillResult.COMPLETE)
+
+    def test_too_big(self):
+        with self.game.construct_task() as task:
+            task.nested_archive_limit = self.inner_size - 1
+            extracted = self.get_mm2info(task)
+
+            # it went through the workdir instead
+            self.assertNotIn('mm2info.zip', task.unpacked_in_memory)
+            self.assertEqual(task.found['mm2info.zip'], extracted)
+            self.assertTrue(os.path.exists(extracted))
+
+    def test_config(self):
+        config = os.path.join(self.tmp.name, 'game-data-packager.conf')
+        saved = game_data_packager.config.CONFIG
+        game_data_packager.config.CONFIG = config
+
+        try:
+            for value, expected in (('""', ''), ('"16"', '16'), ('16', '16'),
+                    ('"lots"', '')):
+                with open(config, 'w') as writer:
+                    writer.write('NESTED_ARCHIVE_LIMIT=%s\n' % value)
+
+                self.assertEqual(read_config()['nested_archive_limit'],
+                        expected)
+        finally:
+            game_data_packager.config.CONFIG = saved
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
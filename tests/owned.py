@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import http.server
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from game_data_packager.gog import (Gog)
+from game_data_packager.owned import (OwnedGamesCache)
+from game_data_packager.steam import (owned_steam_games)
+
+STEAM_ID = '76561197960287930'
+
+STEAM_XML = b'''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<gamesList>
+  <steamID64>76561197960287930</steamID64>
+  <games>
+    <game><appID>2280</appID><name><![CDATA[Ultimate Doom]]></name></game>
+    <game><appID>2270</appID><name><![CDATA[Wolfenstein 3D]]></name></game>
+  </games>
+</gamesList>
+'''
+
+GAME_DETAILS = {
+    'date': '20160101T000000',
+    'games': [
+        {'gamename': 'the_ultimate_doom', 'installers': [
+            {'path': '/the_ultimate_doom/setup_the_ultimate_doom_2.0.0.3.exe',
+                'platform': 1}]},
+        {'gamename': 'heretic', 'installers': []},
+    ],
+}
+
+class SteamCommunity(http.server.BaseHTTPRequestHandler):
+    requests = 0
+
+    def do_GET(self):
+        assert self.path == '/profiles/%s/games?xml=1' % STEAM_ID, self.path
+        SteamCommunity.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.end_headers()
+        self.wfile.write(STEAM_XML)
+
+    def log_message(self, *args):
+        pass
+
+class OwnedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+        self.environ = dict(os.environ)
+        os.environ['HOME'] = os.path.join(self.tmp.name, 'home')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp.name, 'cache')
+        os.makedirs(os.environ['HOME'])
+
+    def test_cache(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return ['a', 'b'] if len(calls) < 3 else None
+
+        cache = OwnedGamesCache('test')
+        self.assertEqual(cache.get('me', fetch), ['a', 'b'])
+        self.assertEqual(cache.get('me', fetch), ['a', 'b'])
+        self.assertEqual(len(calls), 1)
+
+        # a different account
+        self.assertEqual(cache.get('you', fetch), ['a', 'b'])
+        self.assertEqual(len(calls), 2)
+
+        # the cache has expired and fetching fails: use it anyway
+        cache = OwnedGamesCache('test', ttl=0)
+        self.assertEqual(cache.get('you', fetch), ['a', 'b'])
+        self.assertEqual(len(calls), 3)
+
+        # empty lists are not cached
+        cache = OwnedGamesCache('empty')
+        self.assertEqual(cache.get('me', lambda: []), [])
+        self.assertEqual(cache.get('me', lambda: ['c']), ['c'])
+
+    def test_steam(self):
+        server = http.server.HTTPServer(('127.0.0.1', 0), SteamCommunity)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:%d' % server.server_port
+        expected = [(2280, 'Ultimate Doom'), (2270, 'Wolfenstein 3D')]
+
+        try:
+            self.assertEqual(owned_steam_games(STEAM_ID, url=url), expected)
+            self.assertEqual(SteamCommunity.requests, 1)
+
+            # a later run uses the cache
+            owned_steam_games.STEAM_GAMES.clear()
+            self.assertEqual(owned_steam_games(STEAM_ID, url=url), expected)
+            self.assertEqual(SteamCommunity.requests, 1)
+
+            owned_steam_games.STEAM_GAMES.clear()
+            self.assertEqual(owned_steam_games(STEAM_ID, url=url,
+                refresh=True), expected)
+            self.assertEqual(SteamCommunity.requests, 2)
+        finally:
+            owned_steam_games.STEAM_GAMES.clear()
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+    def test_gog(self):
+        bin = os.path.join(self.tmp.name, 'bin')
+        os.makedirs(bin)
+        os.environ['PATH'] = bin + os.pathsep + os.environ['PATH']
+        calls = os.path.join(self.tmp.name, 'calls')
+
+        # a stand-in for lgogdownloader that hasn't been logged in,
+        # so it doesn't have gamedetails.json
+        with open(os.path.join(bin, 'lgogdownloader'), 'w') as writer:
+            writer.write('#!/bin/sh\n'
+                    'echo "$@" >> %s\n'
+                    'echo the_ultimate_doom\n'
+                    'echo heretic\n' % calls)
+        os.chmod(os.path.join(bin, 'lgogdownloader'), 0o755)
+
+        self.assertEqual(Gog().owned_games(),
+                ['the_ultimate_doom', 'heretic'])
+        self.assertEqual(Gog().owned_games(),
+                ['the_ultimate_doom', 'heretic'])
+
+        with open(calls) as reader:
+            self.assertEqual(reader.read(), '--list\n')
+
+        # after "lgogdownloader --update-cache", its cache is used instead
+        details = os.path.join(os.environ['HOME'], '.cache',
+                'lgogdownloader', 'gamedetails.json')
+        os.makedirs(os.path.dirname(details))
+        GAME_DETAILS['games'].pop()
+
+        with open(details, 'w') as writer:
+            json.dump(GAME_DETAILS, writer)
+
+        os.utime(details, ns=(10**18, 10**18))
+        self.assertEqual(Gog().owned_games(), ['the_ultimate_doom'])
+
+        # it is not parsed again until lgogdownloader rewrites it
+        with open(details, 'w') as writer:
+            writer.write('this is not JSON')
+
+        os.utime(details, ns=(10**18, 10**18))
+        self.assertEqual(Gog().owned_games(), ['the_ultimate_doom'])
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import types
+import unittest
+import zipfile
+
+from game_data_packager import (load_games)
+from game_data_packager.build import (FillResult)
+from game_data_packager.plan import (Executor, Step)
+from tests.cab import (get_sample_cab, make_cab)
+
+def set_contents(wanted, data):
+    # replace the real file's details with our made-up version
+    wanted._size = len(data)
+    wanted._md5 = hashlib.md5(data).hexdigest()
+    wanted._sha1 = hashlib.sha1(data).hexdigest()
+    wanted._sha256 = hashlib.sha256(data).hexdigest()
+    wanted._crc32 = None
+
+class PlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+        self.game = load_games(game='doom', use_vfs=False,
+                use_yaml=True)['doom']
+
+    def test_plan(self):
+        package = self.game.packages['doom-e1m4b-wad']
+
+        with self.game.construct_task() as task:
+            # nothing has been found, but the zip can be downloaded
+            plan = task.plan([package], download=True)
+            self.assertEqual([(s.action, s.wanted.name) for s in plan.steps],
+                    [('download', 'e1m4b.zip'), ('unpack', 'e1m4b.zip')])
+            self.assertEqual(plan.steps[1].inputs, [plan.steps[0]])
+            self.assertEqual(plan.steps[1].targets,
+                    set(['e1m4b.txt', 'e1m4b.wad']))
+            self.assertEqual(plan.missing, {'doom-e1m4b-wad': set()})
+            self.assertEqual(plan.download_bytes,
+                    self.game.files['e1m4b.zip'].size)
+
+            # without downloading, it can't be done
+            plan = task.plan([package])
+            self.assertEqual(plan.steps, [])
+            self.assertIn('e1m4b.wad', plan.missing['doom-e1m4b-wad'])
+
+    def test_estimate(self):
+        packages = [self.game.packages['doom-e1m4b-wad'],
+                self.game.packages['doom-wad']]
+
+        with self.game.construct_task() as task:
+            task.destination = self.tmp.name
+            plan = task.plan(packages, download=True)
+            estimate = task.estimate_resources(plan, packages)
+
+            self.assertEqual(estimate.download_bytes, plan.download_bytes)
+            self.assertGreaterEqual(estimate.download_bytes,
+                    self.game.files['e1m4b.zip'].size)
+            self.assertEqual(estimate.tool_invocations, 0)
+            self.assertEqual(estimate.hash_bytes, plan.write_bytes)
+            # doom-wad is impossible, so it isn't counted
+            self.assertIn(('built packages', self.tmp.name,
+                self.game.size(packages[0])[1]), estimate.space)
+
+            for labels, paths, needed, free in estimate.filesystems():
+                self.assertGreater(needed, 0)
+
+            self.assertTrue(task.check_space(estimate))
+
+    def test_execute(self):
+        package = self.game.packages['doom-e1m4b-wad']
+        path = os.path.join(self.tmp.name, 'e1m4b.zip')
+
+        with self.game.construct_task() as task:
+            provider = self.game.files['e1m4b.zip']
+
+            with zipfile.ZipFile(path, 'w') as writer:
+                for wanted in provider.provides_files:
+                    data = ('contents of %s\n' % wanted.name).encode('ascii')
+                    writer.writestr(wanted.name, data)
+                    set_contents(wanted, data)
+
+            with open(path, 'rb') as reader:
+                set_contents(provider, reader.read())
+
+            task.consider_file_or_dir(path)
+            plan = task.plan([package])
+            self.assertEqual([(s.action, s.wanted.name) for s in plan.steps],
+                    [('unpack', 'e1m4b.zip')])
+            self.assertEqual(task.execute_plan(plan), set())
+            self.assertIn('e1m4b.wad', task.found)
+            self.assertIs(task.fill_gaps(package), FillResult.COMPLETE)
+
+            # there is nothing left to do
+            self.assertEqual(task.plan([package]).steps, [])
+
+    def test_provider_order(self):
+        game = load_games(game='etqw', use_vfs=False, use_yaml=True)['etqw']
+        small = 'ETQW-client-1.4-1.5-update.x86.run'
+        big = 'ETQW-client-1.5-full.x86.run'
+
+        with game.construct_task() as task:
+            wanted = game.files['EULA.txt']
+
+            # the smaller download is preferred...
+            self.assertEqual(task.order_providers(wanted), [small, big])
+
+            # ... unless we already have the bigger one
+            task.found[big] = os.path.join(self.tmp.name, big)
+            self.assertEqual(task.order_providers(wanted), [big, small])
+
+    def test_nested_provider_order(self):
+        game = load_games(game='descent1', use_vfs=False,
+                use_yaml=True)['descent1']
+        nested = 'descent1.sow'
+        download = 'desc14sw.tar.gz'
+
+        with game.construct_task() as task:
+            wanted = game.files['readme.txt?demo']
+            # make the two providers the same size
+            game.files[nested]._size = game.files[download].size
+
+            # we would have to download the zip that contains the nested
+            # archive, so downloading the tarball is better...
+            self.assertEqual(task.order_providers(wanted), [download, nested])
+
+            # ... but once we have the zip, extracting it is cheaper
+            task.found['desc14sw.exe'] = os.path.join(self.tmp.name,
+                    'desc14sw.exe')
+            self.assertEqual(task.order_providers(wanted), [nested, download])
+
+    def test_planner_provider_order(self):
+        game = load_games(game='etqw', use_vfs=False, use_yaml=True)['etqw']
+        package = game.packages['etqw-bin']
+
+        with game.construct_task() as task:
+            calls = []
+            order_providers = task.order_providers
+
+            def record(wanted, package=None):
+                calls.append((wanted.name, package))
+                return order_providers(wanted, package)
+
+            # the planner must rank providers in the same way as
+            # fill_gap(), which takes the package into account
+            task.order_providers = record
+            task.plan([package], download=True)
+            self.assertIn(('EULA.txt', package), calls)
+            self.assertNotIn(('EULA.txt', None), calls)
+
+    def test_cab_tool_invocations(self):
+        game = load_games(game='arx', use_vfs=False, use_yaml=True)['arx']
+        provider = game.files['Setup2.cab']
+        package = game.packages['arx-fatalis-demo-en-data']
+        # only Quantum folders need cabextract
+        quantum = make_cab([(2, [(b'\0' * 100, 1000)])],
+                [(b'sfx.pak', 1000, 0, 0)])
+
+        with game.construct_task() as task:
+            # we can't tell whether it needs cabextract until we have it
+            self.assertTrue(task.runs_tool(provider))
+
+            path = os.path.join(self.tmp.name, 'Setup2.cab')
+
+            with open(path, 'wb') as writer:
+                writer.write(get_sample_cab())
+
+            task.found[provider.name] = path
+            self.assertFalse(task.runs_tool(provider))
+            step = Step(game, 'unpack', provider, package,
+                    runs_tool=task.runs_tool(provider))
+            self.assertEqual(step.tool_invocations, 0)
+
+            path = os.path.join(self.tmp.name, 'quantum', 'Setup2.cab')
+            os.mkdir(os.path.dirname(path))
+
+            with open(path, 'wb') as writer:
+                writer.write(quantum)
+
+            task.found[provider.name] = path
+            self.assertTrue(task.runs_tool(provider))
+            step = Step(game, 'unpack', provider, package,
+                    runs_tool=task.runs_tool(provider))
+            self.assertEqual(step.tool_invocations, 1)
+
+    def test_executor_conflicts(self):
+        def wanted(name, *provides):
+            return types.SimpleNamespace(name=name, provides_files=provides,
+                    unpack={'format': 'zip'}, size=0)
+
+        # a.zip contains inner.zip, which contains the same file as b.zip
+        shared = wanted('shared.dat')
+        inner = wanted('inner.zip', shared)
+        files = dict((f.name, f) for f in (shared, inner,
+            wanted('a.zip', inner), wanted('b.zip', shared),
+            wanted('c.zip', wanted('other.dat'))))
+        files['other.dat'] = files['c.zip'].provides_files[0]
+
+        lock = threading.Lock()
+        running = set()
+        overlaps = []
+        seen = []
+
+        class Task(object):
+            game = types.SimpleNamespace(files=files)
+            progress_factory = lambda info=None: 'progress'
+            extraction_threads = 8
+
+            def __init__(self):
+                self.found = {}
+                self.unpack_tried = set()
+                self.unpacked_in_memory = set()
+
+            def get_workdir(self):
+                pass
+
+            def unpack_provider(self, package, provider, target):
+                seen.append((self.extraction_threads,
+                    self.progress_factory()))
+
+                with lock:
+                    overlaps.append(set(running))
+                    running.add(provider.name)
+
+                time.sleep(0.1)
+
+                with lock:
+                    running.discard(provider.name)
+
+                self.unpack_tried.add(provider.name)
+
+                for f in provider.provides_files:
+                    self.found[f.name] = f.name
+
+        task = Task()
+        plan = types.SimpleNamespace(steps=[])
+
+        for name, target in (('a.zip', 'inner.zip'), ('b.zip', 'shared.dat'),
+                ('c.zip', 'other.dat')):
+            step = Step(task.game, 'unpack', files[name], None)
+            step.targets.add(target)
+            plan.steps.append(step)
+
+        self.assertEqual(Executor(task, {'cpu': 3, 'io': 1,
+            'network': 1}).run(plan), set())
+        self.assertEqual(len(overlaps), 3)
+
+        for others in overlaps:
+            self.assertFalse(set(['a.zip', 'b.zip']) <= others)
+
+        # a.zip and b.zip could each run alongside c.zip, but not together
+        self.assertIn(set(['a.zip']), overlaps)
+
+        # steps that run together share the extraction threads and do
+        # not show progress
+        self.assertEqual(seen, [(2, None)] * 3)
+        self.assertEqual(task.extraction_threads, 8)
+        self.assertEqual(task.progress_factory(), 'progress')
+
+        # a single step can use all of them
+        del seen[:]
+        task = Task()
+        plan.steps = plan.steps[2:]
+        self.assertEqual(Executor(task, {'cpu': 3, 'io': 1,
+            'network': 1}).run(plan), set())
+        self.assertEqual(seen, [(8, 'progress')])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -18,7 +18,10 @@
 import unittest
 
 from game_data_packager.data import (PackageRelation)
-from game_data_packager.packaging.rpm import (RpmPackaging)
+from game_data_packager.packaging.rpm import (
+        RpmPackaging,
+        owned_paths,
+        )
 
 class RpmTestCase(unittest.TestCase):
     def setUp(self):
@@ -47,6 +50,29 @@ class RpmTestCase(unittest.TestCase):
             rp.format_relation(
                     PackageRelation('libopenal.so.1 | bundled-openal'))
 
+    def test_owned_paths(self):
+        system = RpmPackaging.SYSTEM_DIRS
+
+        self.assertEqual(owned_paths([
+                    '/usr/share/games/quake3/baseq3/pak0.pk3',
+                    '/usr/share/games/quake3/baseq3/pak1.pk3',
+                    '/usr/share/games/quake3/missionpack/pak0.pk3',
+                    # a sibling whose name starts with the same prefix
+                    '/usr/share/games/quake3-data/README',
+                    '/usr/share/doc/quake3-data/copyright',
+                    '/usr/share/doc',
+                    '/usr/games/quake3',
+                    '/usr/share/games',
+                    '/opt/quake3/quake3.x86',
+                    '/',
+                ], system), set([
+                    '/usr/share/games/quake3',
+                    '/usr/share/games/quake3-data',
+                    '/usr/share/doc/quake3-data',
+                    '/usr/games/quake3',
+                    '/opt',
+                ]))
+
     def tearDown(self):
         pass
 
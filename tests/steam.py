@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import argparse
+import concurrent.futures
+import os
+import tempfile
+import unittest
+
+from game_data_packager import (load_games)
+from game_data_packager.steam import (SteamLocator,
+        get_steam_locator,
+        lock_devices,
+        package_steam_game,
+        parse_vdf)
+from game_data_packager.util import (physical_device)
+
+LIBRARY_FOLDERS = '''"libraryfolders"
+{
+	"contentstatsid"		"-123"
+	"1"
+	{
+		"path"		"%s"
+		"label"		""
+	}
+}
+'''
+
+OLD_LIBRARY_FOLDERS = '''"LibraryFolders"
+{
+	"TimeNextStatsReport"		"1234567890"
+	"1"		"%s"
+}
+'''
+
+APP_MANIFEST = '''"AppState"
+{
+	"appid"		"%s"
+	"Universe"		"1"
+	"name"		"%s"
+	"installdir"		"%s"
+	"UserConfig"
+	{
+		"language"		"english"
+	}
+}
+'''
+
+class SteamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+
+    def make_library(self, name, apps=(), library_folders=None):
+        steamapps = os.path.join(self.tmp.name, name, 'steamapps')
+        os.makedirs(os.path.join(steamapps, 'common'))
+
+        for appid, installdir in apps:
+            os.makedirs(os.path.join(steamapps, 'common', installdir))
+
+            with open(os.path.join(steamapps,
+                    'appmanifest_%s.acf' % appid), 'w') as writer:
+                writer.write(APP_MANIFEST % (appid, installdir, installdir))
+
+        if library_folders is not None:
+            with open(os.path.join(steamapps, 'libraryfolders.vdf'),
+                    'w') as writer:
+                writer.write(library_folders)
+
+        return os.path.join(self.tmp.name, name)
+
+    def test_parse_vdf(self):
+        self.assertEqual(parse_vdf(OLD_LIBRARY_FOLDERS % 'D:\\\\Games'),
+                {'LibraryFolders': {'TimeNextStatsReport': '1234567890',
+                    '1': 'D:\\Games'}})
+        self.assertEqual(parse_vdf(LIBRARY_FOLDERS % '/srv')
+                ['libraryfolders']['1']['path'], '/srv')
+
+    def test_locator(self):
+        third = self.make_library('third', [(9050, 'Doom 2')])
+        second = self.make_library('second', [(2280, 'Ultimate Doom')],
+                OLD_LIBRARY_FOLDERS % third)
+        root = self.make_library('root', [(2270, 'Quake')],
+                LIBRARY_FOLDERS % second)
+        # copied without a manifest
+        os.makedirs(os.path.join(root, 'steamapps', 'common', 'Heretic'))
+
+        locator = SteamLocator(roots=[root])
+        self.assertEqual(len(locator.libraries), 3)
+
+        self.assertEqual(list(locator.iter_paths(2280, None)),
+                [os.path.realpath(os.path.join(second, 'steamapps',
+                    'common', 'Ultimate Doom'))])
+        self.assertEqual(list(locator.iter_paths('9050', 'common/Doom 2')),
+                [os.path.realpath(os.path.join(third, 'steamapps',
+                    'common', 'Doom 2'))])
+        self.assertEqual(list(locator.iter_paths(2390, 'common/Heretic')),
+                [os.path.realpath(os.path.join(root, 'steamapps',
+                    'common', 'Heretic'))])
+        self.assertEqual(list(locator.iter_paths(1234, 'common/Nothing')),
+                [])
+
+        game = load_games(game='doom', use_vfs=False, use_yaml=True)['doom']
+
+        try:
+            get_steam_locator.LOCATOR = locator
+
+            with game.construct_task() as task:
+                self.assertEqual(list(task.iter_steam_paths()),
+                        [os.path.realpath(os.path.join(second, 'steamapps',
+                            'common', 'Ultimate Doom'))])
+        finally:
+            get_steam_locator.LOCATOR = None
+
+    def test_physical_device(self):
+        subdir = os.path.join(self.tmp.name, 'subdir')
+        os.mkdir(subdir)
+
+        self.assertIsNone(physical_device(os.path.join(self.tmp.name,
+            'nonexistent')))
+        self.assertEqual(physical_device(subdir),
+                physical_device(self.tmp.name))
+        # not a block device, so we just get the device number
+        self.assertEqual(physical_device('/proc'), os.stat('/proc').st_dev)
+
+    def test_lock_devices(self):
+        # /proc and /sys are different non-block devices
+        locks = lock_devices({
+            'a': ['/proc/self', self.tmp.name, '/proc'],
+            'b': ['/sys', '/proc', self.tmp.name],
+            'c': [os.path.join(self.tmp.name, 'nonexistent')],
+        })
+
+        self.assertEqual(len(locks['a']), 2)
+        self.assertEqual(len(locks['b']), 3)
+        self.assertEqual(locks['c'], [])
+        # games on the same disk share its lock, and take the locks in
+        # the same order
+        self.assertEqual(locks['a'], [l for l in locks['b']
+            if l in locks['a']])
+
+        # so games sharing disks can run concurrently without deadlock
+        def run(game):
+            for i in range(1000):
+                for lock in locks[game]:
+                    lock.acquire()
+
+                for lock in reversed(locks[game]):
+                    lock.release()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(run, g) for g in ('a', 'b', 'a', 'b')]
+
+            for future in futures:
+                future.result(timeout=60)
+
+    def test_locks_released_before_building(self):
+        lock = lock_devices({'doom': [self.tmp.name]})['doom']
+        workdir = self.tmp.name
+        calls = []
+
+        class Task(object):
+            def look_for_files(self, binary_executables=False):
+                calls.append(('look', lock[0].locked()))
+
+            def prepare_packages(self, log_immediately, packages):
+                calls.append(('prepare', lock[0].locked()))
+                return packages
+
+            def build_packages(self, ready, compress, destination):
+                # the disk is free for other games while we compress
+                calls.append(('build', lock[0].locked()))
+                return ['doom-wad.deb']
+
+            def get_workdir(self):
+                return workdir
+
+        args = argparse.Namespace(save_downloads=None, destination=None,
+                binary_executables=False)
+        self.assertEqual(package_steam_game(Task(), args, ['doom-wad'],
+            self.tmp.name, locks=lock), set(['doom-wad.deb']))
+        self.assertEqual(calls, [('look', True), ('prepare', True),
+            ('build', False)])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
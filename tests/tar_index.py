@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+import concurrent.futures
+import gzip
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from game_data_packager.unpack import (TarUnpacker)
+from game_data_packager.unpack.tar_index import (GzipCheckpointReader)
+
+class TarIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='gdptest.')
+        self.saved_cache = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp.name, 'cache')
+
+    def test_gzip_checkpoints(self):
+        data = bytes(range(256)) * 4096
+        path = os.path.join(self.tmp.name, 'multi.gz')
+
+        # two gzip members followed by padding, like some old tarballs
+        with open(path, 'wb') as writer:
+            writer.write(gzip.compress(data[:300000]))
+            writer.write(gzip.compress(data[300000:]))
+            writer.write(b'\0' * 512)
+
+        with GzipCheckpointReader(path) as reader:
+            self.assertEqual(reader.read(), data)
+            reader.seek(123456)
+            self.assertEqual(reader.read(1000), data[123456:124456])
+            reader.seek(10)
+            self.assertEqual(reader.read(5), data[10:15])
+
+    def test_index(self):
+        contents = {}
+        path = os.path.join(self.tmp.name, 'test.tar.gz')
+
+        with tarfile.open(path, 'w:gz') as tar:
+            for i in range(4):
+                name = 'file%d.txt' % i
+                contents[name] = ('%d\n' % i).encode('ascii') * (1000 * i)
+                info = tarfile.TarInfo(name)
+                info.size = len(contents[name])
+                tar.addfile(info, io.BytesIO(contents[name]))
+
+        # the first pass has to stream through the archive
+        with TarUnpacker(path, use_index=True) as unpacker:
+            self.assertFalse(unpacker.seekable())
+
+            for entry in unpacker:
+                with unpacker.open(entry) as reader:
+                    self.assertEqual(reader.read(), contents[entry.name])
+
+        # the second pass can read members in any order
+        with TarUnpacker(path, use_index=True) as unpacker:
+            self.assertTrue(unpacker.seekable())
+            entries = list(unpacker)
+            self.assertEqual(sorted(e.name for e in entries),
+                    sorted(contents.keys()))
+
+            for entry in reversed(entries):
+                with unpacker.open(entry) as reader:
+                    self.assertEqual(reader.read(), contents[entry.name])
+
+    def test_reopen(self):
+        contents = {}
+        path = os.path.join(self.tmp.name, 'test.tar.gz')
+
+        with tarfile.open(path, 'w:gz') as tar:
+            for i in range(8):
+                name = 'file%d.txt' % i
+                contents[name] = ('%d\n' % i).encode('ascii') * (5000 * i)
+                info = tarfile.TarInfo(name)
+                info.size = len(contents[name])
+                tar.addfile(info, io.BytesIO(contents[name]))
+
+        with TarUnpacker(path, use_index=True) as unpacker:
+            # it can't be reopened until it has been indexed
+            self.assertIsNone(unpacker.reopen())
+            list(unpacker)
+
+        with TarUnpacker(path, use_index=True) as unpacker:
+            entries = list(unpacker)
+
+            def read(entry):
+                # each thread has its own decompressor
+                with unpacker.reopen() as worker:
+                    self.assertTrue(worker.seekable())
+
+                    with worker.open(entry) as reader:
+                        return entry.name, reader.read()
+
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                results = dict(pool.map(read, reversed(entries)))
+
+            self.assertEqual(results, contents)
+
+        # bz2 and xz have no checkpoints, so each reader would have to
+        # start again from the beginning
+        path = os.path.join(self.tmp.name, 'test.tar.xz')
+
+        with tarfile.open(path, 'w:xz') as tar:
+            info = tarfile.TarInfo('file.txt')
+            tar.addfile(info, io.BytesIO(b''))
+
+        with TarUnpacker(path, use_index=True) as unpacker:
+            list(unpacker)
+
+        with TarUnpacker(path, use_index=True) as unpacker:
+            self.assertTrue(unpacker.seekable())
+            self.assertIsNone(unpacker.reopen())
+
+    def tearDown(self):
+        if self.saved_cache is None:
+            os.environ.pop('XDG_CACHE_HOME', None)
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.saved_cache
+
+        self.tmp.cleanup()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
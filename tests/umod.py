@@ -16,10 +16,12 @@
 # /usr/share/common-licenses/GPL-2.
 
 import io
+import os
 import struct
+import tempfile
 import unittest
 
-from game_data_packager.unpack.umod import Umod
+from game_data_packager.unpack.umod import (Umod, _decode_compact_index)
 
 HELLO_TXT = b'Hello, world!\n'
 
@@ -53,6 +55,20 @@ File=(Src=Help\\Hello.txt,Size=%d)\r
 \r
 ''' % (len(MANIFEST_INT), len(HELLO_TXT))).encode('ascii')
 
+def compact_index(value):
+    negative = value < 0
+    value = abs(value)
+    more = value >= 0x40
+    ret = [(0x80 if negative else 0) | (0x40 if more else 0) | (value & 0x3f)]
+    value >>= 6
+
+    while more:
+        more = value >= 0x80
+        ret.append((0x80 if more else 0) | (value & 0x7f))
+        value >>= 7
+
+    return bytes(ret)
+
 def get_sample_umod():
     def sized_string(b):
         return bytes([len(b) + 1]) + b + b'\0'
@@ -111,6 +127,48 @@ class UmodTestCase(unittest.TestCase):
             self.assertEqual(hello.read(5), HELLO_TXT[:5])
             self.assertEqual(hello.read(), HELLO_TXT[5:])
 
+    def test_compact_index(self):
+        for value in (0, 1, 63, -63, 64, 1000, -1000, 100000, 2 ** 26):
+            encoded = b'x' + compact_index(value) + b'y'
+            self.assertEqual(_decode_compact_index(encoded, 1),
+                    (value, len(encoded) - 1))
+
+    def test_concurrent(self):
+        with tempfile.TemporaryDirectory(prefix='gdptest.') as tmp:
+            path = os.path.join(tmp, 'example.umod')
+
+            with open(path, 'wb') as writer:
+                writer.write(SAMPLE_UMOD)
+
+            for umod in (self.umod, Umod(path)):
+                with umod:
+                    hello = umod.open('Help/Hello.txt')
+                    manifest = umod.open('System/Manifest.int')
+
+                    # interleaved reads don't interfere with each other
+                    self.assertEqual(hello.read(5), HELLO_TXT[:5])
+                    self.assertEqual(manifest.read(7), MANIFEST_INT[:7])
+
+                    buf = bytearray(100)
+                    n = hello.readinto(buf)
+                    self.assertEqual(bytes(buf[:n]), HELLO_TXT[5:])
+
+                    self.assertEqual(manifest.read(), MANIFEST_INT[7:])
+
+                    hello.seek(-6, os.SEEK_END)
+                    self.assertEqual(hello.read(), HELLO_TXT[-6:])
+
+                    hello.close()
+                    manifest.close()
+
+                    with umod.reopen() as other:
+                        with other.open('Help/Hello.txt') as reader:
+                            self.assertEqual(reader.read(), HELLO_TXT)
+
+                    # closing the reopened copy leaves this one usable
+                    with umod.open('Help/Hello.txt') as reader:
+                        self.assertEqual(reader.read(), HELLO_TXT)
+
     def tearDown(self):
         del self.umod
 
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+# Micro-benchmark for parsing the table of contents of a large umod.
+# Not part of "make check"; run it by hand:
+#   GDP_UNINSTALLED=1 PYTHONPATH=. python3 tests/umod_benchmark.py
+
+import argparse
+import io
+import os
+import struct
+import tempfile
+import time
+
+from game_data_packager.unpack.umod import Umod
+
+from tests.umod import compact_index
+
+def get_large_umod(n_entries):
+    names = ['Textures\\Texture%05d.utx' % i for i in range(n_entries)]
+    group = ''.join('File=(Src=%s,Size=1)\r\n' % name for name in names)
+    manifest = ('[Setup]\r\n'
+            'Product=Benchmark\r\n'
+            'Version=100\r\n'
+            'Group=SetupGroup\r\n'
+            'Group=TextureGroup\r\n'
+            '\r\n'
+            '[SetupGroup]\r\n'
+            'Copy=(Src=System\\Manifest.ini,Flags=3)\r\n'
+            '\r\n'
+            '[TextureGroup]\r\n'
+            '%s'
+            '\r\n' % group).encode('ascii')
+
+    data = [manifest, b'x' * n_entries]
+    toc = [compact_index(n_entries + 1)]
+    offset = 0
+
+    for name, size in [('System\\Manifest.ini', len(manifest))] + [
+            (name, 1) for name in names]:
+        encoded = name.encode('windows-1252') + b'\0'
+        toc.append(compact_index(len(encoded)))
+        toc.append(encoded)
+        toc.append(struct.pack('<III', offset, size, 0))
+        offset += size
+
+    body = b''.join(data + toc)
+    return body + struct.pack('<IIIII', 0x9fe3c5a3, offset, len(body) + 20,
+            1, 0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    sample = get_large_umod(args.entries)
+
+    with tempfile.TemporaryDirectory(prefix='gdptest.') as tmp:
+        path = os.path.join(tmp, 'large.umod')
+
+        with open(path, 'wb') as writer:
+            writer.write(sample)
+
+        for label, source in (('file', lambda: path),
+                ('BytesIO', lambda: io.BytesIO(sample))):
+            best = None
+
+            for i in range(args.repeat):
+                start = time.perf_counter()
+
+                with Umod(source()) as umod:
+                    assert len(umod.entries) == args.entries + 1
+
+                elapsed = time.perf_counter() - start
+
+                if best is None or elapsed < best:
+                    best = elapsed
+
+            print('%-8s %d entries: best of %d: %.3f s' % (label,
+                args.entries, args.repeat, best))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+# encoding=utf-8
+#
+# Copyright © 2016 the game-data-packager developers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You can find the GPL license text on a Debian system under
+# /usr/share/common-licenses/GPL-2.
+
+# Compile an index of every known file of every game from the JSON
+# in out/vfs, for "game-data-packager identify".
+
+import json
+import os
+import sys
+
+from game_data_packager import (load_games)
+from game_data_packager.catalog import (Catalog)
+
+def main(out):
+    catalog = Catalog.from_games(load_games(use_vfs=False))
+
+    with open(out + '.tmp', 'w', encoding='utf-8') as writer:
+        json.dump(catalog.to_data(), writer, sort_keys=True)
+
+    os.rename(out + '.tmp', out)
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -42,9 +42,7 @@ Suggests: cdparanoia
 Suggests: vorbis-tools
 # extract
 Suggests: arj
-Suggests: cabextract
 Recommends: innoextract
-Suggests: lha
 Suggests: p7zip-plugins
 Suggests: xdelta
 Suggests: unar